@@ -0,0 +1,160 @@
+"""
+Per-image / per-well aggregation of Cells features inside SQLite.
+
+The features and statistics are declared as a dict, and everything is computed in one
+GROUP BY query, so the per-cell rows never reach pandas:
+
+    aggregate_cells(conn, {'Cells_AreaShape_Area': ['mean', 'median', 'std'],
+                           'Cells_AreaShape_Perimeter': ['max', 'q90']})
+
+gives one row per image with the columns ImageID, MeanCellsAreaShapeArea,
+MedianCellsAreaShapeArea, StdCellsAreaShapeArea, MaxCellsAreaShapePerimeter and Q90CellsAreaShapePerimeter.
+"""
+import hashlib
+import json
+import math
+import re
+import pandas as pd
+
+# Statistics SQLite computes natively
+SQL_STATS = {'mean': 'AVG', 'min': 'MIN', 'max': 'MAX', 'sum': 'SUM', 'count': 'COUNT'}
+# Statistics computed by the aggregates registered below, still inside the query
+PYTHON_STATS = {'std': 'morpho_std', 'var': 'morpho_var', 'median': 'morpho_quantile'}
+QUANTILE_PATTERN = re.compile(r'^q(\d{1,2})$')
+COLUMN_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# How the rows of Cells are grouped: by image, or by well through the Image table
+GROUP_BY = {
+    'image': ('Cells.TableNumber', 'ImageID'),
+    'well': ('Image.Image_Metadata_Well', 'Well'),
+}
+
+
+class Variance:
+    """
+    Sample variance with Welford's algorithm, numerically stable in a single pass.
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def step(self, value):
+        if value is None:
+            return
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+    def finalize(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else None
+
+
+class StandardDeviation(Variance):
+    def finalize(self):
+        variance = super().finalize()
+        return math.sqrt(variance) if variance is not None else None
+
+
+class Quantile:
+    """
+    Quantile with linear interpolation (the pandas default). Only the values of the current group are kept.
+    """
+    def __init__(self):
+        self.values = []
+        self.q = 0.5
+
+    def step(self, value, q):
+        self.q = q
+        if value is not None:
+            self.values.append(value)
+
+    def finalize(self):
+        if not self.values:
+            return None
+        values = sorted(self.values)
+        position = (len(values) - 1) * self.q
+        lower = math.floor(position)
+        upper = min(lower + 1, len(values) - 1)
+        return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def register_aggregates(conn):
+    conn.create_aggregate('morpho_var', 1, Variance)
+    conn.create_aggregate('morpho_std', 1, StandardDeviation)
+    conn.create_aggregate('morpho_quantile', 2, Quantile)
+
+
+def stat_expression(feature, stat):
+    """
+    SQL expression and output column name for one statistic of one Cells column.
+    """
+    if not COLUMN_PATTERN.match(feature):
+        raise ValueError(f'Invalid column name {feature!r}')
+
+    name = "".join(f'{stat.capitalize()}_{feature}'.split('_'))
+    if stat in SQL_STATS:
+        return f'{SQL_STATS[stat]}(Cells.{feature})', name
+    if stat == 'median':
+        return f'morpho_quantile(Cells.{feature}, 0.5)', name
+    if stat in PYTHON_STATS:
+        return f'{PYTHON_STATS[stat]}(Cells.{feature})', name
+
+    match = QUANTILE_PATTERN.match(stat)
+    if match:
+        return f'morpho_quantile(Cells.{feature}, {int(match.group(1)) / 100})', name
+
+    raise ValueError(f"Unknown statistic {stat!r}, use one of {list(SQL_STATS) + list(PYTHON_STATS)} or q1..q99")
+
+
+def aggregate_query(features, by='image'):
+    """
+    Single GROUP BY query computing every requested statistic.
+    """
+    if by not in GROUP_BY:
+        raise ValueError(f"by must be one of {list(GROUP_BY)}")
+    group_column, group_name = GROUP_BY[by]
+
+    expressions = [f'{group_column} AS {group_name}']
+    for feature, stats in features.items():
+        for stat in stats:
+            expression, name = stat_expression(feature, stat)
+            expressions.append(f'{expression} AS {name}')
+
+    join = ' JOIN Image ON Image.TableNumber = Cells.TableNumber' if by == 'well' else ''
+    return f"""
+            SELECT {', '.join(expressions)}
+            FROM Cells{join}
+            GROUP BY {group_column}
+            """
+
+
+def aggregate_table_name(features, by='image'):
+    """
+    Name of the table caching the result of a spec in the plate DB (see plate_db.prepare_plate_db).
+    """
+    spec = json.dumps({'by': by, 'features': features}, sort_keys=True)
+    return f'CellsAggregate_{by}_{hashlib.sha1(spec.encode()).hexdigest()[:12]}'
+
+
+def has_table(conn, table_name):
+    query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+    return conn.execute(query, (table_name,)).fetchone() is not None
+
+
+def aggregate_cells(conn, features, by='image'):
+    """
+    Compute the statistics of the Cells features per image (by='image') or per well (by='well')
+    and return a compact DataFrame with one row per group.
+    Statistics: mean, median, std, var, min, max, sum, count and quantiles q1..q99.
+    Reads the precomputed table instead when the plate DB has been prepared for this spec.
+    """
+    table_name = aggregate_table_name(features, by)
+    if has_table(conn, table_name):
+        cursor = conn.execute(f'SELECT * FROM {table_name}')
+    else:
+        register_aggregates(conn)
+        cursor = conn.execute(aggregate_query(features, by))
+    data = cursor.fetchall()
+    return pd.DataFrame(data, columns=[i[0] for i in cursor.description])
@@ -0,0 +1,267 @@
+"""
+Storage and warehouse backends used by utils.py.
+
+GCPBackend talks to Cloud Storage and Big Query. Its clients are created on first use and then
+shared by every call in the process, instead of one new client per call.
+LocalBackend serves the same operations from a local folder (standing in for the bucket)
+and a DuckDB file (standing in for Big Query), so the Plate pipeline runs fully offline.
+
+The backend is picked with the DATA_BACKEND environment variable ('gcp' or 'local').
+"""
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+import pyarrow as pa
+from params import DATA_BACKEND, LOCAL_BUCKET_PATH, LOCAL_WAREHOUSE_PATH
+from cache import filter_expressions
+
+OPERATORS = {'=', '!=', '<', '<=', '>', '>=', 'in'}
+BATCH_SIZE = 100_000
+# Longest wait for the warehouse file when another process holds its lock
+WAREHOUSE_LOCK_TIMEOUT_S = 300
+
+
+def build_query(table, columns, filters, quote, param):
+    """
+    SELECT the columns of table (all if None) WHERE every filter holds.
+    filters use the format of cache.read_table, e.g. {'Well': 'a01', 'ImageID': (0, 999)}.
+    quote(name) quotes a column name and param(value) returns the placeholder of a query parameter.
+    """
+    select = ', '.join(quote(col) for col in columns) if columns else '*'
+    conditions = []
+    for col, op, value in filter_expressions(filters) or []:
+        if op not in OPERATORS:
+            raise ValueError(f'Unsupported filter operator {op!r}')
+        if op == 'in':
+            conditions.append(f'{quote(col)} IN ({", ".join(param(v) for v in value)})')
+        else:
+            conditions.append(f'{quote(col)} {op} {param(value)}')
+
+    query = f'SELECT {select} FROM {table}'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    return query
+
+
+class GCPBackend:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.clients = {}
+
+    def client(self, kind, project=None):
+        """
+        Shared client of the given kind ('storage' or 'bigquery'), created on first use.
+        Clients are not fork safe, so a forked worker process creates its own.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.clients = {}
+
+            key = (kind, project)
+            if key not in self.clients:
+                if kind == 'storage':
+                    from google.cloud import storage
+                    self.clients[key] = storage.Client(project=project)
+                elif kind == 'bigquery':
+                    from google.cloud import bigquery
+                    self.clients[key] = bigquery.Client(project=project)
+                else:
+                    # Storage Read API, streams query results as Arrow. Optional, pages are used without it.
+                    try:
+                        from google.cloud import bigquery_storage
+                        self.clients[key] = bigquery_storage.BigQueryReadClient()
+                    except ImportError:
+                        self.clients[key] = None
+            return self.clients[key]
+
+    def download(self, bucket_name, source_blob_name, destination_file_name):
+        from tqdm.std import tqdm
+
+        storage_client = self.client('storage')
+        blob = storage_client.bucket(bucket_name).get_blob(source_blob_name)
+        if blob is None:
+            raise FileNotFoundError(f'{source_blob_name} not found in bucket {bucket_name}')
+        with open(destination_file_name, 'wb') as f:
+            with tqdm.wrapattr(f, "write", total=blob.size) as file_obj:
+                storage_client.download_blob_to_file(blob, file_obj)
+
+    def query(self, gcp_project, full_table_name, columns=None, filters=None, page_size=None):
+        from google.cloud import bigquery
+
+        query_parameters = []
+
+        def param(value):
+            if isinstance(value, bool):
+                kind = 'BOOL'
+            elif isinstance(value, int) or hasattr(value, 'dtype') and value.dtype.kind in 'iu':
+                kind = 'INT64'
+            elif isinstance(value, float) or hasattr(value, 'dtype') and value.dtype.kind == 'f':
+                kind = 'FLOAT64'
+            else:
+                kind = 'STRING'
+            name = f'p{len(query_parameters)}'
+            query_parameters.append(bigquery.ScalarQueryParameter(name, kind, value.item() if hasattr(value, 'item') else value))
+            return f'@{name}'
+
+        query = build_query(f'`{full_table_name}`', columns, filters, lambda col: f'`{col}`', param)
+        job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+        return self.client('bigquery', gcp_project).query(query, job_config=job_config).result(page_size=page_size)
+
+    def read(self, gcp_project, full_table_name, columns=None, filters=None):
+        rows = self.query(gcp_project, full_table_name, columns, filters)
+        return rows.to_dataframe(bqstorage_client=self.client('bqstorage'))
+
+    def read_batches(self, gcp_project, full_table_name, columns=None, filters=None, batch_size=BATCH_SIZE):
+        rows = self.query(gcp_project, full_table_name, columns, filters, page_size=batch_size)
+        if rows.total_rows == 0:
+            # No page would be yielded: one empty batch still carries the columns of the table
+            yield pa.RecordBatch.from_pylist([], schema=rows.to_arrow().schema)
+            return
+        yield from rows.to_arrow_iterable(bqstorage_client=self.client('bqstorage'))
+
+    def write(self, gcp_project, full_table_name, data):
+        from google.cloud import bigquery
+
+        job_config = bigquery.LoadJobConfig(write_disposition="WRITE_APPEND")
+        return self.client('bigquery', gcp_project).load_table_from_dataframe(data, full_table_name, job_config=job_config)
+
+    def write_file(self, gcp_project, full_table_name, path):
+        from google.cloud import bigquery
+
+        job_config = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.PARQUET, write_disposition="WRITE_TRUNCATE")
+        with open(path, 'rb') as f:
+            job = self.client('bigquery', gcp_project).load_table_from_file(f, full_table_name, job_config=job_config)
+        return job.result()
+
+
+class LocalBackend:
+    def __init__(self, bucket_path=LOCAL_BUCKET_PATH, warehouse_path=LOCAL_WAREHOUSE_PATH):
+        self.bucket_path = Path(bucket_path)
+        self.warehouse_path = Path(warehouse_path)
+        self.lock = threading.Lock()
+
+    def connect(self, read_only):
+        """
+        New DuckDB connection to the warehouse file, to be closed after one operation.
+        DuckDB locks the file: processes can read it together, but a writer needs it alone. Every
+        operation therefore only holds the file while it runs, in the mode it needs, and waits
+        when another process (e.g. an orchestrator worker) has it.
+        """
+        try:
+            import duckdb
+        except ImportError:
+            raise ImportError('The local backend needs duckdb: pip install duckdb')
+        if not self.warehouse_path.is_file():
+            if read_only:
+                raise FileNotFoundError(f'Local warehouse {self.warehouse_path} does not exist yet')
+            # Created under a temp name and linked in place, so no process opens a half created file
+            self.warehouse_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.warehouse_path.with_name(f'{self.warehouse_path.name}.{os.getpid()}.tmp')
+            duckdb.connect(str(tmp_path)).close()
+            try:
+                os.link(tmp_path, self.warehouse_path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+
+        deadline = time.monotonic() + WAREHOUSE_LOCK_TIMEOUT_S
+        while True:
+            try:
+                return duckdb.connect(str(self.warehouse_path), read_only=read_only)
+            except duckdb.IOException as e:
+                if 'lock' not in str(e).lower() or time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    @staticmethod
+    def table_name(full_table_name):
+        """
+        project.dataset.table -> "dataset"."table", the project is ignored.
+        """
+        dataset, table = full_table_name.split('.')[-2:]
+        return f'"{dataset}"', f'"{dataset}"."{table}"'
+
+    def download(self, bucket_name, source_blob_name, destination_file_name):
+        source = self.bucket_path.joinpath(bucket_name, source_blob_name)
+        if not source.is_file():
+            raise FileNotFoundError(f'{source_blob_name} not found in local bucket {self.bucket_path.joinpath(bucket_name)}')
+        shutil.copyfile(source, destination_file_name)
+
+    def query(self, conn, full_table_name, columns=None, filters=None):
+        """
+        Run the query on its own cursor of conn, so several reads can be consumed at the same time.
+        """
+        _, table = self.table_name(full_table_name)
+        params = []
+
+        def param(value):
+            params.append(value.item() if hasattr(value, 'item') else value)
+            return '?'
+
+        query = build_query(table, columns, filters, lambda col: f'"{col}"', param)
+        return conn.cursor().execute(query, params)
+
+    def read(self, gcp_project, full_table_name, columns=None, filters=None):
+        conn = self.connect(read_only=True)
+        try:
+            return self.query(conn, full_table_name, columns, filters).df()
+        finally:
+            conn.close()
+
+    def read_batches(self, gcp_project, full_table_name, columns=None, filters=None, batch_size=BATCH_SIZE):
+        # The file stays locked for reading until the batches are consumed or the generator closed
+        conn = self.connect(read_only=True)
+        try:
+            reader = self.query(conn, full_table_name, columns, filters).fetch_record_batch(batch_size)
+            empty = True
+            for batch in reader:
+                empty = False
+                yield batch
+            if empty:
+                # As for Big Query, an empty table is one empty batch with its columns
+                yield pa.RecordBatch.from_pylist([], schema=reader.schema)
+        finally:
+            conn.close()
+
+    def write(self, gcp_project, full_table_name, data):
+        schema, table = self.table_name(full_table_name)
+        with self.lock:
+            conn = self.connect(read_only=False)
+            try:
+                conn.register('data_to_write', data)
+                conn.execute(f'CREATE SCHEMA IF NOT EXISTS {schema}')
+                conn.execute(f'CREATE TABLE IF NOT EXISTS {table} AS SELECT * FROM data_to_write LIMIT 0')
+                conn.execute(f'INSERT INTO {table} SELECT * FROM data_to_write')
+            finally:
+                conn.close()
+
+    def write_file(self, gcp_project, full_table_name, path):
+        schema, table = self.table_name(full_table_name)
+        with self.lock:
+            conn = self.connect(read_only=False)
+            try:
+                conn.execute(f'CREATE SCHEMA IF NOT EXISTS {schema}')
+                conn.execute(f'CREATE OR REPLACE TABLE {table} AS SELECT * FROM read_parquet(?)', [str(path)])
+            finally:
+                conn.close()
+
+
+BACKENDS = {'gcp': GCPBackend, 'local': LocalBackend}
+_backend = None
+
+
+def get_backend():
+    """
+    Backend selected by DATA_BACKEND, shared by the whole process.
+    """
+    global _backend
+    if _backend is None:
+        if DATA_BACKEND not in BACKENDS:
+            raise ValueError(f"Unknown DATA_BACKEND {DATA_BACKEND!r}, use one of {list(BACKENDS)}")
+        _backend = BACKENDS[DATA_BACKEND]()
+    return _backend
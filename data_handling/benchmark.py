@@ -0,0 +1,389 @@
+"""
+Benchmark of the pipeline stages on synthetic plates (see synthetic.py): time and peak memory of
+every stage at several plate sizes, compared with a saved baseline.
+
+    python benchmark.py --scales 1000,10000 --cells 100
+    python benchmark.py --scales 1000,10000 --save-baseline benchmark_baseline.json
+    python benchmark.py --scales 1000,10000 --baseline benchmark_baseline.json --threshold 0.25
+
+Every scale runs in its own process, on a plate generated in a temporary LOCAL_DATA_PATH with the
+local backend, so no real data or cloud resource is touched. Time is the best of --repeat runs of
+the whole pipeline, each on a fresh copy of the DB. Peak memory is measured with tracemalloc in one
+more run (it counts Python and numpy allocations, not the page cache of SQLite).
+
+With --baseline the exit code is 1 when a stage is slower, or uses more memory, than its baseline
+by more than --threshold (and by more than --min-seconds / --min-mb, so tiny stages do not fail on noise).
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from params import CELL_AGGREGATES, CELLS_CHUNK_SIZE
+from cache import processed_path, TableWriter
+from aggregate import aggregate_cells
+from plate_db import prepare_plate_db, connect_read_only
+from picture_paths import CHANNEL_FOLDERS, picture_file_names, extract_well_and_photo, channel_paths
+from synthetic import make_synthetic_plate, synthetic_pictures_df
+
+BENCH_PLATE = '90000'
+DEMO_PATH = Path(__file__).resolve().parent.parent.joinpath('demo')
+ROOT_PATH = 'https://storage.cloud.google.com/bucket/00000/raw/pictures/'
+API_IMAGES = 256
+
+
+def legacy_parse(pictures_df, plate_number='00000'):
+    """
+    Implementation of merge_picture_data before vectorization, kept as the reference.
+    """
+    pictures_df = pictures_df.copy()
+    channels_df = pictures_df.drop(columns=['CellCount', 'ImageID'])
+
+    wells_df = channels_df.apply(lambda col: col.map(lambda x: x.split('/')[-1].split('_')[1]))
+    wells_df['Well'] = wells_df.apply(lambda row: row.unique()[0] if row.nunique() == 1 else 0, axis=1)
+
+    photo_number_df = channels_df.apply(lambda col: col.map(lambda x: x.split('/')[-1].split('_')[2]))
+    photo_number_df['PhotoNumber'] = photo_number_df.apply(lambda row: int(row.unique()[0][1]) if row.nunique() == 1 else float('NaN'), axis=1)
+
+    for channel, folder in CHANNEL_FOLDERS.items():
+        pictures_df[channel] = pictures_df[channel].apply(lambda x: f'{ROOT_PATH}{plate_number}-{folder}/{x.split("/")[-1]}')
+
+    return pd.concat([pictures_df, wells_df['Well'], photo_number_df['PhotoNumber'].astype('int32')], axis=1)
+
+
+def vectorized_parse(pictures_df, plate_number='00000'):
+    pictures_df = pictures_df.copy()
+    names_df = picture_file_names(pictures_df)
+    wells_photos_df = extract_well_and_photo(names_df)
+    pictures_df[list(CHANNEL_FOLDERS)] = channel_paths(names_df, lambda folder: f'{ROOT_PATH}{plate_number}-{folder}/')
+
+    return pd.concat([pictures_df, wells_photos_df['Well'], wells_photos_df['PhotoNumber'].astype('int32')], axis=1)
+
+
+# Stages run in this order, each gets the context filled by the previous ones and returns the number of rows it handled
+
+def stage_prepare_db(ctx):
+    prepare_plate_db(ctx['sqlite_path'], [CELL_AGGREGATES])
+    ctx['conn'] = connect_read_only(ctx['sqlite_path'])
+
+
+def stage_load_pictures(ctx):
+    from main import Plate
+    ctx['plate'] = Plate(BENCH_PLATE)
+    ctx['plate'].load_pictures_data(ctx['conn'])
+    return len(ctx['plate'].pictures_df)
+
+
+def stage_load_annotations(ctx):
+    ctx['plate'].load_chemical_annotations()
+    ctx['plate'].load_well_annotations()
+    return len(ctx['plate'].chem_df) + len(ctx['plate'].well_df)
+
+
+def stage_merge_pictures(ctx):
+    ctx['plate'].merge_picture_data()
+    return len(ctx['plate'].processed_pictures_df)
+
+
+def stage_load_cells(ctx):
+    ctx['plate'].load_cells_data(ctx['conn'])
+    return len(ctx['plate'].cells_df)
+
+
+def stage_clean_cells(ctx):
+    ctx['plate'].clean_cells_data()
+    return len(ctx['plate'].cells_df)
+
+
+def stage_stream_cells(ctx):
+    ctx['plate'].__dict__.pop('cells_df', None)
+    with TableWriter(processed_path(BENCH_PLATE, 'cells')) as writer:
+        for chunk in ctx['plate'].iter_cells_data(ctx['conn'], CELLS_CHUNK_SIZE or 100_000):
+            writer.write(chunk)
+    return writer.rows
+
+
+def stage_aggregate_image(ctx):
+    return len(aggregate_cells(ctx['conn'], CELL_AGGREGATES, by='image'))
+
+
+def stage_aggregate_well(ctx):
+    # Not precomputed by prepare_plate_db: a full scan of Cells joined to Image
+    return len(aggregate_cells(ctx['conn'], CELL_AGGREGATES, by='well'))
+
+
+def stage_picture_paths_legacy(ctx):
+    return len(legacy_parse(ctx['synthetic_pictures_df']))
+
+
+def stage_picture_paths_vectorized(ctx):
+    return len(vectorized_parse(ctx['synthetic_pictures_df']))
+
+
+def stage_image_store(ctx):
+    from image_store import build_image_store
+    if not ctx['pictures']:
+        return None
+    build_image_store(BENCH_PLATE, 'Hoechst', ctx['plate'].processed_pictures_df, size=(64, 64), overwrite=True)
+    return len(ctx['plate'].processed_pictures_df)
+
+
+def stage_well_mosaics(ctx):
+    from stitching import build_well_mosaics
+    if not ctx['pictures']:
+        return None
+    build_well_mosaics(BENCH_PLATE, ('Hoechst',), overwrite=True)
+    return ctx['plate'].processed_pictures_df['Well'].nunique()
+
+
+def api_bodies(n_images):
+    """
+    Request bodies of n_images 224 x 224 uint16 images, as the clients send them.
+    """
+    from payloads import encode_base64, encode_npy
+    images = np.random.default_rng(0).integers(0, 65535, (n_images, 224, 224), dtype=np.uint16)
+    return {'json': [json.dumps(encode_base64(image)).encode() for image in images],
+            'npy': [encode_npy(image)[0] for image in images]}
+
+
+def stage_api_decode_json(ctx):
+    from payloads import decode_json
+    bodies = ctx['api_bodies']['json']
+    ctx['api_images'] = [decode_json(body) for body in bodies]
+    return len(bodies)
+
+
+def stage_api_decode_npy(ctx):
+    from payloads import decode_npy
+    bodies = ctx['api_bodies']['npy']
+    ctx['api_images'] = [decode_npy(body) for body in bodies]
+    return len(bodies)
+
+
+def stage_api_predict(ctx):
+    """
+    Concurrent requests through the model registry (micro-batching, no prediction cache) with a stand-in
+    model that costs nothing, so the stage measures the API code and not TensorFlow.
+    """
+    from registry import ModelRegistry, StandInModel
+
+    async def predict_all():
+        registry = ModelRegistry(loader=lambda path: StandInModel(path, latency_ms=0, per_image_ms=0))
+        registry.register('counter', 'stand-in')
+        try:
+            return await asyncio.gather(*(registry.predict('counter', image / 65535) for image in ctx['api_images']))
+        finally:
+            await registry.close()
+
+    return len(asyncio.run(predict_all()))
+
+
+STAGES = {
+    'prepare_db': stage_prepare_db,
+    'load_pictures': stage_load_pictures,
+    'load_annotations': stage_load_annotations,
+    'merge_pictures': stage_merge_pictures,
+    'load_cells': stage_load_cells,
+    'clean_cells': stage_clean_cells,
+    'stream_cells': stage_stream_cells,
+    'aggregate_image': stage_aggregate_image,
+    'aggregate_well': stage_aggregate_well,
+    'picture_paths_legacy': stage_picture_paths_legacy,
+    'picture_paths_vectorized': stage_picture_paths_vectorized,
+    'image_store': stage_image_store,
+    'well_mosaics': stage_well_mosaics,
+    'api_decode_json': stage_api_decode_json,
+    'api_decode_npy': stage_api_decode_npy,
+    'api_predict': stage_api_predict,
+}
+
+# Stages whose context a stage needs: they run before it, unreported, when it is benchmarked on its own
+REQUIRES = {
+    'load_pictures': ['prepare_db'],
+    'load_annotations': ['load_pictures'],
+    'merge_pictures': ['load_annotations'],
+    'load_cells': ['load_pictures'],
+    'clean_cells': ['load_cells'],
+    'stream_cells': ['load_pictures'],
+    'aggregate_image': ['prepare_db'],
+    'aggregate_well': ['prepare_db'],
+    'image_store': ['merge_pictures'],
+    'well_mosaics': ['merge_pictures'],
+    'api_predict': ['api_decode_npy'],
+}
+
+
+def with_requirements(stages):
+    """
+    The stages and everything they need, in the order of STAGES.
+    """
+    needed = set()
+    pending = list(stages)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(REQUIRES.get(name, []))
+    return [name for name in STAGES if name in needed]
+
+
+def run_pipeline(sqlite_path, pristine_path, n_images, pictures, stages, trace, verbose):
+    """
+    One run of the stages on a fresh copy of the DB: {stage: (seconds, rows, peak MB or None)}.
+    """
+    shutil.copy(pristine_path, sqlite_path)
+    ctx = {'sqlite_path': sqlite_path, 'pictures': pictures,
+           'synthetic_pictures_df': synthetic_pictures_df(n_images, BENCH_PLATE),
+           'api_bodies': api_bodies(min(API_IMAGES, n_images))}
+    measures = {}
+    try:
+        for name in stages:
+            output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+            with output:
+                if trace:
+                    tracemalloc.start()
+                start = time.perf_counter()
+                rows = STAGES[name](ctx)
+                seconds = time.perf_counter() - start
+                peak_mb = None
+                if trace:
+                    peak_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+                    tracemalloc.stop()
+            measures[name] = (seconds, rows, peak_mb)
+    finally:
+        if 'conn' in ctx:
+            ctx['conn'].close()
+    return measures
+
+
+def run_scale(n_images, cells_per_image, stages, repeat, memory, pictures, verbose):
+    """
+    Measures of the stages on one synthetic plate, run in a child process whose LOCAL_DATA_PATH is a temporary folder.
+    """
+    sys.path.append(str(DEMO_PATH))
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        sqlite_path = make_synthetic_plate(BENCH_PLATE, n_images, cells_per_image, pictures=pictures)
+    pristine_path = sqlite_path.with_suffix('.sqlite.orig')
+    shutil.copy(sqlite_path, pristine_path)
+
+    report = {name: {} for name in stages}
+    for run in range(repeat + memory):
+        trace = run == repeat
+        for name, (seconds, rows, peak_mb) in run_pipeline(sqlite_path, pristine_path, n_images, pictures, with_requirements(stages), trace, verbose).items():
+            if name not in report:
+                continue
+            if trace:
+                report[name]['peak_mb'] = round(peak_mb, 2)
+                continue
+            if seconds < report[name].get('seconds', float('inf')):
+                report[name]['seconds'] = round(seconds, 4)
+            if rows:
+                report[name]['rows'] = rows
+                report[name]['rows_per_s'] = round(rows / max(report[name]['seconds'], 1e-9), 1)
+    return report
+
+
+def bench(scales, cells_per_image=100, stages=tuple(STAGES), repeat=3, memory=True, pictures=True, verbose=False):
+    context = multiprocessing.get_context('spawn')
+    report = {}
+    for n_images in scales:
+        with tempfile.TemporaryDirectory(prefix='morpho_bench_') as data_path:
+            env = {'LOCAL_DATA_PATH': data_path, 'PLATE_NUMBER': BENCH_PLATE, 'DATA_BACKEND': 'local', 'EXPORT_CSV': '0',
+                   # The stages are measured without the instrumentation of instrumentation.py
+                   'METRICS_PATH': ''}
+            previous = {key: os.environ.get(key) for key in env}
+            # The child process reads params.py with this environment
+            os.environ.update(env)
+            try:
+                with context.Pool(1) as pool:
+                    report[str(n_images)] = pool.apply(run_scale, (n_images, cells_per_image, list(stages), repeat, memory, pictures, verbose))
+            finally:
+                for key, value in previous.items():
+                    if value is None:
+                        os.environ.pop(key, None)
+                    else:
+                        os.environ[key] = value
+        print(f'✅ {n_images} images benchmarked')
+    return report
+
+
+def regressions(report, baseline, threshold=0.25, min_seconds=0.05, min_mb=1.0):
+    """
+    (scale, stage, measure, value, baseline value) of every measure past the threshold.
+    """
+    found = []
+    for scale, stages in report.items():
+        for name, measures in stages.items():
+            reference = baseline.get(scale, {}).get(name, {})
+            for measure, minimum in (('seconds', min_seconds), ('peak_mb', min_mb)):
+                value, base = measures.get(measure), reference.get(measure)
+                if value is None or base is None:
+                    continue
+                if value > base * (1 + threshold) and value - base > minimum:
+                    found.append((scale, name, measure, value, base))
+    return found
+
+
+def print_report(report, baseline=None):
+    for scale, stages in report.items():
+        print(f'\n{scale} images')
+        print(f'{"stage":<26}{"seconds":>10}{"rows/s":>14}{"peak MB":>10}{"baseline s":>12}')
+        for name, measures in stages.items():
+            base = (baseline or {}).get(scale, {}).get(name, {}).get('seconds')
+            print(f'{name:<26}{measures.get("seconds", float("nan")):>10.4f}{measures.get("rows_per_s", float("nan")):>14.0f}'
+                  f'{measures.get("peak_mb", float("nan")):>10.1f}{"" if base is None else f"{base:.4f}":>12}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='1000,10000', help='numbers of images of the synthetic plates')
+    parser.add_argument('--cells', type=int, default=100, help='mean number of cells per image')
+    parser.add_argument('--stages', default=','.join(STAGES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run')
+    parser.add_argument('--no-pictures', action='store_true', help='no dummy TIFFs, skips the image stages')
+    parser.add_argument('--baseline', help='JSON report to compare with')
+    parser.add_argument('--save-baseline', help='write the report to this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown, 0.25 = 25%%')
+    parser.add_argument('--min-seconds', type=float, default=0.05)
+    parser.add_argument('--min-mb', type=float, default=1.0)
+    parser.add_argument('--verbose', action='store_true', help='show the output of the stages')
+    args = parser.parse_args()
+
+    stages = args.stages.split(',')
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f'Unknown stages {sorted(unknown)}, use some of {list(STAGES)}')
+
+    scales = [int(scale) for scale in args.scales.split(',')]
+    report = bench(scales, args.cells, stages, args.repeat, not args.no_memory, not args.no_pictures, args.verbose)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\n✅ Baseline saved to {args.save_baseline}')
+
+    if baseline is not None:
+        found = regressions(report, baseline, args.threshold, args.min_seconds, args.min_mb)
+        for scale, name, measure, value, base in found:
+            print(f'❌ {name} at {scale} images: {measure} {value} vs {base} in the baseline')
+        if found:
+            sys.exit(1)
+        print(f'\n✅ No stage regressed by more than {args.threshold:.0%}')
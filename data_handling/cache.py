@@ -0,0 +1,172 @@
+import os
+import warnings
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+from params import LOCAL_DATA_PATH, EXPORT_CSV
+
+ROW_GROUP_SIZE = 64_000
+
+
+def processed_path(plate_number, table, suffix='parquet'):
+    """
+    Path of the processed cache file of a plate table, e.g. ~/.morpho_minds_data/24585/processed/24585_cells.parquet
+    """
+    return Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'processed', f'{plate_number}_{table}.{suffix}')
+
+
+def is_string_type(arrow_type):
+    return pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type)
+
+
+def to_arrow(data, schema=None):
+    """
+    Convert a DataFrame to an Arrow table keeping the pandas dtypes (int32 stays int32).
+    Object columns Arrow cannot type are cast to numbers when all their values are numeric,
+    otherwise (e.g. MMoles after fillna('None')) they are stored as strings, and reported.
+    """
+    data = data.copy()
+    stringified = []
+    for col in data.select_dtypes('object').columns:
+        # Stored as strings by an earlier chunk of the same file
+        string_column = schema is not None and col in schema.names and is_string_type(schema.field(col).type)
+        try:
+            array_type = pa.array(data[col]).type
+            if not string_column or is_string_type(array_type) or pa.types.is_null(array_type):
+                continue
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+
+        try:
+            if string_column:
+                raise ValueError(f'{col} holds strings')
+            data[col] = pd.to_numeric(data[col])
+        except (ValueError, TypeError):
+            data[col] = data[col].astype(str)
+            stringified.append(col)
+
+    if stringified and schema is None:
+        warnings.warn(f'Columns {stringified} mix numbers and text, they are stored as strings')
+    return pa.Table.from_pandas(data, schema=schema, preserve_index=False)
+
+
+def write_table(data, path):
+    """
+    Save a DataFrame as a compressed Parquet file. A CSV copy is also written when EXPORT_CSV is set.
+    """
+    pq.write_table(to_arrow(data), path, compression='zstd', row_group_size=ROW_GROUP_SIZE)
+
+    if EXPORT_CSV:
+        data.to_csv(Path(path).with_suffix('.csv'), index=False)
+
+
+class TableWriter:
+    """
+    Append chunks (DataFrames or Arrow record batches) to a single Parquet file, for tables too
+    big to be held in memory. The schema of the first chunk is used for the whole file.
+    The file is written under a temp name and only shows up at path if every chunk was written.
+    Without any chunk, an empty file with schema (no columns if None) is written on close.
+
+    with TableWriter(path) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    """
+    def __init__(self, path, schema=None):
+        self.path = Path(path)
+        self.schema = schema
+        self.tmp_path = self.path.with_suffix('.parquet.tmp')
+        self.writer = None
+        self.rows = 0
+
+    def write(self, data):
+        schema = None if self.writer is None else self.writer.schema
+        if isinstance(data, pd.DataFrame):
+            table = to_arrow(data, schema=schema)
+        else:
+            table = pa.Table.from_batches([data])
+
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.tmp_path, table.schema, compression='zstd')
+        self.writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+
+        if EXPORT_CSV:
+            first = self.rows == 0
+            data = data if isinstance(data, pd.DataFrame) else table.to_pandas()
+            data.to_csv(self.path.with_suffix('.csv'), mode='w' if first else 'a', header=first, index=False)
+
+        self.rows += table.num_rows
+
+    def close(self):
+        if self.writer is None:
+            # Nothing was written (e.g. an empty source table): still leave a readable file
+            pq.write_table((self.schema or pa.schema([])).empty_table(), self.tmp_path, compression='zstd')
+        else:
+            self.writer.close()
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self.writer is not None:
+            self.writer.close()
+            os.remove(self.tmp_path)
+
+
+def filter_expressions(filters):
+    """
+    Turn {'Well': 'a01', 'Role': ['mock', 'treated'], 'ImageID': (10, 20)} into a list of
+    (column, operator, value) tuples, the format of pyarrow filters. A list is passed through as is.
+    """
+    if filters is None or isinstance(filters, list):
+        return filters
+
+    expressions = []
+    for col, value in filters.items():
+        if isinstance(value, tuple):
+            expressions += [(col, '>=', value[0]), (col, '<=', value[1])]
+        elif isinstance(value, (list, set)):
+            expressions.append((col, 'in', list(value)))
+        else:
+            expressions.append((col, '=', value))
+    return expressions
+
+
+def read_table(path, columns=None, filters=None):
+    """
+    Read a processed table. Only the requested columns are read, and row groups that cannot
+    match the filters are skipped, e.g. read_table(path, ['Well', 'CellCount'], {'Role': 'mock'}).
+    Falls back to the CSV file for caches written before the Parquet format.
+    """
+    path = Path(path)
+    if path.is_file():
+        return pq.read_table(path, columns=columns, filters=filter_expressions(filters)).to_pandas()
+
+    expressions = filter_expressions(filters) or []
+    usecols = None if columns is None else list(dict.fromkeys(list(columns) + [col for col, _, _ in expressions]))
+    data = pd.read_csv(path.with_suffix('.csv'), usecols=usecols)
+    for expression in expressions:
+        col, op, value = expression
+        if op == 'in':
+            data = data[data[col].isin(value)]
+        elif op == '>=':
+            data = data[data[col] >= value]
+        elif op == '<=':
+            data = data[data[col] <= value]
+        else:
+            data = data[data[col] == value]
+
+    if columns is not None:
+        data = data[list(columns)]
+    return data.reset_index(drop=True)
+
+
+def is_cached(path):
+    """
+    True if the processed table exists as Parquet or as a legacy CSV.
+    """
+    path = Path(path)
+    return path.is_file() or path.with_suffix('.csv').is_file()
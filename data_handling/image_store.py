@@ -0,0 +1,182 @@
+"""
+Memory-mapped store of preprocessed pictures, one per plate, channel and size.
+
+The TIFFs of a channel are decoded and resized once into a uint16 .npy file of shape
+(n_images, height, width), next to an index of the rows of the processed pictures table.
+Training code then slices the store instead of decoding thousands of TIFFs again:
+
+    build_image_store('24585', 'Hoechst')
+    store = ImageStore('24585', 'Hoechst')
+    images = store.images[:500]                          # zero copy view
+    images = store.take(store.positions(Well='a01'))     # all the pictures of a well
+
+Multi-channel models use stacks of shape (n_images, height, width, n_channels) instead,
+with the channels in the order given:
+
+    build_stack_store('24585', ['Hoechst', 'Mito', 'PhGolgi'])
+    store = ImageStore('24585', ['Hoechst', 'Mito', 'PhGolgi'])
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from PIL import Image
+from params import LOCAL_DATA_PATH
+from cache import processed_path, read_table, write_table
+from picture_paths import CHANNEL_FOLDERS
+
+IMAGE_SIZE = (224, 224)
+INDEX_COLUMNS = ['ImageID', 'Well', 'PhotoNumber']
+
+
+def local_picture_paths(pictures_df, plate_number, channel):
+    """
+    Paths of the unzipped pictures of a channel, whatever URL or path the processed table holds.
+    """
+    folder = Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'raw', 'pictures', f'{plate_number}-{CHANNEL_FOLDERS[channel]}')
+    return str(folder) + os.sep + pictures_df[channel].str.rsplit('/', n=1).str[-1]
+
+
+def load_picture(path, size=IMAGE_SIZE, resample=Image.NEAREST):
+    """
+    Decode a picture and resize it to size (width, height), keeping the 16 bit values.
+    Nearest neighbour by default, like keras load_img.
+    """
+    with Image.open(path) as img:
+        # Mode 'I' (32 bit int) holds the 16 bit values and can be resized
+        img = img.convert('I').resize(size, resample)
+        return np.asarray(img).astype(np.uint16)
+
+
+def store_paths(plate_number, channels, size=IMAGE_SIZE):
+    """
+    Paths of the images and index files of a store. channels is one channel name or a list of channels (stack).
+    """
+    folder = Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'processed', 'images')
+    prefix = channels if isinstance(channels, str) else 'stack_' + '-'.join(channels)
+    name = f'{prefix}_{size[0]}x{size[1]}'
+    return folder.joinpath(f'{name}.npy'), folder.joinpath(f'{name}_index.parquet')
+
+
+def decode_into(images, jobs, size=IMAGE_SIZE, workers=8):
+    """
+    Decode the pictures of jobs, a list of (position in images, path), in parallel straight into images.
+    """
+    def decode(job):
+        position, path = job
+        images[position] = load_picture(path, size)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() re-raises the first decoding error
+        list(executor.map(decode, jobs))
+
+
+def write_store(plate_number, channels, pictures_df, size, workers, overwrite):
+    """
+    Build the store of one channel (n, height, width) or of a stack of channels (n, height, width, n_channels).
+    """
+    images_path, index_path = store_paths(plate_number, channels, size)
+    if images_path.is_file() and index_path.is_file() and not overwrite:
+        print(f'Image store {images_path} already built.')
+        return images_path
+
+    if pictures_df is None:
+        pictures_df = read_table(processed_path(plate_number, 'small'))
+    missing = [col for col in INDEX_COLUMNS if col not in pictures_df.columns]
+    if missing:
+        raise ValueError(f'The pictures table of plate {plate_number} has no {missing} column, '
+                         'rebuild it (small tables cached before ImageID was kept lack it)')
+
+    if isinstance(channels, str):
+        shape = (len(pictures_df), size[1], size[0])
+        paths = local_picture_paths(pictures_df, plate_number, channels).tolist()
+        jobs = list(enumerate(paths))
+    else:
+        shape = (len(pictures_df), size[1], size[0], len(channels))
+        jobs = []
+        for c, channel in enumerate(channels):
+            paths = local_picture_paths(pictures_df, plate_number, channel).tolist()
+            jobs.extend(((i, slice(None), slice(None), c), path) for i, path in enumerate(paths))
+
+    images_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = images_path.with_suffix('.npy.tmp')
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint16, shape=shape)
+
+    print(f'Decoding {len(jobs)} pictures of plate {plate_number} ({channels})...')
+    try:
+        decode_into(images, jobs, size, workers)
+        images.flush()
+        del images
+        os.replace(tmp_path, images_path)
+    finally:
+        # Only left when a picture could not be decoded
+        tmp_path.unlink(missing_ok=True)
+
+    index = pictures_df[INDEX_COLUMNS].reset_index(drop=True)
+    write_table(index, index_path)
+    print(f'✅ Image store saved to {images_path}')
+    return images_path
+
+
+def build_image_store(plate_number, channel, pictures_df=None, size=IMAGE_SIZE, workers=8, overwrite=False):
+    """
+    Decode and resize every picture of a channel into a memory-mapped .npy file.
+    pictures_df defaults to the processed small table of the plate. Pictures are decoded
+    by a pool of threads writing straight into the file. Returns the path of the store.
+    """
+    return write_store(plate_number, channel, pictures_df, size, workers, overwrite)
+
+
+def build_stack_store(plate_number, channels=tuple(CHANNEL_FOLDERS), pictures_df=None, size=IMAGE_SIZE, workers=8, overwrite=False):
+    """
+    Same as build_image_store for several channels: every row becomes a (height, width, n_channels)
+    stack, channels in the given order. All the (row, channel) pictures are decoded in parallel.
+    """
+    unknown = set(channels) - set(CHANNEL_FOLDERS)
+    if unknown:
+        raise ValueError(f'Unknown channels {sorted(unknown)}, use some of {list(CHANNEL_FOLDERS)}')
+    return write_store(plate_number, list(channels), pictures_df, size, workers, overwrite)
+
+
+def stack_pictures(paths, size=IMAGE_SIZE, workers=8, out=None):
+    """
+    Stack the pictures of paths (one per channel) into a (height, width, n_channels) uint16 array,
+    written into out if given.
+    """
+    if out is None:
+        out = np.empty((size[1], size[0], len(paths)), dtype=np.uint16)
+    decode_into(out, [((slice(None), slice(None), c), path) for c, path in enumerate(paths)], size, workers)
+    return out
+
+
+class ImageStore:
+    """
+    Read-only view of an image store. images is a memmap: slices are views and only the
+    pages actually read are loaded from disk.
+    """
+    def __init__(self, plate_number, channels, size=IMAGE_SIZE):
+        images_path, index_path = store_paths(plate_number, channels, size)
+        self.images = np.load(images_path, mmap_mode='r')
+        self.index = read_table(index_path)
+
+    def __len__(self):
+        return len(self.images)
+
+    def positions(self, **filters):
+        """
+        Rows of the store matching the filters, e.g. positions(Well='a01') or positions(Well=['a01', 'a02']).
+        """
+        mask = np.ones(len(self.index), dtype=bool)
+        for col, value in filters.items():
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            mask &= self.index[col].isin(values).to_numpy()
+        return np.flatnonzero(mask)
+
+    def take(self, positions):
+        """
+        Images at the given rows: a zero copy view when the rows are contiguous, a copy otherwise.
+        """
+        positions = np.asarray(positions)
+        if len(positions) and np.array_equal(positions, np.arange(positions[0], positions[0] + len(positions))):
+            return self.images[positions[0]:positions[0] + len(positions)]
+        return self.images[positions]
@@ -0,0 +1,349 @@
+"""
+Per-stage metrics of the pipelines, written as JSON lines.
+
+Every instrumented stage appends one line to METRICS_PATH when it ends:
+
+    {"stage": "merge_pictures", "parent": "get_processed_data", "plate": "24585", "status": "ok",
+     "wall_s": 1.52, "cpu_s": 1.49, "rows": 3456, "rows_per_s": 2273.7, "bytes_read": 0,
+     "bytes_written": 0, "peak_rss_mb": 812.4, "rss_delta_mb": 35.1, ...}
+
+Stages are marked with the instrumented decorator or the stage context manager:
+
+    @instrumented('load_pictures', rows='pictures_df')     # rows = len(self.pictures_df)
+    def load_pictures_data(self, conn): ...
+
+    with stage('extract', plate=plate_number) as metrics:
+        metrics.rows = extract()
+
+The records can also be collected in process, e.g. to keep them with the result of a run:
+
+    with collect_stages() as records:
+        plate.run()
+
+Peak RSS is sampled by a background thread every RSS_INTERVAL_S seconds. Bytes read and written
+are those of the whole process during the stage (read/write calls on files and pipes, from
+/proc/self/io: a download counts what it writes to disk, an upload what it reads), so concurrent
+stages of other threads are counted too. Configured with the environment variables:
+
+    METRICS_PATH        JSON lines file (default LOCAL_DATA_PATH/metrics.jsonl, empty to disable)
+    METRICS_RUN_ID      id shared by the lines of one run (default: one per process)
+    PROFILE_STAGES      stages to run under cProfile, comma separated or 'all'; the .prof file is
+                        saved next to METRICS_PATH and the slowest functions added to the line
+    TRACEMALLOC_STAGES  stages to trace with tracemalloc; the top allocation sites are added to the line
+
+    python instrumentation.py                   # summary of the metrics file, per stage
+    python instrumentation.py --run 1a2b3c4d    # of one run only
+"""
+import argparse
+import contextlib
+import cProfile
+import functools
+import inspect
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+METRICS_PATH = os.environ.get('METRICS_PATH', os.path.join(
+    os.environ.get('LOCAL_DATA_PATH', os.path.join(os.path.expanduser('~'), ".morpho_minds_data")), 'metrics.jsonl'))
+PROFILE_STAGES = set(filter(None, os.environ.get('PROFILE_STAGES', '').split(',')))
+TRACEMALLOC_STAGES = set(filter(None, os.environ.get('TRACEMALLOC_STAGES', '').split(',')))
+RSS_INTERVAL_S = 0.05
+TOP_ENTRIES = 10
+
+PROCESS_RUN_ID = uuid.uuid4().hex[:8]
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+_write_lock = threading.Lock()
+_local = threading.local()
+_profiling = threading.Lock()
+_collectors = []
+
+
+def run_id():
+    return os.environ.get('METRICS_RUN_ID') or PROCESS_RUN_ID
+
+
+def current_rss():
+    """
+    Resident memory of the process in bytes. Falls back on the peak so far where /proc is missing.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        # ru_maxrss is in KB on Linux, in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def io_counters():
+    """
+    (bytes read, bytes written) by the process so far, or (None, None).
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class RSSSampler:
+    """
+    Highest RSS seen between start() and stop(), sampled by a daemon thread.
+    """
+    def __init__(self, interval=RSS_INTERVAL_S):
+        self.interval = interval
+        self.peak = current_rss()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak
+
+
+class StageMetrics:
+    """
+    Metrics of a running stage. The code of the stage may set rows, bytes_read / bytes_written
+    (instead of the process counters) and extra fields.
+    """
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+        self.rows = None
+        self.bytes_read = None
+        self.bytes_written = None
+        self.extra = {}
+
+
+def selected(name, stages):
+    return 'all' in stages or name in stages
+
+
+def write_record(record, path=None):
+    path = METRICS_PATH if path is None else path
+    if not path:
+        return
+    line = json.dumps(record, default=str) + '\n'
+    with _write_lock:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(line)
+
+
+def profile_summary(profiler, name):
+    """
+    Save the profile next to the metrics file and return its path and the slowest functions.
+    """
+    profile_path = None
+    if METRICS_PATH:
+        folder = Path(METRICS_PATH).parent.joinpath('profiles')
+        folder.mkdir(parents=True, exist_ok=True)
+        profile_path = folder.joinpath(f'{name}-{run_id()}-{os.getpid()}-{int(time.time())}.prof')
+        profiler.dump_stats(profile_path)
+
+    stats = pstats.Stats(profiler, stream=io.StringIO()).sort_stats('cumulative')
+    top = []
+    for (filename, line, function), (_, calls, _, cumulative, _) in list(stats.stats.items()):
+        top.append((cumulative, f'{Path(filename).name}:{line}({function})', calls))
+    top.sort(reverse=True)
+    return profile_path, [{'function': function, 'calls': calls, 'cumulative_s': round(cumulative, 4)}
+                          for cumulative, function, calls in top[:TOP_ENTRIES]]
+
+
+@contextlib.contextmanager
+def collect_stages():
+    """
+    List receiving the record of every stage of the process that ends within the block,
+    whether METRICS_PATH is set or not.
+    """
+    records = []
+    _collectors.append(records)
+    try:
+        yield records
+    finally:
+        _collectors.remove(records)
+
+
+@contextlib.contextmanager
+def stage(name, **tags):
+    """
+    Measure the block as the stage name and write its metrics line when it ends, failed or not.
+    """
+    if not METRICS_PATH and not _collectors:
+        yield StageMetrics(name, tags)
+        return
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    parent = stack[-1] if stack else None
+    inherited = dict(parent.tags) if parent else {}
+    metrics = StageMetrics(name, {**inherited, **tags})
+    stack.append(metrics)
+
+    # cProfile allows one profiler at a time: a stage nested in a profiled one is not profiled again
+    profiler = None
+    if selected(name, PROFILE_STAGES) and _profiling.acquire(blocking=False):
+        profiler = cProfile.Profile()
+    tracing = selected(name, TRACEMALLOC_STAGES) and not tracemalloc.is_tracing()
+
+    started = datetime.now(timezone.utc)
+    read_start, written_start = io_counters()
+    rss_start = current_rss()
+    sampler = RSSSampler().start()
+    if tracing:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    status, error = 'ok', None
+    try:
+        yield metrics
+    except BaseException as e:
+        status, error = 'failed', repr(e)
+        raise
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        if profiler is not None:
+            profiler.disable()
+        if tracing:
+            snapshot = tracemalloc.take_snapshot()
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        peak_rss = sampler.stop()
+        read_end, written_end = io_counters()
+        stack.pop()
+
+        record = {'time': started.isoformat(timespec='milliseconds'), 'run': run_id(), 'pid': os.getpid(),
+                  'stage': name, 'parent': parent.name if parent else None, **metrics.tags,
+                  'status': status, 'error': error,
+                  'wall_s': round(wall, 4), 'cpu_s': round(cpu, 4),
+                  'rows': metrics.rows,
+                  'rows_per_s': round(metrics.rows / wall, 1) if metrics.rows is not None and wall > 0 else None,
+                  'bytes_read': metrics.bytes_read if metrics.bytes_read is not None else (None if read_start is None else read_end - read_start),
+                  'bytes_written': metrics.bytes_written if metrics.bytes_written is not None else (None if written_start is None else written_end - written_start),
+                  'peak_rss_mb': round(peak_rss / 1024 ** 2, 1),
+                  'rss_delta_mb': round((current_rss() - rss_start) / 1024 ** 2, 1),
+                  **metrics.extra}
+        if profiler is not None:
+            record['profile'], record['profile_top'] = profile_summary(profiler, name)
+            _profiling.release()
+        if tracing:
+            record['traced_peak_mb'] = round(traced_peak / 1024 ** 2, 2)
+            record['top_allocations'] = [{'site': str(stat.traceback), 'size_mb': round(stat.size / 1024 ** 2, 3), 'count': stat.count}
+                                         for stat in snapshot.statistics('lineno')[:TOP_ENTRIES]]
+        for records in _collectors:
+            records.append(record)
+        write_record(record)
+
+
+def bound_argument(func, name, args, kwargs):
+    """
+    Value of the argument name of a call of func, whether it was passed by position or keyword.
+    """
+    return inspect.signature(func).bind(*args, **kwargs).arguments[name]
+
+
+def instrumented(name=None, rows=None):
+    """
+    Decorator measuring every call of the function as a stage (by default named after the function).
+    rows is the name of a sized attribute of the first argument (e.g. 'pictures_df' of self), or a
+    function of (result, *args, **kwargs), see bound_argument. An error while counting the rows is
+    printed and leaves rows empty. The plate_number of the first argument, or the
+    plate_number argument, tags the line.
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tags = {}
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            plate_number = arguments.get('plate_number', getattr(args[0], 'plate_number', None) if args else None)
+            if plate_number is not None:
+                tags['plate'] = str(plate_number)
+            with stage(stage_name, **tags) as metrics:
+                result = func(*args, **kwargs)
+                # The work is done: a failure to count its rows must not fail the stage
+                try:
+                    if isinstance(rows, str):
+                        metrics.rows = len(getattr(args[0], rows))
+                    elif rows is not None:
+                        metrics.rows = rows(result, *args, **kwargs)
+                except Exception as e:
+                    print(f'Could not count the rows of stage {stage_name}: {e!r}')
+                    metrics.rows = None
+                return result
+        return wrapper
+    return decorator
+
+
+def read_metrics(path=METRICS_PATH, run=None):
+    records = []
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if run is None or record.get('run') == run:
+                records.append(record)
+    return records
+
+
+def summarize(records):
+    """
+    {stage: totals} over the records: calls, failures, wall time, rows, rows/s and peak RSS.
+    """
+    summary = {}
+    for record in records:
+        totals = summary.setdefault(record['stage'], {'calls': 0, 'failed': 0, 'wall_s': 0.0, 'rows': 0,
+                                                      'bytes_read': 0, 'bytes_written': 0, 'peak_rss_mb': 0.0})
+        totals['calls'] += 1
+        totals['failed'] += record['status'] != 'ok'
+        totals['wall_s'] += record['wall_s']
+        totals['rows'] += record.get('rows') or 0
+        totals['bytes_read'] += record.get('bytes_read') or 0
+        totals['bytes_written'] += record.get('bytes_written') or 0
+        totals['peak_rss_mb'] = max(totals['peak_rss_mb'], record['peak_rss_mb'])
+    for totals in summary.values():
+        totals['wall_s'] = round(totals['wall_s'], 3)
+        totals['rows_per_s'] = round(totals['rows'] / totals['wall_s'], 1) if totals['rows'] and totals['wall_s'] else None
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?', default=METRICS_PATH)
+    parser.add_argument('--run', help='only the lines of this run id')
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args()
+
+    summary = summarize(read_metrics(args.path, args.run))
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(f'{"stage":<28}{"calls":>7}{"failed":>8}{"wall s":>10}{"rows":>12}{"rows/s":>12}{"read MB":>10}{"written MB":>12}{"peak RSS MB":>13}')
+        for name, totals in sorted(summary.items(), key=lambda item: -item[1]['wall_s']):
+            print(f'{name:<28}{totals["calls"]:>7}{totals["failed"]:>8}{totals["wall_s"]:>10.3f}{totals["rows"]:>12}'
+                  f'{totals["rows_per_s"] or 0:>12.0f}{totals["bytes_read"] / 1e6:>10.1f}{totals["bytes_written"] / 1e6:>12.1f}{totals["peak_rss_mb"]:>13.1f}')
@@ -1,8 +1,67 @@
+import os
 import pandas as pd
 from pathlib import Path
-import sqlite3
 from params import *
-from utils import create_folder_structure, download_blob, big_query_read, big_query_write
+from utils import create_folder_structure, download_blob, big_query_read_batches, big_query_write, big_query_write_file
+from cache import processed_path, read_table, write_table, is_cached, TableWriter
+from plate_db import open_plate_db
+from picture_paths import CHANNEL_FOLDERS, picture_file_names, extract_well_and_photo, channel_paths
+from instrumentation import instrumented
+
+CELLS_QUERY = """
+        SELECT TableNumber, Cells_AreaShape_Area, Cells_AreaShape_Compactness,
+        Cells_AreaShape_Eccentricity, Cells_AreaShape_EulerNumber, Cells_AreaShape_Extent,
+        Cells_AreaShape_FormFactor, Cells_AreaShape_MaxFeretDiameter, Cells_AreaShape_MinFeretDiameter,
+        Cells_AreaShape_MeanRadius, Cells_AreaShape_MedianRadius, Cells_AreaShape_Orientation,
+        Cells_AreaShape_Perimeter, Cells_AreaShape_Solidity, Cells_AreaShape_Zernike_0_0,
+        Cells_Children_Cytoplasm_Count, Cells_Granularity_10_RNA
+        FROM Cells
+        """
+
+
+def cells_column_name(column):
+    return "".join(column.split('_'))
+
+
+def sqlite_dtype(declared_type):
+    """
+    int32 or float32 for a declared SQLite column type, following SQLite's type affinity rules.
+    None for text and blob columns, '' for columns without a declared type.
+    """
+    declared_type = (declared_type or '').upper()
+    if 'INT' in declared_type:
+        return 'int32'
+    if any(name in declared_type for name in ('CHAR', 'CLOB', 'TEXT', 'BLOB')):
+        return None
+    return 'float32' if declared_type else ''
+
+
+def cells_dtypes(conn):
+    """
+    Dtype of every column of CELLS_QUERY, from the types declared in the Cells table rather than
+    from the values of a chunk, so every chunk and the whole table get the same schema.
+    Columns declared without a type are typed from the values they hold, in one pass over the table.
+    """
+    declared = {row[1]: row[2] for row in conn.execute('PRAGMA table_info(Cells)')}
+    columns = [column[0] for column in conn.execute(f'{CELLS_QUERY} LIMIT 0').description]
+    dtypes = {column: sqlite_dtype(declared.get(column)) for column in columns}
+
+    untyped = [column for column, dtype in dtypes.items() if dtype == '']
+    if untyped:
+        checks = ', '.join(f"max(typeof({column}) = 'real'), max(typeof({column}) IN ('text', 'blob'))" for column in untyped)
+        flags = conn.execute(f'SELECT {checks} FROM Cells').fetchone()
+        for i, column in enumerate(untyped):
+            is_real, is_text = flags[2 * i], flags[2 * i + 1]
+            dtypes[column] = None if is_text else 'float32' if is_real else 'int32'
+
+    return {cells_column_name(column): dtype for column, dtype in dtypes.items() if dtype}
+
+
+def downcast_cells(cells_df, dtypes):
+    """
+    Fill missing values with 0 and change the data types to the int32 and float32 of cells_dtypes.
+    """
+    return cells_df.fillna(0).astype(dtypes)
 
 
 class Plate:
@@ -11,38 +70,42 @@ class Plate:
         self.chem_cols = ['BROAD_ID', 'CPD_NAME', 'CPD_NAME_TYPE', 'SOURCE_NAME', 'CPD_SMILES']
         self.well_cols = ['Metadata_Well', 'Metadata_ASSAY_WELL_ROLE', 'Metadata_broad_sample', 'Metadata_mmoles_per_liter']
 
+    @instrumented()
     def run(self):
         """
         Load the data from the local or remote source.
         """
         print(f'Trying to load local data for plate {self.plate_number}...')
 
-        processed_pictures_file = Path(LOCAL_DATA_PATH).joinpath(PLATE_NUMBER, 'processed', f'{PLATE_NUMBER}_pictures.csv')
-        processed_cells_file = Path(LOCAL_DATA_PATH).joinpath(PLATE_NUMBER, 'processed', f'{PLATE_NUMBER}_cells.csv')
+        processed_pictures_file = processed_path(self.plate_number, 'pictures')
+        processed_cells_file = processed_path(self.plate_number, 'cells')
 
-        if processed_pictures_file.is_file():
-            self.processed_pictures_df = pd.read_csv(processed_pictures_file)
+        if is_cached(processed_pictures_file):
+            self.processed_pictures_df = read_table(processed_pictures_file)
             print(f'✅ Loaded local Pictures Processed Data sucessfully')
         else:
             self.get_processed_data('pictures', processed_pictures_file)
 
-        if processed_cells_file.is_file():
-            self.processed_cells_df = pd.read_csv(processed_cells_file)
+        if is_cached(processed_cells_file):
+            self.processed_cells_df = read_table(processed_cells_file)
             print(f'✅ Loaded local Cells Processed Data sucessfully')
 
         else:
             self.get_processed_data('cells', processed_cells_file)
 
+    @instrumented()
     def get_processed_data(self, table_name, saving_path):
 
         print(f'Local processed file for {table_name} not found. Trying to retrieve data from Big Query...')
         try:
-            full_table_name = f"{GCP_PROJECT}.{BQ_DATASET}.{PLATE_NUMBER}_{table_name}"
-            data = big_query_read(GCP_PROJECT, full_table_name)
-            data = data.to_dataframe()
+            full_table_name = f"{GCP_PROJECT}.{BQ_DATASET}.{self.plate_number}_{table_name}"
+            # Stream the table into the local cache batch by batch instead of holding it in memory
+            with TableWriter(saving_path) as writer:
+                for batch in big_query_read_batches(GCP_PROJECT, full_table_name):
+                    writer.write(batch)
             print(f'✅ {table_name} Processed Data retrieved from Big Query successfully.')
 
-            data.to_csv(saving_path, header=True, index=False)
+            data = read_table(saving_path)
             print(f'✅ {table_name} Processed Data saved succesfully.')
 
             if table_name == 'pictures':
@@ -57,7 +120,7 @@ class Plate:
             sqlite_path = Path(LOCAL_DATA_PATH).joinpath(self.plate_number, 'raw', f'{self.plate_number}.sqlite')
             if not sqlite_path.is_file():
                 self.retrieve_sqlite()
-            conn = sqlite3.connect(sqlite_path)
+            conn = open_plate_db(sqlite_path)
 
             if table_name == 'pictures':
                 self.load_chemical_annotations()
@@ -68,12 +131,16 @@ class Plate:
                 self.save('pictures')
 
             if table_name == 'cells':
-                self.load_cells_data(conn)
-                conn.close()
-                self.clean_cells_data()
-                breakpoint()
-                self.save('cells')
-
+                if CELLS_CHUNK_SIZE:
+                    self.stream_cells_data(conn, CELLS_CHUNK_SIZE)
+                    conn.close()
+                else:
+                    self.load_cells_data(conn)
+                    conn.close()
+                    self.clean_cells_data()
+                    self.save('cells')
+
+    @instrumented(rows='chem_df')
     def load_chemical_annotations(self):
 ## Check that file chemical_compounds.csv exists locally. If not, download it.
         data_query_cache_path = Path(LOCAL_DATA_PATH).joinpath('chemical_annotations.csv')
@@ -98,6 +165,7 @@ class Plate:
                                      'SOURCE_NAME': 'SourceName',
                                      'CPD_SMILES': 'CPDSmiles'}, inplace=True)
 
+    @instrumented(rows='well_df')
     def load_well_annotations(self):
 ## Check that mean_well_profile.csv exists. If not, download it.
         data_query_cache_path = Path(LOCAL_DATA_PATH).joinpath(self.plate_number, 'raw', 'mean_well_profiles.csv')
@@ -119,6 +187,7 @@ class Plate:
                                                     'Metadata_broad_sample': 'DrugID',
                                                     'Metadata_mmoles_per_liter': 'MMoles'}, inplace=True)
 
+    @instrumented(rows='pictures_df')
     def load_pictures_data(self, conn):
 ## Create Images DF
         query = """
@@ -131,21 +200,52 @@ class Plate:
         data = cursor.fetchall()
         self.pictures_df = pd.DataFrame(data, columns=['ImageID', 'PhGolgi', 'Hoechst', 'ERSyto', 'Mito', 'ERSytoBleed', 'CellCount'])
 
+    @instrumented(rows='cells_df')
     def load_cells_data(self, conn):
 ## Create Cells DF
-        query = """
-                SELECT TableNumber, Cells_AreaShape_Area, Cells_AreaShape_Compactness,
-                Cells_AreaShape_Eccentricity, Cells_AreaShape_EulerNumber, Cells_AreaShape_Extent,
-                Cells_AreaShape_FormFactor, Cells_AreaShape_MaxFeretDiameter, Cells_AreaShape_MinFeretDiameter,
-                Cells_AreaShape_MeanRadius, Cells_AreaShape_MedianRadius, Cells_AreaShape_Orientation,
-                Cells_AreaShape_Perimeter, Cells_AreaShape_Solidity, Cells_AreaShape_Zernike_0_0,
-                Cells_Children_Cytoplasm_Count, Cells_Granularity_10_RNA
-                FROM Cells
-                """
-        cursor = conn.execute(query)
+        self.cells_dtypes = cells_dtypes(conn)
+        cursor = conn.execute(CELLS_QUERY)
         data = cursor.fetchall()
-        self.cells_df = pd.DataFrame(data, columns=["".join(i[0].split('_')) for i in cursor.description])
+        self.cells_df = pd.DataFrame(data, columns=[cells_column_name(i[0]) for i in cursor.description])
+
+    def iter_cells_data(self, conn, chunk_size):
+        """
+        Read the Cells table in chunks of chunk_size rows, yielding each chunk already cleaned.
+        Every chunk is cast to the declared column types, so all of them have the same schema.
+        """
+        dtypes = cells_dtypes(conn)
+        cursor = conn.execute(CELLS_QUERY)
+        columns = [cells_column_name(i[0]) for i in cursor.description]
+
+        while True:
+            data = cursor.fetchmany(chunk_size)
+            if not data:
+                break
+            yield downcast_cells(pd.DataFrame(data, columns=columns), dtypes)
+
+    @instrumented(rows=lambda rows, *args: rows)
+    def stream_cells_data(self, conn, chunk_size):
+        """
+        Extract, clean and save the Cells table chunk by chunk, so memory depends on chunk_size and not on the plate size.
+        The finished Parquet file is then loaded into Big Query in a single job that replaces the table,
+        so a failed run leaves nothing half appended and a rerun does not duplicate rows.
+        """
+        saving_path = processed_path(self.plate_number, 'cells')
+        full_table_name = f"{GCP_PROJECT}.{BQ_DATASET}.{self.plate_number}_cells"
 
+        print(f'Streaming Cells data in chunks of {chunk_size} rows...')
+        with TableWriter(saving_path) as writer:
+            for chunk in self.iter_cells_data(conn, chunk_size):
+                writer.write(chunk)
+                print(f'{writer.rows} rows processed...')
+        print(f'✅ cells Data saved to {saving_path}')
+
+        print('Now, storing data in Big Query...')
+        big_query_write_file(GCP_PROJECT, full_table_name, saving_path)
+        print('✅ cells Table uploaded to Big Query!')
+        return writer.rows
+
+    @instrumented()
     def retrieve_sqlite(self):
 ## Check that sqlite db exists locally. If not, download it.
         data_query_cache_path = Path(LOCAL_DATA_PATH).joinpath(self.plate_number, 'raw', f'{self.plate_number}.sqlite')
@@ -158,30 +258,25 @@ class Plate:
                         f'{self.plate_number}/raw/{self.plate_number}.sqlite',
                         data_query_cache_path)
 
+    @instrumented(rows='processed_pictures_df')
     def merge_picture_data(self):
         """
         Clean the data.
         """
-        print('Extracting well from picture file name...')
-        wells_df = self.pictures_df.drop(columns=['CellCount','ImageID']).applymap(lambda x: x.split('/')[-1].split('_')[1])
-        wells_df['Well'] = wells_df.apply(lambda row: row.unique()[0] if row.nunique()==1 else 0, axis=1)
-
-        print('Extracting photo id from picture file name...')
-        photo_number_df = self.pictures_df.drop(columns=['CellCount','ImageID']).applymap(lambda x: x.split('/')[-1].split('_')[2])
-        photo_number_df['PhotoNumber'] = photo_number_df.apply(lambda row: int(row.unique()[0][1]) if row.nunique()==1 else float('NaN'), axis=1)
+        print('Extracting well and photo id from picture file names...')
+        names_df = picture_file_names(self.pictures_df)
+        wells_photos_df = extract_well_and_photo(names_df)
 
         print('Converting photo path for training...')
-        self.pictures_df['PhGolgi'] = self.pictures_df['PhGolgi'].apply(lambda x: str(Path(LOCAL_DATA_PATH).joinpath(PLATE_NUMBER, 'Raw_pictures', f'{PLATE_NUMBER}-Ph_golgi', x.split('/')[-1])))
-        self.pictures_df['Hoechst'] = self.pictures_df['Hoechst'].apply(lambda x: str(Path(LOCAL_DATA_PATH).joinpath(PLATE_NUMBER, 'Raw_pictures', f'{PLATE_NUMBER}-Hoechst', x.split('/')[-1])))
-        self.pictures_df['ERSyto'] = self.pictures_df['ERSyto'].apply(lambda x: str(Path(LOCAL_DATA_PATH).joinpath(PLATE_NUMBER, 'Raw_pictures', f'{PLATE_NUMBER}-ERSyto', x.split('/')[-1])))
-        self.pictures_df['Mito'] = self.pictures_df['Mito'].apply(lambda x: str(Path(LOCAL_DATA_PATH).joinpath(PLATE_NUMBER, 'Raw_pictures', f'{PLATE_NUMBER}-Mito', x.split('/')[-1])))
-        self.pictures_df['ERSytoBleed'] = self.pictures_df['ERSytoBleed'].apply(lambda x: str(Path(LOCAL_DATA_PATH).joinpath(PLATE_NUMBER, 'Raw_pictures', f'{PLATE_NUMBER}-ERSytoBleed', x.split('/')[-1])))
+        raw_pictures_path = Path(LOCAL_DATA_PATH).joinpath(self.plate_number, 'Raw_pictures')
+        paths_df = channel_paths(names_df, lambda folder: str(raw_pictures_path.joinpath(f'{self.plate_number}-{folder}')) + os.sep)
+        self.pictures_df[list(CHANNEL_FOLDERS)] = paths_df
 
         print('Concatenating...')
         self.concat_df = pd.concat([
             self.pictures_df,
-            wells_df['Well'],
-            photo_number_df['PhotoNumber'].astype('int32'),
+            wells_photos_df['Well'],
+            wells_photos_df['PhotoNumber'].astype('int32'),
         ],
         axis = 1)
 
@@ -194,30 +289,26 @@ class Plate:
 
         print('✅ Data Merged')
 
+    @instrumented(rows='cells_df')
     def clean_cells_data(self):
         """
         Change the data types to int32 and float32.
         """
-        int_cols = self.cells_df.select_dtypes('int64').columns
-        float_cols = self.cells_df.select_dtypes('float64').columns
-
-        self.cells_df[int_cols] = self.cells_df[int_cols].astype('int32')
-        self.cells_df[float_cols] = self.cells_df[float_cols].astype('float32')
-
-        self.cells_df = self.cells_df.fillna(0)
+        self.cells_df = downcast_cells(self.cells_df, self.cells_dtypes)
 
+    @instrumented(rows='save_df')
     def save(self, table):
-        saving_path = Path(LOCAL_DATA_PATH).joinpath(self.plate_number, 'processed', f'{PLATE_NUMBER}_{table}.csv')
+        saving_path = processed_path(self.plate_number, table)
 
         if table == 'pictures':
             self.save_df = self.processed_pictures_df
         else:
             self.save_df = self.cells_df
 
-        self.save_df.to_csv(saving_path, index=False)
+        write_table(self.save_df, saving_path)
         print(f'✅ {table} Data saved to {saving_path}')
         print('Now, storing data in Big Query...')
-        full_table_name = f"{GCP_PROJECT}.{BQ_DATASET}.{PLATE_NUMBER}_{table}"
+        full_table_name = f"{GCP_PROJECT}.{BQ_DATASET}.{self.plate_number}_{table}"
         big_query_write(GCP_PROJECT, full_table_name, self.save_df)
         print(f'✅ {table} Table uploaded to Big Query!')
 
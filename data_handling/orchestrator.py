@@ -0,0 +1,150 @@
+"""
+Run a Plate pipeline for many plates in parallel: the small dataset of smaller_dataset.py
+('small', default) or the pictures and cells tables of main.py ('full').
+
+Every finished plate is recorded in the manifest of its pipeline (status, timings, row counts,
+output paths, and the status, time and rows of every stage of the run), so an interrupted run
+can be started again and only the missing plates are processed.
+
+    python orchestrator.py                      # all PLATES, one worker per core
+    python orchestrator.py --plates 24585 24639 --workers 2
+    python orchestrator.py --pipeline full
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+from pathlib import Path
+import pyarrow.parquet as pq
+from params import LOCAL_DATA_PATH, PLATES
+from cache import processed_path
+import main
+import smaller_dataset
+from instrumentation import collect_stages, run_id
+
+# Pipeline -> (Plate class, processed tables it writes)
+PIPELINES = {
+    'small': (smaller_dataset.Plate, ['small']),
+    'full': (main.Plate, ['pictures', 'cells']),
+}
+STAGE_FIELDS = ['stage', 'parent', 'status', 'wall_s', 'cpu_s', 'rows', 'peak_rss_mb', 'error']
+
+
+def pipeline_manifest_path(pipeline):
+    return Path(LOCAL_DATA_PATH).joinpath('manifest.json' if pipeline == 'small' else f'manifest_{pipeline}.json')
+
+
+MANIFEST_PATH = pipeline_manifest_path('small')
+
+
+def load_manifest(manifest_path=MANIFEST_PATH):
+    manifest_path = Path(manifest_path)
+    if manifest_path.is_file():
+        with open(manifest_path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(manifest, manifest_path=MANIFEST_PATH):
+    """
+    Write the manifest to a temp file first, so an interruption never leaves a truncated manifest.
+    """
+    manifest_path = Path(manifest_path)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = manifest_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def is_done(record):
+    """
+    A plate is done when its last run succeeded and its outputs are still on disk.
+    """
+    return (record is not None
+            and record.get('status') == 'done'
+            and all(Path(path).is_file() for path in record.get('outputs', [])))
+
+
+def process_plate(plate_number, pipeline='small'):
+    """
+    Run the pipeline for one plate. Executed in a worker process; never raises, failures are recorded.
+    """
+    plate_class, tables = PIPELINES[pipeline]
+    record = {'plate': plate_number, 'pipeline': pipeline, 'pid': os.getpid(), 'run': run_id(),
+              'started': datetime.now(timezone.utc).isoformat()}
+    start = time.perf_counter()
+
+    with collect_stages() as stages:
+        try:
+            plate_class(plate_number).run()
+            outputs = [processed_path(plate_number, table) for table in tables]
+            record.update(status='done',
+                          rows={table: pq.read_metadata(path).num_rows for table, path in zip(tables, outputs)},
+                          outputs=[str(path) for path in outputs])
+        except Exception as e:
+            record.update(status='failed', error=repr(e))
+
+    record['finished'] = datetime.now(timezone.utc).isoformat()
+    record['duration_s'] = round(time.perf_counter() - start, 3)
+    record['stages'] = [{field: stage[field] for field in STAGE_FIELDS if stage.get(field) is not None} for stage in stages]
+    return record
+
+
+def run_plates(plates, workers=None, manifest_path=None, force=False, pipeline='small'):
+    """
+    Process the plates across a pool of workers (one per core by default), skipping plates
+    the manifest of the pipeline marks as done unless force is set. Returns the manifest.
+    """
+    if pipeline not in PIPELINES:
+        raise ValueError(f'Unknown pipeline {pipeline!r}, use one of {list(PIPELINES)}')
+    manifest_path = manifest_path or pipeline_manifest_path(pipeline)
+    manifest = load_manifest(manifest_path)
+    plates = [str(plate) for plate in plates]
+    todo = [plate for plate in plates if force or not is_done(manifest.get(plate))]
+
+    print(f'{len(plates) - len(todo)} plates already processed, {len(todo)} to go.')
+    if not todo:
+        return manifest
+
+    workers = min(workers or os.cpu_count(), len(todo))
+    # The stage metrics of every worker are written under the run id of this process
+    os.environ.setdefault('METRICS_RUN_ID', run_id())
+    print(f'Processing {len(todo)} plates with {workers} workers...')
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_plate, plate, pipeline): plate for plate in todo}
+        for future in as_completed(futures):
+            plate = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                # The worker process itself died (e.g. out of memory)
+                record = {'plate': plate, 'status': 'failed', 'error': repr(e)}
+
+            manifest[plate] = record
+            save_manifest(manifest, manifest_path)
+
+            if record['status'] == 'done':
+                rows = ', '.join(f'{n} {table}' for table, n in record['rows'].items())
+                print(f"✅ Plate {plate} processed in {record['duration_s']}s ({rows} rows)")
+            else:
+                print(f"❌ Plate {plate} failed: {record['error']}")
+
+    failed = [plate for plate in todo if manifest[plate]['status'] != 'done']
+    print(f'Done. {len(todo) - len(failed)} plates processed, {len(failed)} failed.')
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--plates', nargs='+', default=PLATES, help='Plate numbers, all BBBC047 plates by default')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes, one per core by default')
+    parser.add_argument('--pipeline', choices=list(PIPELINES), default='small', help='small dataset or full pictures and cells tables')
+    parser.add_argument('--manifest', default=None, help='Path of the manifest JSON, by default one per pipeline in LOCAL_DATA_PATH')
+    parser.add_argument('--force', action='store_true', help='Process plates again even if the manifest marks them done')
+    args = parser.parse_args()
+
+    run_plates(args.plates, workers=args.workers, manifest_path=args.manifest, force=args.force, pipeline=args.pipeline)
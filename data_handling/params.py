@@ -1,4 +1,5 @@
 import os
+import json
 
 MODEL_TARGET = os.environ.get('MODEL_TARGET')
 GCP_PROJECT = os.environ.get('GCP_PROJECT')
@@ -9,4 +10,24 @@ BQ_REGION = os.environ.get('BQ_REGION')
 BQ_DATASET = os.environ.get('BQ_DATASET')
 PLATE_NUMBER = os.environ.get('PLATE_NUMBER')
 
-LOCAL_DATA_PATH = os.path.join(os.path.expanduser('~'), ".morpho_minds_data")
+# BBBC047 plates
+PLATES = [
+    24302, 24585, 24639, 24774, 25576, 25689, 25935, 26166, 26545, 26672,
+    24277, 24564, 24644, 24750, 25572, 25911, 26203, 26794, 24792, 26576
+]
+
+LOCAL_DATA_PATH = os.environ.get('LOCAL_DATA_PATH', os.path.join(os.path.expanduser('~'), ".morpho_minds_data"))
+
+# Number of Cells rows fetched from SQLite at a time. Set to 0 to load the whole table at once.
+CELLS_CHUNK_SIZE = int(os.environ.get('CELLS_CHUNK_SIZE', 100_000))
+
+# Processed tables are cached as Parquet. Set EXPORT_CSV=1 to also write a CSV copy.
+EXPORT_CSV = os.environ.get('EXPORT_CSV', '0') == '1'
+
+# 'gcp' uses Cloud Storage and Big Query, 'local' a local folder as bucket and a DuckDB file as warehouse
+DATA_BACKEND = os.environ.get('DATA_BACKEND', 'gcp')
+LOCAL_BUCKET_PATH = os.environ.get('LOCAL_BUCKET_PATH', os.path.join(LOCAL_DATA_PATH, 'bucket'))
+LOCAL_WAREHOUSE_PATH = os.environ.get('LOCAL_WAREHOUSE_PATH', os.path.join(LOCAL_DATA_PATH, 'warehouse.duckdb'))
+
+# Cells statistics computed per image in SQLite for the small dataset, e.g. '{"Cells_AreaShape_Area": ["mean", "median", "q90"]}'
+CELL_AGGREGATES = json.loads(os.environ.get('CELL_AGGREGATES', '{"Cells_AreaShape_Area": ["mean"]}'))
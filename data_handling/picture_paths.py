@@ -0,0 +1,46 @@
+import pandas as pd
+
+# Column of the pictures DF -> folder suffix of the channel in the raw pictures tree
+CHANNEL_FOLDERS = {
+    'PhGolgi': 'Ph_golgi',
+    'Hoechst': 'Hoechst',
+    'ERSyto': 'ERSyto',
+    'Mito': 'Mito',
+    'ERSytoBleed': 'ERSytoBleed',
+}
+
+# cdp2w9x2-au00026617_a01_s1_w2a7ff0700-....tif -> Well 'a01', site 's1'
+FILE_NAME_PATTERN = r'^[^_]*_(?P<Well>[^_]*)_(?P<Site>[^_]*)'
+
+
+def picture_file_names(pictures_df):
+    """
+    Strip the folders of the five channel URLs, keeping only the file names.
+    """
+    return pd.DataFrame({channel: pictures_df[channel].str.rsplit('/', n=1).str[-1]
+                         for channel in CHANNEL_FOLDERS})
+
+
+def extract_well_and_photo(names_df):
+    """
+    Parse Well and PhotoNumber from the file names of the five channels.
+    Well is 0 and PhotoNumber is NaN when the channels of a row disagree.
+    """
+    parts = {channel: names_df[channel].str.extract(FILE_NAME_PATTERN) for channel in CHANNEL_FOLDERS}
+    first = parts[next(iter(CHANNEL_FOLDERS))]
+
+    same_well = pd.concat([part['Well'].eq(first['Well']) for part in parts.values()], axis=1).all(axis=1)
+    same_site = pd.concat([part['Site'].eq(first['Site']) for part in parts.values()], axis=1).all(axis=1)
+
+    return pd.DataFrame({
+        'Well': first['Well'].where(same_well, 0),
+        'PhotoNumber': pd.to_numeric(first['Site'].str[1]).where(same_site),
+    })
+
+
+def channel_paths(names_df, folder_prefix):
+    """
+    Rebuild the path of every channel picture as folder_prefix(folder) + file name.
+    """
+    return pd.DataFrame({channel: folder_prefix(folder) + names_df[channel]
+                         for channel, folder in CHANNEL_FOLDERS.items()})
@@ -0,0 +1,82 @@
+"""
+Read path of the per-plate SQLite DBs.
+
+prepare_plate_db is run once per DB file: it adds the indexes the extraction queries need and
+stores the per-image aggregates, so later extractions read a few thousand precomputed rows
+instead of scanning every cell. connect_read_only then opens the DB for fast, safe reads.
+"""
+import sqlite3
+from pathlib import Path
+from aggregate import aggregate_query, aggregate_table_name, has_table, register_aggregates
+from instrumentation import instrumented
+
+INDEXES = {
+    'idx_cells_tablenumber': ('Cells', 'TableNumber'),
+    'idx_cells_imagenumber': ('Cells', 'ImageNumber'),
+    'idx_image_tablenumber': ('Image', 'TableNumber'),
+    'idx_image_imagenumber': ('Image', 'ImageNumber'),
+}
+
+MMAP_SIZE = 1024 ** 3        # map up to 1 GB of the DB file in memory
+CACHE_SIZE_KB = 256 * 1024   # 256 MB page cache
+
+
+@instrumented()
+def prepare_plate_db(sqlite_path, features_list=(), by='image'):
+    """
+    Add the missing indexes and precompute the aggregates of every spec in features_list.
+    Safe to call on every run: it does nothing when the DB is already prepared.
+    Returns True if the DB was changed.
+    """
+    conn = sqlite3.connect(sqlite_path)
+    changed = False
+    try:
+        for index_name, (table, column) in INDEXES.items():
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (index_name,)).fetchone()
+            if column in columns and not exists:
+                print(f'Creating index on {table}.{column}...')
+                conn.execute(f'CREATE INDEX {index_name} ON {table}({column})')
+                changed = True
+
+        register_aggregates(conn)
+        for features in features_list:
+            table_name = aggregate_table_name(features, by)
+            if not has_table(conn, table_name):
+                print(f'Precomputing {by} aggregates into {table_name}...')
+                conn.execute(f'CREATE TABLE {table_name} AS {aggregate_query(features, by)}')
+                changed = True
+
+        if changed:
+            conn.execute('ANALYZE')
+        conn.commit()
+    finally:
+        conn.close()
+
+    return changed
+
+
+def connect_read_only(sqlite_path):
+    """
+    Read-only connection tuned for large scans: the file is memory mapped and the page cache enlarged.
+    mode=ro (rather than immutable) keeps reads consistent if the DB is in WAL mode.
+    """
+    uri = f'{Path(sqlite_path).resolve().as_uri()}?mode=ro'
+    conn = sqlite3.connect(uri, uri=True)
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KB}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+def open_plate_db(sqlite_path, features_list=()):
+    """
+    Prepare the DB if needed and return a read-only connection to it.
+    A DB that cannot be written (e.g. read-only mount) is used unprepared.
+    """
+    try:
+        prepare_plate_db(sqlite_path, features_list)
+    except sqlite3.OperationalError as e:
+        print(f'Could not prepare {sqlite_path} ({e}), reading it as is.')
+    return connect_read_only(sqlite_path)
@@ -1,8 +1,12 @@
 import pandas as pd
 from pathlib import Path
-import sqlite3
 from params import *
-from utils import create_folder_structure, download_blob, big_query_read, big_query_write
+from utils import create_folder_structure, download_blob, big_query_read_batches, big_query_write
+from cache import processed_path, read_table, write_table, is_cached, TableWriter
+from aggregate import aggregate_cells
+from plate_db import open_plate_db
+from picture_paths import CHANNEL_FOLDERS, picture_file_names, extract_well_and_photo, channel_paths
+from instrumentation import instrumented
 
 
 class Plate:
@@ -11,31 +15,35 @@ class Plate:
         self.chem_cols = ['BROAD_ID', 'CPD_NAME', 'CPD_NAME_TYPE', 'SOURCE_NAME', 'CPD_SMILES']
         self.well_cols = ['Metadata_Well', 'Metadata_ASSAY_WELL_ROLE', 'Metadata_mmoles_per_liter']
 
+    @instrumented()
     def run(self):
         """
         Load the data from the local or remote source.
         """
         print(f'Trying to load local data for plate {self.plate_number}...')
 
-        processed_small_file = Path(LOCAL_DATA_PATH).joinpath(self.plate_number, 'processed', f'{self.plate_number}_small.csv')
+        processed_small_file = processed_path(self.plate_number, 'small')
 
-        if processed_small_file.is_file():
-            self.processed_pictures_df = pd.read_csv(processed_small_file)
+        if is_cached(processed_small_file):
+            self.processed_pictures_df = read_table(processed_small_file)
             print(f'✅ Loaded local Pictures Processed Data sucessfully')
         else:
             self.get_processed_data(processed_small_file)
 
 
+    @instrumented()
     def get_processed_data(self, saving_path):
 
         print(f'Local processed file not found. Trying to retrieve data from Big Query...')
         try:
             full_table_name = f"{GCP_PROJECT}.{BQ_DATASET}.{self.plate_number}_small"
-            data = big_query_read(GCP_PROJECT, full_table_name)
-            data = data.to_dataframe()
+            # Stream the table into the local cache batch by batch instead of holding it in memory
+            with TableWriter(saving_path) as writer:
+                for batch in big_query_read_batches(GCP_PROJECT, full_table_name):
+                    writer.write(batch)
             print(f'✅ Processed Data retrieved from Big Query successfully.')
 
-            data.to_csv(saving_path, header=True, index=False)
+            data = read_table(saving_path)
             print(f'✅ Processed Data saved succesfully.')
 
             self.processed_pictures_df = data
@@ -47,7 +55,7 @@ class Plate:
             sqlite_path = Path(LOCAL_DATA_PATH).joinpath(self.plate_number, 'raw', f'{self.plate_number}.sqlite')
             if not sqlite_path.is_file():
                 self.retrieve_sqlite()
-            conn = sqlite3.connect(sqlite_path)
+            conn = open_plate_db(sqlite_path, [CELL_AGGREGATES])
 
             self.load_well_annotations()
             self.load_pictures_data(conn)
@@ -55,7 +63,9 @@ class Plate:
             self.merge_picture_data()
             conn.close()
             self.save()
+            self.processed_pictures_df = self.processed_df
 
+    @instrumented(rows='well_df')
     def load_well_annotations(self):
 ## Check that mean_well_profile.csv exists. If not, download it.
         data_query_cache_path = Path(LOCAL_DATA_PATH).joinpath(self.plate_number, 'raw', 'mean_well_profiles.csv')
@@ -77,6 +87,7 @@ class Plate:
                                                     'Metadata_mmoles_per_liter': 'MMoles'}, inplace=True)
         self.well_df['Plate'] = self.plate_number
 
+    @instrumented(rows='pictures_df')
     def load_pictures_data(self, conn):
 ## Create Images DF
         query = """
@@ -89,17 +100,13 @@ class Plate:
         data = cursor.fetchall()
         self.pictures_df = pd.DataFrame(data, columns=['ImageID', 'PhGolgi', 'Hoechst', 'ERSyto', 'Mito', 'ERSytoBleed', 'CellCount'])
 
+    @instrumented(rows='cells_df')
     def load_cells_data(self, conn):
-## Create Cells DF
-        query = """
-                SELECT TableNumber as ImageID, AVG(Cells_AreaShape_Area) as MeanArea
-                FROM Cells
-                GROUP BY TableNumber
-                """
-        cursor = conn.execute(query)
-        data = cursor.fetchall()
-        self.cells_df = pd.DataFrame(data, columns=["".join(i[0].split('_')) for i in cursor.description])
+## Create Cells DF with the per image statistics declared in CELL_AGGREGATES
+        self.cells_df = aggregate_cells(conn, CELL_AGGREGATES, by='image')
+        self.cells_df.rename(columns={'MeanCellsAreaShapeArea': 'MeanArea'}, inplace=True)
 
+    @instrumented()
     def retrieve_sqlite(self):
 ## Check that sqlite db exists locally. If not, download it.
         data_query_cache_path = Path(LOCAL_DATA_PATH).joinpath(self.plate_number, 'raw', f'{self.plate_number}.sqlite')
@@ -112,47 +119,42 @@ class Plate:
                         f'{self.plate_number}/raw/{self.plate_number}.sqlite',
                         data_query_cache_path)
 
+    @instrumented(rows='processed_df')
     def merge_picture_data(self):
         """
         Clean the data.
         """
-        print('Extracting well from picture file name...')
-        wells_df = self.pictures_df.drop(columns=['CellCount','ImageID']).applymap(lambda x: x.split('/')[-1].split('_')[1])
-        wells_df['Well'] = wells_df.apply(lambda row: row.unique()[0] if row.nunique()==1 else 0, axis=1)
+        print('Extracting well and photo id from picture file names...')
+        names_df = picture_file_names(self.pictures_df)
+        wells_photos_df = extract_well_and_photo(names_df)
 
-        print('Extracting photo id from picture file name...')
-        photo_number_df = self.pictures_df.drop(columns=['CellCount','ImageID']).applymap(lambda x: x.split('/')[-1].split('_')[2])
-        photo_number_df['PhotoNumber'] = photo_number_df.apply(lambda row: int(row.unique()[0][1]) if row.nunique()==1 else float('NaN'), axis=1)
         print('Converting photo path for training...')
-
         root_path = f'https://storage.cloud.google.com/{BUCKET_NAME}/{self.plate_number}/raw/pictures/'
-        self.pictures_df['PhGolgi'] = self.pictures_df['PhGolgi'].apply(lambda x: (f'{root_path}{self.plate_number}-Ph_golgi/{x.split("/")[-1]}'))
-        self.pictures_df['Hoechst'] = self.pictures_df['Hoechst'].apply(lambda x: (f'{root_path}{self.plate_number}-Hoechst/{x.split("/")[-1]}'))
-        self.pictures_df['ERSyto'] = self.pictures_df['ERSyto'].apply(lambda x: (f'{root_path}{self.plate_number}-ERSyto/{x.split("/")[-1]}'))
-        self.pictures_df['Mito'] = self.pictures_df['Mito'].apply(lambda x: (f'{root_path}{self.plate_number}-Mito/{x.split("/")[-1]}'))
-        self.pictures_df['ERSytoBleed'] = self.pictures_df['ERSytoBleed'].apply(lambda x: (f'{root_path}{self.plate_number}-ERSytoBleed/{x.split("/")[-1]}'))
+        paths_df = channel_paths(names_df, lambda folder: f'{root_path}{self.plate_number}-{folder}/')
+        self.pictures_df[list(CHANNEL_FOLDERS)] = paths_df
 
         print('Concatenating...')
         self.concat_df = pd.concat([
             self.pictures_df,
-            wells_df['Well'],
-            photo_number_df['PhotoNumber'].astype('int32')
+            wells_photos_df['Well'],
+            wells_photos_df['PhotoNumber'].astype('int32')
         ],
         axis = 1)
 
         self.concat_df[['CellCount']] = self.concat_df[['CellCount']].astype('int32')
         self.well_df[['MMoles']] = self.well_df[['MMoles']].astype('float32')
 
-        self.processed_df = self.concat_df.merge(self.well_df).fillna('None').merge(self.cells_df, on='ImageID').drop(columns=['ImageID'])
+        self.processed_df = self.concat_df.merge(self.well_df).fillna('None').merge(self.cells_df, on='ImageID')
 
         print('✅ Data Merged')
 
+    @instrumented(rows='save_df')
     def save(self):
-        saving_path = Path(LOCAL_DATA_PATH).joinpath(self.plate_number, 'processed', f'{self.plate_number}_small.csv')
+        saving_path = processed_path(self.plate_number, 'small')
 
         self.save_df = self.processed_df
 
-        self.save_df.to_csv(saving_path, index=False)
+        write_table(self.save_df, saving_path)
         print(f'✅ Data saved to {saving_path}')
         # print('Now, storing data in Big Query...')
         # full_table_name = f"{GCP_PROJECT}.{BQ_DATASET}.{self.plate_number}_small"
@@ -170,11 +172,3 @@ if __name__ == '__main__':
 
     plate = Plate('24277')
     plate.run()
-
-#     PLATES = [
-#     24302, 24585, 24639, 24774, 25576, 25689, 25935, 26166, 26545, 26672,
-#     24277, 24564, 24644, 24750, 25572, 25911, 26203, 26794, 24792, 26576
-# ]
-#     for plate in PLATES:
-#         plate = Plate(f'{plate}')
-#         plate.run()
@@ -0,0 +1,171 @@
+"""
+Well mosaics: the fields of view of a well stitched into one picture, for every well and channel of a plate.
+
+The fields (sites s1..s6 of the file names) are placed on a 3 x 2 grid as in image_stitching.ipynb.
+All the wells of a channel are written to one memory-mapped uint16 .npy file of shape
+(n_wells, 3 * field height, 2 * field width). Next to it are downsampled pyramid levels, each
+halving the resolution, and the index of its wells, as channels may not have the same wells.
+The wells are stitched in parallel, and reading one well at any level only reads the pages of that well:
+
+    build_well_mosaics('24585')
+    mosaics = WellMosaics('24585', 'Hoechst')
+    preview = mosaics.well('a01', level=2)      # quarter resolution view
+"""
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from PIL import Image
+from params import LOCAL_DATA_PATH
+from cache import read_table, write_table
+from picture_paths import CHANNEL_FOLDERS, FILE_NAME_PATTERN
+
+GRID_SHAPE = (3, 2)
+LEVELS = 3
+PICTURE_SUFFIXES = ('.tif', '.tiff', '.png')
+
+
+def well_fields(plate_number, channel):
+    """
+    {well: {site number: path}} of the raw pictures of a channel.
+    """
+    folder = Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'raw', 'pictures', f'{plate_number}-{CHANNEL_FOLDERS[channel]}')
+    pattern = re.compile(FILE_NAME_PATTERN)
+    wells = {}
+    for name in sorted(os.listdir(folder)):
+        match = pattern.match(name)
+        if not name.lower().endswith(PICTURE_SUFFIXES) or match is None:
+            continue
+        site = int(match.group('Site').lstrip('s'))
+        wells.setdefault(match.group('Well'), {})[site] = folder.joinpath(name)
+    return wells
+
+
+def downsample(mosaic):
+    """
+    Half resolution, each pixel the mean of a 2 x 2 block.
+    """
+    height, width = mosaic.shape[0] // 2 * 2, mosaic.shape[1] // 2 * 2
+    blocks = mosaic[:height, :width].reshape(height // 2, 2, width // 2, 2).astype(np.uint32)
+    return (blocks.sum(axis=(1, 3)) // 4).astype(np.uint16)
+
+
+def level_shapes(field_shape, grid_shape=GRID_SHAPE, levels=LEVELS):
+    shape = (field_shape[0] * grid_shape[0], field_shape[1] * grid_shape[1])
+    shapes = [shape]
+    for _ in range(1, levels):
+        shape = (shape[0] // 2, shape[1] // 2)
+        shapes.append(shape)
+    return shapes
+
+
+def mosaic_paths(plate_number, channel, levels=LEVELS):
+    """
+    Paths of the levels of a channel and of the index of its wells (one row per mosaic).
+    """
+    folder = Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'processed', 'wells')
+    return [folder.joinpath(f'{channel}_level{level}.npy') for level in range(levels)], folder.joinpath(f'{channel}_wells.parquet')
+
+
+def stitch_well(fields, field_shape, grid_shape=GRID_SHAPE):
+    """
+    Mosaic of one well from its {site number: path}, sites numbered from 1 row by row. Missing sites stay black.
+    """
+    height, width = field_shape
+    mosaic = np.zeros((height * grid_shape[0], width * grid_shape[1]), dtype=np.uint16)
+    for site, path in fields.items():
+        row, col = divmod(site - 1, grid_shape[1])
+        if row >= grid_shape[0]:
+            raise ValueError(f'Site {site} of {path} does not fit a {grid_shape} grid')
+        with Image.open(path) as img:
+            field = np.asarray(img)
+        if field.shape != field_shape:
+            raise ValueError(f'{path} is {field.shape}, expected {field_shape}')
+        mosaic[row * height:(row + 1) * height, col * width:(col + 1) * width] = field
+    return mosaic
+
+
+def build_well_mosaics(plate_number, channels=tuple(CHANNEL_FOLDERS), grid_shape=GRID_SHAPE, levels=LEVELS, workers=8, overwrite=False):
+    """
+    Stitch every well of every channel of the plate into memory-mapped mosaics and their pyramid levels.
+    (channel, well) pairs are stitched in parallel, each written straight into its slot of the files.
+    Every channel has its own index of wells, so building a channel never changes the others.
+    """
+    folder = mosaic_paths(plate_number, channels[0], levels)[0][0].parent
+    folder.mkdir(parents=True, exist_ok=True)
+
+    fields = {}
+    outputs = {}
+    for channel in channels:
+        level_paths, index_path = mosaic_paths(plate_number, channel, levels)
+        if all(path.is_file() for path in level_paths) and index_path.is_file() and not overwrite:
+            print(f'Mosaics of {channel} already built.')
+            continue
+        fields[channel] = well_fields(plate_number, channel)
+        if not fields[channel]:
+            raise FileNotFoundError(f'No pictures of {channel} for plate {plate_number}, nothing to stitch')
+        first_well = next(iter(fields[channel].values()))
+        with Image.open(next(iter(first_well.values()))) as img:
+            field_shape = (img.height, img.width)
+        shapes = level_shapes(field_shape, grid_shape, levels)
+        outputs[channel] = (field_shape, [np.lib.format.open_memmap(path.with_suffix('.npy.tmp'), mode='w+', dtype=np.uint16, shape=(len(fields[channel]),) + shape)
+                                          for path, shape in zip(level_paths, shapes)])
+
+    if not outputs:
+        return folder
+
+    def stitch(job):
+        channel, i, well = job
+        field_shape, arrays = outputs[channel]
+        mosaic = stitch_well(fields[channel][well], field_shape, grid_shape)
+        for level, array in enumerate(arrays):
+            if level:
+                mosaic = downsample(mosaic)
+            array[i] = mosaic
+
+    wells = {channel: sorted(fields[channel]) for channel in outputs}
+    jobs = [(channel, i, well) for channel in outputs for i, well in enumerate(wells[channel])]
+    print(f'Stitching {len(jobs)} wells of {len(outputs)} channels of plate {plate_number}...')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() re-raises the first stitching error
+        list(executor.map(stitch, jobs))
+
+    for channel, (_, arrays) in outputs.items():
+        level_paths, index_path = mosaic_paths(plate_number, channel, levels)
+        for path, array in zip(level_paths, arrays):
+            array.flush()
+            os.replace(array.filename, path)
+        write_table(pd.DataFrame({'Well': wells[channel]}), index_path)
+    del outputs
+
+    print(f'✅ Well mosaics saved to {folder}')
+    return folder
+
+
+class WellMosaics:
+    """
+    Read-only access to the mosaics of one channel of a plate. Levels are opened on first use.
+    """
+    def __init__(self, plate_number, channel):
+        self.plate_number = plate_number
+        self.channel = channel
+        _, index_path = mosaic_paths(plate_number, channel)
+        self.wells = read_table(index_path)['Well'].tolist()
+        self.positions = {well: i for i, well in enumerate(self.wells)}
+        self.levels = {}
+
+    def level(self, level=0):
+        if level not in self.levels:
+            paths, _ = mosaic_paths(self.plate_number, self.channel, level + 1)
+            self.levels[level] = np.load(paths[level], mmap_mode='r')
+        return self.levels[level]
+
+    def well(self, well, level=0):
+        """
+        Zero copy view of the mosaic of a well.
+        """
+        if well not in self.positions:
+            raise KeyError(f'No well {well} in plate {self.plate_number}')
+        return self.level(level)[self.positions[well]]
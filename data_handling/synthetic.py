@@ -0,0 +1,177 @@
+"""
+Synthetic plates of any size, laid out like a downloaded BBBC047 plate, for benchmarks and offline runs.
+
+make_synthetic_plate writes under LOCAL_DATA_PATH/<plate>/raw:
+
+    <plate>.sqlite            Image and Cells tables with the columns of the real DBs
+    mean_well_profiles.csv    well annotations (role, compound, concentration)
+    pictures/<plate>-<folder>/ one small dummy TIFF per field of view and channel
+
+and LOCAL_DATA_PATH/chemical_annotations.csv, so Plate / SmallerPlate run on it without any download:
+
+    LOCAL_DATA_PATH=/tmp/plates python synthetic.py --plate 90000 --images 2000 --cells 100
+"""
+import argparse
+import io
+import sqlite3
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from PIL import Image
+from params import LOCAL_DATA_PATH
+from utils import create_folder_structure
+from picture_paths import CHANNEL_FOLDERS
+
+# Channel of the pictures DF -> suffix of its Image_URL_Orig* column
+URL_CHANNELS = {'PhGolgi': 'AGP', 'Hoechst': 'DNA', 'ERSyto': 'ER', 'Mito': 'Mito', 'ERSytoBleed': 'RNA'}
+
+CELL_FEATURES = [
+    'Cells_AreaShape_Area', 'Cells_AreaShape_Compactness', 'Cells_AreaShape_Eccentricity',
+    'Cells_AreaShape_EulerNumber', 'Cells_AreaShape_Extent', 'Cells_AreaShape_FormFactor',
+    'Cells_AreaShape_MaxFeretDiameter', 'Cells_AreaShape_MinFeretDiameter', 'Cells_AreaShape_MeanRadius',
+    'Cells_AreaShape_MedianRadius', 'Cells_AreaShape_Orientation', 'Cells_AreaShape_Perimeter',
+    'Cells_AreaShape_Solidity', 'Cells_AreaShape_Zernike_0_0', 'Cells_Children_Cytoplasm_Count',
+    'Cells_Granularity_10_RNA',
+]
+INTEGER_FEATURES = {'Cells_AreaShape_Area', 'Cells_AreaShape_EulerNumber', 'Cells_Children_Cytoplasm_Count'}
+
+WELLS = [f'{row}{col:02d}' for row in 'abcdefghijklmnop' for col in range(1, 25)]
+SITES = 6
+PICTURE_SIZE = (64, 48)
+INSERT_CHUNK_SIZE = 100_000
+
+
+def picture_file_name(plate_number, well, site, channel, i):
+    return f'cdp2w9x2-au000{plate_number}_{well}_s{site}_w{URL_CHANNELS[channel]}{i:08x}.tif'
+
+
+def synthetic_pictures_df(n_images, plate_number='00000', sites=SITES):
+    """
+    Pictures DF shaped like the result of Plate.load_pictures_data: one row per field of view, one URL per channel.
+    """
+    rng = np.random.default_rng(0)
+    data = {'ImageID': np.arange(n_images), 'CellCount': rng.integers(0, 500, n_images)}
+    for channel in CHANNEL_FOLDERS:
+        data[channel] = [f'/home/ubuntu/bucket/images/{plate_number}/'
+                         + picture_file_name(plate_number, WELLS[(i // sites) % len(WELLS)], i % sites + 1, channel, i)
+                         for i in range(n_images)]
+    return pd.DataFrame(data)
+
+
+def write_image_table(conn, pictures_df, plate_number):
+    columns = ['TableNumber', 'ImageNumber', 'Image_Metadata_Well'] + [f'Image_URL_Orig{URL_CHANNELS[channel]}' for channel in CHANNEL_FOLDERS] + ['Image_Count_Cells']
+    conn.execute(f'CREATE TABLE Image ({", ".join(columns)})')
+    wells = pictures_df['Hoechst'].str.rsplit('/', n=1).str[-1].str.split('_').str[1]
+    rows = zip(pictures_df['ImageID'].tolist(), pictures_df['ImageID'].tolist(), wells.tolist(),
+               *[pictures_df[channel].tolist() for channel in CHANNEL_FOLDERS], pictures_df['CellCount'].tolist())
+    conn.executemany(f'INSERT INTO Image VALUES ({", ".join("?" * len(columns))})', rows)
+
+
+def write_cells_table(conn, cell_counts, seed=0, declared_types=True):
+    """
+    One row per cell, cell_counts[i] cells for image i, inserted INSERT_CHUNK_SIZE rows at a time.
+    Columns are declared INTEGER or FLOAT like in the real DBs, or without a type if declared_types is False.
+    """
+    columns = ['TableNumber', 'ImageNumber', 'ObjectNumber'] + CELL_FEATURES
+    integer_columns = {'TableNumber', 'ImageNumber', 'ObjectNumber'} | INTEGER_FEATURES
+    definitions = [f'{col} {"INTEGER" if col in integer_columns else "FLOAT"}' if declared_types else col for col in columns]
+    conn.execute(f'CREATE TABLE Cells ({", ".join(definitions)})')
+    rng = np.random.default_rng(seed)
+    image_numbers = np.repeat(np.arange(len(cell_counts)), cell_counts)
+    object_numbers = np.arange(len(image_numbers)) - np.repeat(np.cumsum(cell_counts) - cell_counts, cell_counts) + 1
+
+    for start in range(0, len(image_numbers), INSERT_CHUNK_SIZE):
+        images = image_numbers[start:start + INSERT_CHUNK_SIZE]
+        n = len(images)
+        values = [images.tolist(), images.tolist(), object_numbers[start:start + n].tolist()]
+        for feature in CELL_FEATURES:
+            if feature in INTEGER_FEATURES:
+                values.append(rng.integers(0, 2000, n).tolist())
+            else:
+                feature_values = rng.random(n)
+                # The real tables have a few missing values, clean_cells_data fills them
+                feature_values[rng.random(n) < 0.001] = np.nan
+                values.append([None if np.isnan(value) else value for value in feature_values.tolist()])
+        conn.executemany(f'INSERT INTO Cells VALUES ({", ".join("?" * len(columns))})', zip(*values))
+
+
+def well_profiles_df(wells, seed=0):
+    rng = np.random.default_rng(seed)
+    roles = np.where(rng.random(len(wells)) < 0.1, 'mock', 'treated')
+    drugs = np.where(roles == 'mock', 'DMSO', [f'BRD-K{i:08d}' for i in rng.integers(0, 300, len(wells))])
+    return pd.DataFrame({'Metadata_Well': wells,
+                         'Metadata_ASSAY_WELL_ROLE': roles,
+                         'Metadata_broad_sample': drugs,
+                         'Metadata_mmoles_per_liter': np.where(roles == 'mock', 0.0, rng.choice([0.5, 1.0, 5.0, 10.0], len(wells)))})
+
+
+def chemical_annotations_df(drugs):
+    drugs = sorted(drug for drug in set(drugs) if drug != 'DMSO')
+    return pd.DataFrame({'BROAD_ID': drugs,
+                         'CPD_NAME': [f'compound-{i}' for i in range(len(drugs))],
+                         'CPD_NAME_TYPE': 'BROAD_CPD_ID',
+                         'SOURCE_NAME': 'Synthetic',
+                         'CPD_SMILES': 'CCO'})
+
+
+def write_pictures(pictures_df, plate_number, size=PICTURE_SIZE, seed=0):
+    """
+    One dummy 16 bit TIFF per picture. Every channel gets its own random image, written as-is for every field.
+    """
+    rng = np.random.default_rng(seed)
+    for channel, folder in CHANNEL_FOLDERS.items():
+        buffer = io.BytesIO()
+        Image.fromarray(rng.integers(0, 4096, (size[1], size[0]), dtype=np.uint16)).save(buffer, format='TIFF')
+        body = buffer.getvalue()
+
+        channel_folder = Path(LOCAL_DATA_PATH).joinpath(plate_number, 'raw', 'pictures', f'{plate_number}-{folder}')
+        channel_folder.mkdir(parents=True, exist_ok=True)
+        for name in pictures_df[channel].str.rsplit('/', n=1).str[-1]:
+            channel_folder.joinpath(name).write_bytes(body)
+
+
+def make_synthetic_plate(plate_number, n_images, cells_per_image=100, sites=SITES, pictures=True, picture_size=PICTURE_SIZE, seed=0):
+    """
+    Write a synthetic plate of n_images fields of view and about cells_per_image cells each. Existing files are replaced.
+    Returns the path of the SQLite DB.
+    """
+    plate_number = str(plate_number)
+    create_folder_structure(plate_number)
+    raw_path = Path(LOCAL_DATA_PATH).joinpath(plate_number, 'raw')
+
+    rng = np.random.default_rng(seed)
+    pictures_df = synthetic_pictures_df(n_images, plate_number, sites)
+    pictures_df['CellCount'] = rng.poisson(cells_per_image, n_images)
+    wells = WELLS[:min(len(WELLS), -(-n_images // sites))]
+
+    sqlite_path = raw_path.joinpath(f'{plate_number}.sqlite')
+    sqlite_path.unlink(missing_ok=True)
+    conn = sqlite3.connect(sqlite_path)
+    try:
+        write_image_table(conn, pictures_df, plate_number)
+        write_cells_table(conn, pictures_df['CellCount'].to_numpy(), seed)
+        conn.commit()
+    finally:
+        conn.close()
+
+    well_df = well_profiles_df(wells, seed)
+    well_df.to_csv(raw_path.joinpath('mean_well_profiles.csv'), index=False)
+    chemical_annotations_df(well_df['Metadata_broad_sample']).to_csv(Path(LOCAL_DATA_PATH).joinpath('chemical_annotations.csv'), index=False)
+
+    if pictures:
+        write_pictures(pictures_df, plate_number, picture_size, seed)
+
+    print(f'✅ Synthetic plate {plate_number}: {n_images} images, {int(pictures_df["CellCount"].sum())} cells in {raw_path}')
+    return sqlite_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--plate', default='90000')
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--cells', type=int, default=100, help='mean number of cells per image')
+    parser.add_argument('--sites', type=int, default=SITES)
+    parser.add_argument('--no-pictures', action='store_true', help='skip the dummy TIFFs')
+    args = parser.parse_args()
+
+    make_synthetic_plate(args.plate, args.images, args.cells, args.sites, pictures=not args.no_pictures)
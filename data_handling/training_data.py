@@ -0,0 +1,162 @@
+"""
+Streaming input pipeline for the counter / area models.
+
+Instead of loading every picture in a list and stacking it before train_test_split, the rows
+of the processed small tables are streamed plate by plate. Each row goes through a bounded
+shuffle buffer, and its TIFF is decoded and resized on a pool of threads, then scaled by 1/65535.
+Batches are assembled by a background thread a few batches ahead of the model, so decoding
+overlaps training steps and memory stays flat whatever the number of plates:
+
+    train = as_tf_dataset(['24585', '24639'], label='CellCount', subset='train')
+    valid = as_tf_dataset(['24585', '24639'], label='CellCount', subset='validation')
+    model.fit(train, validation_data=valid, epochs=10)
+"""
+import queue
+import random
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from cache import processed_path, read_table
+from image_store import IMAGE_SIZE, load_picture, local_picture_paths
+
+MAX_VALUE = 65535
+
+
+def in_subset(path, subset, validation_fraction):
+    """
+    Stable train / validation split: a picture always falls on the same side, whatever the plates or the order.
+    """
+    if subset is None:
+        return True
+    is_validation = zlib.crc32(path.encode()) % 10_000 < validation_fraction * 10_000
+    return is_validation == (subset == 'validation')
+
+
+def iter_rows(plates, label='CellCount', channel='Hoechst', subset=None, validation_fraction=0.2):
+    """
+    (picture path, label) of every row of the processed small tables, one plate at a time.
+    subset is None (all rows), 'train' or 'validation'.
+    """
+    if subset not in (None, 'train', 'validation'):
+        raise ValueError("subset must be None, 'train' or 'validation'")
+
+    for plate_number in plates:
+        rows_df = read_table(processed_path(plate_number, 'small'), columns=[channel, label])
+        paths = local_picture_paths(rows_df, plate_number, channel)
+        for path, value in zip(paths, rows_df[label]):
+            if in_subset(path, subset, validation_fraction):
+                yield path, value
+
+
+def shuffle_buffer(items, buffer_size, seed=None):
+    """
+    Shuffle a stream holding at most buffer_size items, like tf.data.Dataset.shuffle.
+    """
+    rng = random.Random(seed)
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def load_normalized(path, size=IMAGE_SIZE):
+    """
+    Picture as the models expect it: float32 (height, width, 1) in [0, 1].
+    """
+    return (load_picture(path, size).astype(np.float32) / MAX_VALUE)[..., np.newaxis]
+
+
+def batches(rows, batch_size=32, size=IMAGE_SIZE, shuffle=1024, seed=None, workers=8, prefetch=2):
+    """
+    Yield (images, labels) batches from an iterable of (path, label) rows.
+    Up to `prefetch` batches are decoded ahead by `workers` threads while the caller consumes the current one.
+    shuffle is the size of the shuffle buffer (0 to keep the order).
+    """
+    if shuffle:
+        rows = shuffle_buffer(rows, shuffle, seed)
+
+    ready = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up when the consumer stopped iterating
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = deque()
+                max_pending = batch_size * (prefetch + 1)
+                images = np.empty((batch_size, size[1], size[0], 1), dtype=np.float32)
+                labels = []
+
+                def collect():
+                    nonlocal images, labels
+                    future, value = pending.popleft()
+                    images[len(labels)] = future.result()
+                    labels.append(value)
+                    if len(labels) == batch_size:
+                        if not put((images, np.asarray(labels, dtype=np.float32))):
+                            return False
+                        images = np.empty_like(images)
+                        labels = []
+                    return True
+
+                for path, value in rows:
+                    pending.append((executor.submit(load_normalized, path, size), value))
+                    if len(pending) >= max_pending and not collect():
+                        return
+                while pending:
+                    if not collect():
+                        return
+                if labels:
+                    put((images[:len(labels)], np.asarray(labels, dtype=np.float32)))
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = ready.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def as_tf_dataset(plates, label='CellCount', channel='Hoechst', subset=None, validation_fraction=0.2,
+                  batch_size=32, size=IMAGE_SIZE, shuffle=1024, seed=None, workers=8, prefetch=2):
+    """
+    tf.data.Dataset over the plates, re-reading the rows at every epoch.
+    """
+    import tensorflow as tf
+
+    def generator():
+        rows = iter_rows(plates, label, channel, subset, validation_fraction)
+        yield from batches(rows, batch_size, size, shuffle, seed, workers, prefetch)
+
+    signature = (tf.TensorSpec(shape=(None, size[1], size[0], 1), dtype=tf.float32),
+                 tf.TensorSpec(shape=(None,), dtype=tf.float32))
+    return tf.data.Dataset.from_generator(generator, output_signature=signature).prefetch(tf.data.AUTOTUNE)
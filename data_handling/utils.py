@@ -1,10 +1,11 @@
 import os
 from params import LOCAL_DATA_PATH
 from pathlib import Path
-from google.cloud import storage
-from tqdm.std import tqdm
-from google.cloud import bigquery
+from typing import Iterator
 import pandas as pd
+import pyarrow as pa
+from backends import get_backend
+from instrumentation import bound_argument, instrumented
 
 
 def create_folder_structure(plate_number):
@@ -28,6 +29,7 @@ def create_folder_structure(plate_number):
         if not os.path.exists(Path(LOCAL_DATA_PATH).joinpath(plate_number, 'processed')):
             os.makedirs(Path(LOCAL_DATA_PATH).joinpath(plate_number, 'processed'))
 
+@instrumented()
 def download_blob(bucket_name, source_blob_name, destination_file_name):
     """
     Download a file from GCS. Is called blob so is generic but will retrieve the SQLite DB.
@@ -36,47 +38,56 @@ def download_blob(bucket_name, source_blob_name, destination_file_name):
     :param source_blob_name: The name of the blob
     :param destination_file_name: The name of the file to save the blob to
     """
-    # Initialize a client
-    storage_client = storage.Client()
-    # Get the bucket
-    bucket = storage_client.bucket(bucket_name)
-    # Get the blob
-    blob = bucket.blob(source_blob_name)
-    # Download the blob to a destination file
-    with open(destination_file_name, 'wb') as f:
-        with tqdm.wrapattr(f, "write", total=blob.size) as file_obj:
-            storage_client.download_blob_to_file(blob, file_obj)
+    get_backend().download(bucket_name, source_blob_name, destination_file_name)
 
+@instrumented(rows=lambda data, *args, **kwargs: len(data))
 def big_query_read(
         gcp_project:str,
-        full_table_name:str
-    ) -> None:
+        full_table_name:str,
+        columns:list=None,
+        filters:dict=None
+    ) -> pd.DataFrame:
     """
-    Read the data from Big Query.
+    Read the data from Big Query (or the local warehouse).
+    Only the given columns are transferred, and only the rows matching filters,
+    e.g. {'Well': 'a01', 'Role': ['mock', 'treated'], 'ImageID': (0, 999)}.
     """
-    query = f"""
-        SELECT *
-        FROM {full_table_name}
-        """
+    return get_backend().read(gcp_project, full_table_name, columns, filters)
 
-    client = bigquery.Client(project=gcp_project)
-    query_job = client.query(query)
-    result = query_job.result()
 
-    return result
+def big_query_read_batches(
+        gcp_project:str,
+        full_table_name:str,
+        columns:list=None,
+        filters:dict=None,
+        batch_size:int=100_000
+    ) -> Iterator[pa.RecordBatch]:
+    """
+    Stream the data from Big Query (or the local warehouse) as Arrow record batches,
+    so large tables can be consumed without holding them in memory.
+    """
+    return get_backend().read_batches(gcp_project, full_table_name, columns, filters, batch_size)
 
 
+@instrumented(rows=lambda result, *args, **kwargs: len(bound_argument(big_query_write, 'data', args, kwargs)))
 def big_query_write(
         gcp_project:str,
         full_table_name:str,
         data:pd.DataFrame
     ) -> None:
     """
-    Write the data to Big Query.
+    Write the data to Big Query (or the local warehouse).
     """
-    client = bigquery.Client(project=gcp_project)
-    write_mode = "WRITE_APPEND"
+    get_backend().write(gcp_project, full_table_name, data)
 
-    client = bigquery.Client()
-    job_config = bigquery.LoadJobConfig(write_disposition=write_mode)
-    job = client.load_table_from_dataframe(data, full_table_name, job_config=job_config)
+
+@instrumented()
+def big_query_write_file(
+        gcp_project:str,
+        full_table_name:str,
+        path:str
+    ) -> None:
+    """
+    Replace the table in Big Query (or the local warehouse) with the content of a Parquet file, in one load job.
+    """
+    get_backend().write_file(gcp_project, full_table_name, path)
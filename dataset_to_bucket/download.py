@@ -1,13 +1,25 @@
 import os
-import requests
-import zipfile
+import sys
 from pathlib import Path
-from tqdm.std import tqdm
 import shutil
-from google.cloud import storage
-import tarfile
+from fetch import download_files
+from extract import extract_tar_file, extract_tar_url, extract_zip_members
+from upload import GCSStorage, upload_folder
+
+# Same default and override as data_handling/params.py, so downloads and metrics land in the same tree
+LOCAL_DATA_PATH = os.environ.get('LOCAL_DATA_PATH', os.path.join(os.path.expanduser('~'), ".morpho_minds_data"))
+
+# Stage metrics are recorded with data_handling/instrumentation.py (flat imports, like the other data_handling modules)
+DATA_HANDLING_PATH = os.environ.get('DATA_HANDLING_PATH', str(Path(__file__).resolve().parent.parent.joinpath('data_handling')))
+if DATA_HANDLING_PATH not in sys.path:
+    sys.path.append(DATA_HANDLING_PATH)
+try:
+    from instrumentation import instrumented
+except ImportError:
+    # The downloader also runs without the data_handling folder, just without metrics
+    def instrumented(name=None, rows=None):
+        return lambda func: func
 
-LOCAL_DATA_PATH = os.path.join(os.path.expanduser('~'), ".morpho_minds_data")
 BUCKET_NAME = 'cell_profiles_morpho_minds'
 
 PLATES = [
@@ -40,124 +52,130 @@ def create_folder_structure(plate_number):
     if not os.path.exists(Path(LOCAL_DATA_PATH).joinpath(plate_number, 'raw')):
         os.makedirs(Path(LOCAL_DATA_PATH).joinpath(plate_number, 'raw'))
 
+@instrumented()
 def download_dataset(url, plate_number):
     saving_path = Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'raw')
-    if not os.path.exists(saving_path):
-        os.makedirs(saving_path)
-
-    # Download the file
-    try:
-        file_path = Path(saving_path).joinpath(f'Plate_{plate_number}.tar.gz')
-        with requests.get(url, stream=True) as r:
-            r.raise_for_status()
-            with open(file_path, 'wb') as f:
-                with tqdm.wrapattr(f, "write", total=int(r.headers.get('content-length'))) as file_obj:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        file_obj.write(chunk)
+    file_path = Path(saving_path).joinpath(f'Plate_{plate_number}.tar.gz')
+
+    # Download the file, resuming a previous partial download
+    result, = download_files([{'url': url, 'path': file_path}])
+    if result['status'] == 'failed':
+        raise RuntimeError(f"Could not download {url}: {result['error']}")
+    if result['status'] == 'skipped':
+        print(f"{file_path} is already there, skipped {url}")
+    else:
         print(f"Downloaded {url} to {file_path}")
-    except Exception as e:
-        print(f"Failed to download {url}: {e}")
 
+@instrumented(rows=lambda results, *args, **kwargs: len(results))
+def download_datasets(plates, max_workers=4):
+    """
+    Download the preprocessed tarballs of several plates concurrently.
+    """
+    # Plates may come as strings, e.g. from the command line
+    jobs = [{'url': preprocessed_data_urls[PLATES.index(int(plate))],
+             'path': Path(LOCAL_DATA_PATH).joinpath(str(plate), 'raw', f'Plate_{plate}.tar.gz')}
+            for plate in plates]
+    return download_files(jobs, max_workers=max_workers)
+
+def dataset_members(plate_number):
+    """
+    Members of Plate_{n}.tar.gz we keep, mapped to where they are saved.
+    """
+    archive_path = f'gigascience_upload/Plate_{plate_number}'
+    save_path = Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'raw')
+    return {
+        f'{archive_path}/extracted_features/{plate_number}.sqlite': save_path.joinpath(f'{plate_number}.sqlite'),
+        f'{archive_path}/profiles/mean_well_profiles.csv': save_path.joinpath('mean_well_profiles.csv'),
+    }
+
+@instrumented()
 def unzip_dataset(plate_number):
 # Unzip the file
     print('Unzipping...')
     file_path = Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'raw', f'Plate_{plate_number}.tar.gz')
-    uncompressed_dir = Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'raw', 'temp')
     if not file_path.exists():
         print('File does not exist')
 
-    tar = tarfile.open(file_path, "r:gz",)
-    tar.extractall(uncompressed_dir)
-    tar.close()
-    print(f"Unzipped to {uncompressed_dir}")
-
-    files_path = uncompressed_dir.joinpath('gigascience_upload', f'Plate_{plate_number}')
-    sqlite_path = files_path.joinpath('extracted_features', f'{plate_number}.sqlite')
-    profiles_path = files_path.joinpath('profiles', 'mean_well_profiles.csv')
-    save_path = Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'raw')
-    print(f"Moving files...")
-    shutil.move(str(sqlite_path), str(save_path))
-    shutil.move(str(profiles_path), str(save_path))
-    print("Deleting temp files...")
-    shutil.rmtree(uncompressed_dir)
+    # Only the SQLite DB and the well profiles are written, straight to the raw folder
+    extract_tar_file(file_path, dataset_members(plate_number))
+    print("Deleting archive...")
     os.remove(file_path)
     print("Done.")
 
-def download_pictures(urls, plate_number):
-    for url in urls:
-        channel = url.split("/")[-1].split("-")[1].split(".")[0]
-        file_name = url.split("/")[-1]
-        saving_path = Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'raw')
-        print(f'Downloading pictures for plate {plate_number} and channel {channel}...')
-
-        if not os.path.exists(saving_path):
-            os.makedirs(saving_path)
-
-        # Download the file
-        try:
-            file_path = Path(saving_path).joinpath(f'{file_name}')
-            if not file_path.exists():
-                with requests.get(url, stream=True) as r:
-                    r.raise_for_status()
-                    with open(file_path, 'wb') as f:
-                        with tqdm.wrapattr(f, "write", total=int(r.headers.get('content-length'))) as file_obj:
-                            for chunk in r.iter_content(chunk_size=8192):
-                                file_obj.write(chunk)
-                print(f"Downloaded {url} to {file_path}")
-        except Exception as e:
-            print(f"Failed to download {url}: {e}")
+@instrumented()
+def stream_dataset(url, plate_number):
+    """
+    Extract the SQLite DB and the well profiles while the tarball downloads, without ever storing the tarball.
+    Unlike download_dataset, an interrupted stream cannot be resumed.
+    """
+    print(f'Streaming {url}...')
+    extract_tar_url(url, dataset_members(plate_number))
+    print("Done.")
 
+@instrumented(rows=lambda results, *args, **kwargs: len(results))
+def download_pictures(urls, plate_number, max_workers=5, segments=4):
+    """
+    Download the channel zips of a plate concurrently. Big zips are fetched as parallel byte ranges.
+    """
+    saving_path = Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'raw')
+    print(f'Downloading pictures for plate {plate_number}...')
+
+    jobs = [{'url': url, 'path': saving_path.joinpath(url.split("/")[-1])} for url in urls]
+    return download_files(jobs, max_workers=max_workers, segments=segments)
+
+@instrumented()
 def unzip_pictures(plate_number):
     for channel in CHANNELS:
         print(f'Unzipping pictures for channel {channel}...')
         zip_file_path = Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'raw', f'{plate_number}-{channel}.zip')
         if not zip_file_path.exists():
             print('File does not exist')
-        zip_uncompressed_dir = Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'raw', 'pictures')
-        z = zipfile.ZipFile(zip_file_path)
-        z.extractall(zip_uncompressed_dir)
-        print(f"Unzipped to {zip_uncompressed_dir}")
-        print("Deleting temp files...")
-        os.remove(zip_file_path)
-        print("Done.")
-
-def upload_folder_to_bucket(bucket_name, source_folder_path, plate_number):
-    # Initialize Google Cloud Storage client
-    client = storage.Client()
-    bucket = client.get_bucket(bucket_name)
+        unzip_picture_file(zip_file_path, plate_number)
+
+@instrumented(rows=lambda count, *args, **kwargs: count)
+def unzip_picture_file(zip_file_path, plate_number):
+    zip_uncompressed_dir = Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'raw', 'pictures')
+    count = extract_zip_members(zip_file_path, zip_uncompressed_dir, keep=lambda name: name.lower().endswith(('.tif', '.tiff')))
+    print(f"Unzipped {count} pictures to {zip_uncompressed_dir}")
+    print("Deleting temp files...")
+    os.remove(zip_file_path)
+    print("Done.")
+    return count
+
+@instrumented(rows=lambda results, *args, **kwargs: len(results))
+def download_and_unzip_pictures(urls, plate_number, max_workers=5, segments=4):
+    """
+    Download the channel zips of a plate and unzip each one as soon as it is complete,
+    while the other channels are still downloading.
+    """
+    saving_path = Path(LOCAL_DATA_PATH).joinpath(str(plate_number), 'raw')
+    jobs = [{'url': url, 'path': saving_path.joinpath(url.split("/")[-1])} for url in urls]
+    return download_files(jobs, max_workers=max_workers, segments=segments,
+                          on_complete=lambda result: unzip_picture_file(result['path'], plate_number))
+
+@instrumented(rows=lambda report, *args, **kwargs: report['uploaded'])
+def upload_folder_to_bucket(bucket_name, source_folder_path, plate_number, workers=16, storage=None):
+    """
+    Upload the plate folder to the bucket in parallel, then delete it locally if every file made it.
+    Files already uploaded and unchanged are skipped, using a manifest kept next to the plate folder.
+    """
+    storage = storage or GCSStorage(bucket_name, pool_size=workers)
+    manifest_path = Path(LOCAL_DATA_PATH).joinpath(f'{plate_number}_upload_manifest.json')
     print(f"Uploading {source_folder_path} to {bucket_name}...")
-    counter = 0
-    try:
-        # Walk through the source folder and upload files to the bucket
-        for root, dirs, files in os.walk(source_folder_path):
-            for file in files:
-                # Get the local file path
-                local_file_path = os.path.join(root, file)
-                # Get the relative file path (stripping the source_folder_path)
-                relative_file_path = os.path.relpath(local_file_path, source_folder_path)
-                # Define the destination blob path in the bucket
-                destination_blob_path = os.path.join(f'{plate_number}', relative_file_path).replace("\\", "/")
-                # Create a blob in the bucket
-                blob = bucket.blob(destination_blob_path)
-                # Upload the file
-                blob.upload_from_filename(local_file_path)
-                counter = counter + 1
-                if counter == 200:
-                    print("200 files uploaded...")
-                    counter = 0
-            print(f"✅ {source_folder_path} uploaded to {bucket_name}")
-        # Delete local folder
-        shutil.rmtree(source_folder_path)
-    except Exception as e:
-        print(f"Failed to upload {source_folder_path} to {bucket_name}: {e}")
-
-for i, plate in enumerate(PLATES):
-#    create_folder_structure(f'{plate}')
-   download_dataset(preprocessed_data_urls[i], plate)
-    # unzip_dataset(plate)
-#    download_pictures(pictures_urls[plate], plate)
-#    unzip_pictures(plate)
-#    upload_folder_to_bucket(BUCKET_NAME, Path(LOCAL_DATA_PATH).joinpath(str(plate)), plate)
-#for var in PLATES:
-#  unzip_dataset(var)
-#  upload_folder_to_bucket(BUCKET_NAME, Path(LOCAL_DATA_PATH).joinpath(str(var)), f'{var}')
+
+    report = upload_folder(storage, source_folder_path, prefix=f'{plate_number}', workers=workers, manifest_path=manifest_path)
+    if report['failed']:
+        print(f"Failed to upload {report['failed']} files of {source_folder_path} to {bucket_name}, run again to resume.")
+        return report
+
+    print(f"✅ {source_folder_path} uploaded to {bucket_name}")
+    # Delete local folder
+    shutil.rmtree(source_folder_path)
+    return report
+
+if __name__ == '__main__':
+    download_datasets(PLATES)
+    # for plate in PLATES:
+    #    unzip_dataset(plate)
+    #    download_and_unzip_pictures(pictures_urls[plate], plate)
+    #    upload_folder_to_bucket(BUCKET_NAME, Path(LOCAL_DATA_PATH).joinpath(str(plate)), plate)
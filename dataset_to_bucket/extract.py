@@ -0,0 +1,91 @@
+"""
+Selective extraction of plate archives.
+
+Only the archive members we keep are written, straight to their final location, instead of
+extracting the whole archive into a temp tree and moving files out of it. Tarballs are read
+as a stream, so they can be extracted while they are still being downloaded and reading
+stops as soon as all the wanted members have been found.
+"""
+import os
+import shutil
+import tarfile
+import zipfile
+from pathlib import Path
+import requests
+
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = 60
+
+
+def _write_member(src, dest):
+    """
+    Copy an archive member to dest through a temp file, so a crash never leaves half a file at dest.
+    """
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(f'{dest}.tmp')
+    with open(tmp_path, 'wb') as f:
+        shutil.copyfileobj(src, f, CHUNK_SIZE)
+    os.replace(tmp_path, dest)
+
+
+def extract_tar_members(fileobj, members):
+    """
+    Stream a .tar.gz from a file object and write the members listed in `members`
+    ({member name: destination path}). Nothing else is written to disk.
+    Raises KeyError if some members are not in the archive.
+    """
+    remaining = dict(members)
+
+    with tarfile.open(fileobj=fileobj, mode='r|gz') as tar:
+        for member in tar:
+            if member.name not in remaining:
+                continue
+            _write_member(tar.extractfile(member), remaining.pop(member.name))
+            print(f'Extracted {member.name}')
+            if not remaining:
+                # No need to decompress the rest of the archive
+                break
+
+    if remaining:
+        raise KeyError(f'Members not found in archive: {list(remaining)}')
+
+
+def extract_tar_file(tar_path, members):
+    with open(tar_path, 'rb') as f:
+        extract_tar_members(f, members)
+
+
+def extract_tar_url(url, members, session=None):
+    """
+    Extract members of a remote .tar.gz while it downloads, without storing the archive.
+    """
+    session = session or requests.Session()
+    with session.get(url, stream=True, timeout=TIMEOUT) as r:
+        r.raise_for_status()
+        # Undo a Content-Encoding the server may add, the gzip of the archive itself is handled by tarfile
+        r.raw.decode_content = True
+        extract_tar_members(r.raw, members)
+
+
+def extract_zip_members(zip_path, dest_dir, keep=None):
+    """
+    Write the files of a zip to dest_dir one by one, keeping the paths they have in the archive.
+    keep is an optional predicate on the member name, e.g. lambda name: name.endswith('.tif').
+    Returns the number of files extracted.
+    """
+    dest_dir = Path(dest_dir).resolve()
+    count = 0
+
+    with zipfile.ZipFile(zip_path) as z:
+        for info in z.infolist():
+            if info.is_dir() or (keep is not None and not keep(info.filename)):
+                continue
+            dest = dest_dir.joinpath(info.filename).resolve()
+            if dest_dir not in dest.parents:
+                raise ValueError(f'Refusing to extract {info.filename} outside of {dest_dir}')
+            with z.open(info) as src:
+                _write_member(src, dest)
+            count += 1
+
+    return count
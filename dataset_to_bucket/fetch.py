@@ -0,0 +1,258 @@
+"""
+Concurrent, resumable HTTP downloads.
+
+Each file is first written to `<path>.part`. If a download is interrupted, the next run
+resumes the .part file with an HTTP Range request instead of starting from zero. Large
+files can also be split into byte ranges that are fetched in parallel. A file is only
+renamed to its final path once its size (and checksum, when given) has been verified.
+
+    jobs = [{'url': 'https://.../Plate_24585.tar.gz', 'path': '/data/Plate_24585.tar.gz'},
+            {'url': 'https://.../24585-Hoechst.zip', 'path': '/data/24585-Hoechst.zip', 'md5': '...'}]
+    download_files(jobs, max_workers=4)
+
+Any HTTP server with Range support works, so a local server can stand in for the real hosts.
+"""
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm.std import tqdm
+
+CHUNK_SIZE = 1024 * 1024
+MIN_SEGMENT_SIZE = 64 * 1024 * 1024
+TIMEOUT = 60
+RETRY_BACKOFF_S = 1
+
+
+class FileProgress:
+    """
+    Counts the bytes of one file on the batch progress bar, so they can be taken back before a retry.
+    """
+    def __init__(self, bar):
+        self.bar = bar
+        self.n = 0
+        self.lock = threading.Lock()
+
+    def update(self, n):
+        with self.lock:
+            self.n += n
+            self.bar.update(n)
+
+    def reset(self):
+        self.update(-self.n)
+
+
+class RestartDownload(RuntimeError):
+    """
+    The partial file was discarded, the next attempt starts from zero.
+    """
+
+
+def is_retryable(error):
+    """
+    Connection errors, timeouts, 5xx and 429 answers are worth another attempt, other 4xx answers are not.
+    """
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        return status is not None and (status >= 500 or status == 429)
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, RestartDownload))
+
+
+def make_session(pool_size=16):
+    """
+    requests session whose connection pool is big enough for all the download threads.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def probe(session, url):
+    """
+    Return the size of the remote file (None if unknown) and whether the server accepts Range requests.
+    """
+    r = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    if r.ok and r.headers.get('content-length'):
+        return int(r.headers['content-length']), r.headers.get('accept-ranges') == 'bytes'
+
+    # Some servers do not answer HEAD properly: ask for the first byte instead
+    with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=TIMEOUT) as r:
+        r.raise_for_status()
+        if r.status_code == 206 and '/' in r.headers.get('content-range', ''):
+            total = r.headers['content-range'].split('/')[-1]
+            return (int(total) if total != '*' else None), True
+        length = r.headers.get('content-length')
+        return (int(length) if length else None), False
+
+
+def file_checksum(path, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify(path, size=None, md5=None, sha256=None):
+    """
+    Raise ValueError if the file does not have the expected size or checksum.
+    """
+    actual_size = Path(path).stat().st_size
+    if size is not None and actual_size != size:
+        raise ValueError(f'{path} has {actual_size} bytes, expected {size}')
+    for algorithm, expected in (('md5', md5), ('sha256', sha256)):
+        if expected and file_checksum(path, algorithm) != expected.lower():
+            raise ValueError(f'{path} does not match its {algorithm} checksum')
+
+
+def fetch_range(session, url, part_path, progress, start=0, end=None):
+    """
+    Download bytes start..end (inclusive, end=None for the rest of the file) of url into part_path,
+    resuming from what part_path already holds.
+    """
+    part_path = Path(part_path)
+    done = part_path.stat().st_size if part_path.exists() else 0
+    expected = None if end is None else end - start + 1
+
+    if expected is not None and done >= expected:
+        progress.update(expected)
+        return
+    progress.update(done)
+
+    headers = {}
+    if start + done > 0 or end is not None:
+        headers['Range'] = f'bytes={start + done}-{"" if end is None else end}'
+
+    with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+        if r.status_code == 416 and done and end is None:
+            # Size unknown and the .part already holds the whole file: nothing is left to send
+            total = r.headers.get('content-range', '').split('/')[-1]
+            if total.isdigit() and int(total) != start + done:
+                os.remove(part_path)
+                raise RestartDownload(f'{part_path} has {done} bytes, {url} has {total}, starting over')
+            return
+        r.raise_for_status()
+        if 'Range' in headers and r.status_code != 206:
+            # The server ignored the Range header and sends the whole file: start over
+            if start > 0:
+                raise RuntimeError(f'{url} does not support Range requests')
+            progress.update(-done)
+            done = 0
+
+        with open(part_path, 'ab' if done else 'wb') as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                progress.update(len(chunk))
+
+
+def fetch_segments(session, url, part_path, size, segments, progress):
+    """
+    Split the file into byte ranges, download them in parallel and join them into part_path.
+    Every range has its own .partN file, so each of them resumes independently.
+    """
+    bounds = [size * i // segments for i in range(segments + 1)]
+    segment_paths = [Path(f'{part_path}{i}') for i in range(segments)]
+
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [executor.submit(fetch_range, session, url, segment_paths[i], progress, bounds[i], bounds[i + 1] - 1)
+                   for i in range(segments)]
+        for future in futures:
+            future.result()
+
+    with open(part_path, 'wb') as f:
+        for segment_path in segment_paths:
+            with open(segment_path, 'rb') as segment:
+                while chunk := segment.read(CHUNK_SIZE):
+                    f.write(chunk)
+            os.remove(segment_path)
+
+
+def download_file(session, job, bar, segments=1, retries=3):
+    """
+    Download one job, skipping it when the final file is already there and valid.
+    Returns 'skipped' or 'downloaded'.
+    """
+    url, path = job['url'], Path(job['path'])
+    size, accept_ranges = job.get('size'), job.get('accept_ranges', False)
+    part_path = Path(f'{path}.part')
+    progress = FileProgress(bar)
+
+    if path.exists():
+        try:
+            verify(path, size, job.get('md5'), job.get('sha256'))
+            progress.update(path.stat().st_size)
+            return 'skipped'
+        except ValueError:
+            os.remove(path)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    for attempt in range(retries + 1):
+        try:
+            if segments > 1 and accept_ranges and size and size >= segments * MIN_SEGMENT_SIZE:
+                fetch_segments(session, url, part_path, size, segments, progress)
+            else:
+                fetch_range(session, url, part_path, progress, 0, size - 1 if size else None)
+            break
+        except (requests.RequestException, RuntimeError) as e:
+            # The bytes already on disk are counted again when resuming
+            progress.reset()
+            if attempt == retries or not is_retryable(e):
+                raise
+            time.sleep(RETRY_BACKOFF_S * 2 ** attempt)
+
+    try:
+        verify(part_path, size, job.get('md5'), job.get('sha256'))
+    except ValueError:
+        os.remove(part_path)
+        raise
+    os.replace(part_path, path)
+    return 'downloaded'
+
+
+def download_files(jobs, max_workers=4, segments=1, retries=3, session=None, on_complete=None):
+    """
+    Download all jobs with at most max_workers files in flight, showing one progress bar for the batch.
+    Each job is a dict with 'url' and 'path', and optionally 'size', 'md5' and 'sha256'.
+    Files larger than segments * 64 MB are split into `segments` parallel ranges.
+    on_complete(result) is called as soon as each file is ready, while the other files keep downloading.
+    Returns one result dict per job with its status ('downloaded', 'skipped' or 'failed').
+    """
+    session = session or make_session(max_workers * segments)
+
+    def probe_job(job):
+        job = dict(job)
+        try:
+            size, job['accept_ranges'] = probe(session, job['url'])
+            job.setdefault('size', size)
+        except requests.RequestException:
+            job.setdefault('size', None)
+        return job
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        jobs = list(executor.map(probe_job, jobs))
+
+    total = sum(job['size'] or 0 for job in jobs)
+    results = []
+    with tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024, desc=f'{len(jobs)} files') as bar:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(download_file, session, job, bar, segments, retries): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                result = {'url': job['url'], 'path': str(job['path'])}
+                try:
+                    result['status'] = future.result()
+                except Exception as e:
+                    result.update(status='failed', error=repr(e))
+                    print(f"Failed to download {job['url']}: {e}")
+                results.append(result)
+
+                if on_complete is not None and result['status'] != 'failed':
+                    on_complete(result)
+
+    return results
@@ -0,0 +1,160 @@
+"""
+Parallel, incremental folder upload.
+
+Files are uploaded by a pool of threads, each file retried on its own. A manifest records the
+size, modification time and MD5 of every uploaded file, so after a failure only the files that
+are missing or changed are sent again.
+
+The destination is anything with the two methods of the storage interface:
+
+    stat(name)               -> (size, md5 hex) of the stored object, or None if it does not exist
+                                (md5 None when unknown, e.g. composite objects: the file is sent again)
+    upload(local_path, name) -> store the local file under name
+
+GCSStorage writes to a bucket, LocalStorage to a folder (to test without GCS).
+"""
+import base64
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class GCSStorage:
+    def __init__(self, bucket_name, client=None, pool_size=16):
+        """
+        pool_size should be at least the number of upload workers: the client's HTTP pool keeps
+        10 connections by default, and the workers beyond that would reconnect on every request.
+        """
+        from google.cloud import storage
+        from requests.adapters import HTTPAdapter
+
+        client = client or storage.Client()
+        client._http.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        self.bucket = client.bucket(bucket_name)
+
+    def stat(self, name):
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            return None
+        # Composite objects have no MD5, only a CRC32C
+        return blob.size, base64.b64decode(blob.md5_hash).hex() if blob.md5_hash else None
+
+    def upload(self, local_path, name):
+        self.bucket.blob(name).upload_from_filename(local_path, checksum='md5')
+
+
+class LocalStorage:
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def stat(self, name):
+        path = self.root.joinpath(name)
+        if not path.is_file():
+            return None
+        return path.stat().st_size, file_md5(path)
+
+    def upload(self, local_path, name):
+        path = self.root.joinpath(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(f'{path}.tmp')
+        shutil.copyfile(local_path, tmp_path)
+        os.replace(tmp_path, path)
+
+
+def load_manifest(manifest_path):
+    if manifest_path is not None and Path(manifest_path).is_file():
+        with open(manifest_path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(manifest, manifest_path):
+    if manifest_path is None:
+        return
+    tmp_path = Path(f'{manifest_path}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def upload_file(storage, local_path, name, entry, retries=3):
+    """
+    Upload one file unless the manifest entry or the storage already has the same content.
+    Returns ('skipped' or 'uploaded', new manifest entry).
+    """
+    stat = os.stat(local_path)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return 'skipped', entry
+
+    md5 = file_md5(local_path)
+    new_entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'md5': md5}
+    if (entry and entry['size'] == stat.st_size and entry['md5'] == md5) or storage.stat(name) == (stat.st_size, md5):
+        return 'skipped', new_entry
+
+    for attempt in range(retries + 1):
+        try:
+            storage.upload(local_path, name)
+            return 'uploaded', new_entry
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def upload_folder(storage, source_folder_path, prefix='', workers=16, retries=3, manifest_path=None):
+    """
+    Upload every file under source_folder_path to prefix/<relative path> with `workers` threads.
+    Returns a report with the number of files uploaded, skipped and failed, and the throughput.
+    """
+    manifest = load_manifest(manifest_path)
+    files = []
+    for root, dirs, filenames in os.walk(source_folder_path):
+        for filename in filenames:
+            local_path = os.path.join(root, filename)
+            relative_path = os.path.relpath(local_path, source_folder_path)
+            files.append((local_path, os.path.join(prefix, relative_path).replace("\\", "/")))
+
+    report = {'files': len(files), 'uploaded': 0, 'skipped': 0, 'failed': 0, 'bytes': 0, 'errors': {}}
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(upload_file, storage, local_path, name, manifest.get(name), retries): (local_path, name)
+                   for local_path, name in files}
+        for done, future in enumerate(as_completed(futures), start=1):
+            local_path, name = futures[future]
+            try:
+                status, entry = future.result()
+                manifest[name] = entry
+                report[status] += 1
+                if status == 'uploaded':
+                    report['bytes'] += entry['size']
+            except Exception as e:
+                report['failed'] += 1
+                report['errors'][name] = repr(e)
+
+            if done % 200 == 0:
+                save_manifest(manifest, manifest_path)
+                print(f"{done}/{len(files)} files processed...")
+
+    save_manifest(manifest, manifest_path)
+
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    report['files_per_s'] = round(report['uploaded'] / report['seconds'], 1) if report['seconds'] else 0.0
+    report['mb_per_s'] = round(report['bytes'] / 1e6 / report['seconds'], 2) if report['seconds'] else 0.0
+    print(f"{report['uploaded']} uploaded, {report['skipped']} skipped, {report['failed']} failed "
+          f"in {report['seconds']}s ({report['files_per_s']} files/s, {report['mb_per_s']} MB/s)")
+    return report
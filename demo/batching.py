@@ -0,0 +1,126 @@
+"""
+Dynamic micro-batching of model inference.
+
+Requests put their image in a queue and wait. A single worker takes what is in the queue, up
+to max_batch_size images or whatever arrived within max_wait_ms of the first one, stacks the
+images of the same shape and runs one predict_on_batch in a thread, so the event loop keeps
+accepting requests meanwhile. Each caller then gets its own row of the result:
+
+    counter = BatchScheduler(model.predict_on_batch)
+    prediction = await counter.predict(image)    # image without the batch dimension
+
+The defaults can be changed with the BATCH_MAX_SIZE and BATCH_MAX_WAIT_MS environment variables.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+MAX_BATCH_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 32))
+MAX_WAIT_MS = float(os.environ.get('BATCH_MAX_WAIT_MS', 5))
+
+
+class BatchScheduler:
+    def __init__(self, predict_fn, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # One thread: the model runs one batch at a time, the next batch fills up meanwhile
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.worker = None
+        self.batches = 0
+        self.images = 0
+
+    def start(self):
+        """
+        Start the worker on the running event loop (done by the first predict call).
+        """
+        if self.worker is None or self.worker.done():
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        self.executor.shutdown(wait=False)
+
+    async def predict(self, image):
+        """
+        Prediction for one image (no batch dimension).
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((np.asarray(image), future))
+        return await future
+
+    async def predict_many(self, images):
+        """
+        Predictions for a batch of images, scheduled with the images of the other requests.
+        """
+        return list(await asyncio.gather(*(self.predict(image) for image in images)))
+
+    async def run_batch(self, batch):
+        """
+        Run an already assembled batch (e.g. bulk scoring) on the model thread, in turn with the queued requests.
+        """
+        results = await asyncio.get_running_loop().run_in_executor(self.executor, self.predict_fn, batch)
+        self.batches += 1
+        self.images += len(batch)
+        return np.asarray(results)
+
+    async def collect(self):
+        """
+        Wait for a first image, then take more until the batch is full or max_wait is over.
+        """
+        items = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(items) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                # Still take what is already waiting
+                if self.queue.empty():
+                    break
+                items.append(self.queue.get_nowait())
+                continue
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return items
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = await self.collect()
+
+            # Only images of the same shape and type can be stacked together
+            groups = {}
+            for image, future in items:
+                groups.setdefault((image.shape, image.dtype.str), []).append((image, future))
+
+            for group in groups.values():
+                futures = [future for _, future in group]
+                try:
+                    batch = np.stack([image for image, _ in group])
+                    results = await loop.run_in_executor(self.executor, self.predict_fn, batch)
+                    self.batches += 1
+                    self.images += len(group)
+                    for future, result in zip(futures, np.asarray(results)):
+                        if not future.done():
+                            future.set_result(result)
+                except Exception as e:
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+
+    def stats(self):
+        return {'batches': self.batches,
+                'images': self.images,
+                'mean_batch_size': round(self.images / self.batches, 2) if self.batches else 0.0}
@@ -0,0 +1,95 @@
+"""
+Compare the Keras and TFLite backends of a model: load time, latency per batch size,
+peak memory and difference of the predictions with Keras.
+
+    python bench_inference.py final_counter_model.keras final_counter_model.tflite final_counter_model_int8.tflite
+    python bench_inference.py final_area_model.keras final_area_model_float16.tflite --samples area_samples.npy
+
+The first model is the reference. Every model is run in its own process, so load time and
+memory include the import of its runtime. The inputs are --samples (preprocessed as the API
+does before predict) or random values in [0, --max-value].
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import time
+import numpy as np
+from registry import load_model
+
+
+def inputs_for(model, samples, n_samples, max_value):
+    if samples is not None:
+        return np.asarray(samples[:n_samples], dtype=np.float32).reshape((-1,) + tuple(model.input_shape[1:]))
+    rng = np.random.default_rng(0)
+    return rng.uniform(0, max_value, (n_samples,) + tuple(model.input_shape[1:])).astype(np.float32)
+
+
+def run_backend(path, batch_sizes, repeat, samples_path, n_samples, max_value):
+    """
+    Measures of one model, run in a child process.
+    """
+    start = time.perf_counter()
+    model = load_model(path)
+    load_s = time.perf_counter() - start
+
+    samples = np.load(samples_path, mmap_mode='r') if samples_path else None
+    inputs = inputs_for(model, samples, n_samples, max_value)
+
+    latencies = {}
+    for batch_size in batch_sizes:
+        batch = inputs[np.arange(batch_size) % len(inputs)]
+        model.predict_on_batch(batch)
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model.predict_on_batch(batch)
+            timings.append(time.perf_counter() - start)
+        timings = np.array(timings) * 1000
+        latencies[batch_size] = {'p50_ms': round(float(np.percentile(timings, 50)), 3),
+                                 'p99_ms': round(float(np.percentile(timings, 99)), 3),
+                                 'images_per_s': round(batch_size * 1000 / float(np.mean(timings)), 1)}
+
+    predictions = np.concatenate([np.asarray(model.predict_on_batch(inputs[i:i + 32])).reshape(-1)
+                                  for i in range(0, len(inputs), 32)])
+    return {'load_s': round(load_s, 3),
+            # ru_maxrss is in KB on Linux
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'latency': latencies,
+            'predictions': predictions.tolist()}
+
+
+def bench(paths, batch_sizes=(1, 8, 32), repeat=50, samples_path=None, n_samples=256, max_value=1.0):
+    context = multiprocessing.get_context('spawn')
+    report = {}
+    for path in paths:
+        with context.Pool(1) as pool:
+            report[path] = pool.apply(run_backend, (path, batch_sizes, repeat, samples_path, n_samples, max_value))
+
+    reference = np.array(report[paths[0]]['predictions'])
+    for path in paths:
+        predictions = np.array(report[path].pop('predictions'))
+        errors = np.abs(predictions - reference)
+        report[path]['accuracy'] = {'mae': round(float(errors.mean()), 6),
+                                    'max_abs_error': round(float(errors.max()), 6),
+                                    'relative_mae': round(float(errors.mean() / (np.abs(reference).mean() or 1)), 6)}
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('models', nargs='+', help='.keras / .tflite files, the first one is the reference')
+    parser.add_argument('--batch-sizes', default='1,8,32')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--samples', help='.npy of preprocessed inputs')
+    parser.add_argument('--n-samples', type=int, default=256)
+    parser.add_argument('--max-value', type=float, default=1.0)
+    parser.add_argument('--output', help='also write the report to this JSON file')
+    args = parser.parse_args()
+
+    batch_sizes = [int(size) for size in args.batch_sizes.split(',')]
+    report = bench(args.models, batch_sizes, args.repeat, args.samples, args.n_samples, args.max_value)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,197 @@
+"""
+Bulk scoring: many images in one request, results streamed back as NDJSON while they are computed.
+
+The images are read in chunks of BULK_BATCH_SIZE. The next chunk is decoded in a thread while
+the models run on the current one, and each chunk goes through the model as one batch. The body of
+the request is one of:
+
+    application/x-npy     a stack of images (n, height, width[, channels])
+    multipart/form-data   image files (TIFF, PNG...) in `files` fields
+    application/json      {"images": [{"data": base64, "dtype": "uint16", "shape": [224, 224]}, ...]}
+                          or a plate reference {"plate": "24585", "channels": ["Hoechst"], "limit": 1000}
+
+For a plate, the memory-mapped image store of data_handling/image_store.py is read if it was built,
+the TIFFs listed in the processed small table are decoded otherwise.
+Every line of the response is {<ids of the image>, <model name>: prediction, ...}, and a last line {"error": ...}
+if scoring stopped early.
+"""
+import asyncio
+import base64
+import binascii
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from payloads import INPUT_SIZE, PayloadError, decode_image_file, decode_json, decode_npy, decode_raw
+
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 64))
+DATA_HANDLING_PATH = os.environ.get('DATA_HANDLING_PATH', str(Path(__file__).resolve().parent.parent.joinpath('data_handling')))
+
+
+class PlateDataUnavailable(RuntimeError):
+    """
+    Plate references cannot be served here, e.g. in the API image, which ships neither data_handling nor pyarrow.
+    """
+
+
+def import_data_handling():
+    """
+    Make the data_handling modules importable (they use flat imports).
+    """
+    if DATA_HANDLING_PATH not in sys.path:
+        sys.path.append(DATA_HANDLING_PATH)
+    try:
+        import cache  # noqa: F401, also needs pandas and pyarrow
+    except ImportError as e:
+        raise PlateDataUnavailable(f'Plate references are not available on this server ({e}), send the images instead')
+
+
+def check_plate(plate_number, channels):
+    """
+    Refuse plates and channels the pipeline does not know, before any path is built from them.
+    """
+    import_data_handling()
+    from params import LOCAL_DATA_PATH, PLATES
+    from picture_paths import CHANNEL_FOLDERS
+
+    plate = str(plate_number)
+    # Plate numbers are digits only, so they can never walk out of LOCAL_DATA_PATH
+    known = plate in {str(p) for p in PLATES} or (plate.isdigit() and Path(LOCAL_DATA_PATH).joinpath(plate).is_dir())
+    if not known:
+        raise PayloadError(f'Unknown plate {plate_number!r}, use one of {PLATES} or a local plate')
+    if isinstance(channels, str) or not channels or set(channels) - set(CHANNEL_FOLDERS):
+        raise PayloadError(f'Invalid channels {channels!r}, use some of {list(CHANNEL_FOLDERS)}')
+
+
+def array_chunks(images, batch_size=BULK_BATCH_SIZE):
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        yield [{'index': start + i} for i in range(len(batch))], np.asarray(batch)
+
+
+def file_chunks(files, batch_size=BULK_BATCH_SIZE, size=INPUT_SIZE):
+    """
+    files is a list of (file name, bytes).
+    """
+    for start in range(0, len(files), batch_size):
+        chunk = files[start:start + batch_size]
+        ids = [{'index': start + i, 'file': name} for i, (name, _) in enumerate(chunk)]
+        yield ids, np.stack([decode_image_file(body, size) for _, body in chunk])
+
+
+def plate_chunks(plate_number, channels, batch_size=BULK_BATCH_SIZE, limit=None, size=INPUT_SIZE, workers=8):
+    """
+    Pictures of a plate with their ImageID / Well / PhotoNumber, one channel (n, h, w) or a stack (n, h, w, c).
+    """
+    import_data_handling()
+    from cache import processed_path, read_table
+    from image_store import INDEX_COLUMNS, ImageStore, load_picture, local_picture_paths, stack_pictures, store_paths
+
+    key = channels[0] if len(channels) == 1 else list(channels)
+    executor = None
+    if store_paths(plate_number, key, size)[0].is_file():
+        store = ImageStore(plate_number, key, size)
+        index = store.index
+
+        def load(start, end):
+            return np.asarray(store.images[start:end])
+    else:
+        rows = read_table(processed_path(plate_number, 'small'))
+        index = rows[[col for col in INDEX_COLUMNS if col in rows.columns]]
+        paths = [local_picture_paths(rows, plate_number, channel).tolist() for channel in channels]
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+        def load(start, end):
+            if len(channels) == 1:
+                return np.stack(list(executor.map(lambda path: load_picture(path, size), paths[0][start:end])))
+            stacks = np.empty((end - start, size[1], size[0], len(channels)), dtype=np.uint16)
+            for i in range(start, end):
+                stack_pictures([channel_paths[i] for channel_paths in paths], size, workers, out=stacks[i - start])
+            return stacks
+
+    n = len(index) if limit is None else min(limit, len(index))
+    try:
+        for start in range(0, n, batch_size):
+            end = min(start + batch_size, n)
+            yield index.iloc[start:end].to_dict('records'), load(start, end)
+    finally:
+        # Also run when stream_predictions closes the generator early, e.g. the client went away
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+async def read_bulk(request, batch_size=BULK_BATCH_SIZE):
+    """
+    Iterator of (ids, batch of images) chunks for the body of the request.
+    """
+    content_type = request.headers.get('content-type', 'application/json').split(';')[0].strip().lower()
+
+    if content_type == 'multipart/form-data':
+        form = await request.form()
+        files = [(upload.filename, await upload.read()) for upload in form.getlist('files') if not isinstance(upload, str)]
+        if not files:
+            raise PayloadError("multipart payload needs one or more 'files' fields")
+        return file_chunks(files, batch_size)
+
+    body = await request.body()
+    if content_type == 'application/x-npy':
+        return array_chunks(decode_npy(body), batch_size)
+
+    try:
+        payload = json.loads(body)
+    except ValueError as e:
+        raise PayloadError(f'Invalid JSON: {e}')
+    if not isinstance(payload, dict):
+        raise PayloadError(f'JSON payload must be an object, got {type(payload).__name__}')
+    if 'plate' in payload:
+        channels = payload.get('channels', ['Hoechst'])
+        check_plate(payload['plate'], channels)
+        return plate_chunks(str(payload['plate']), channels, batch_size, payload.get('limit'))
+    if 'images' in payload:
+        try:
+            images = [decode_raw(base64.b64decode(image['data'], validate=True), image.get('dtype'), image.get('shape')) for image in payload['images']]
+        except PayloadError:
+            raise
+        except (KeyError, TypeError, AttributeError, binascii.Error, ValueError) as e:
+            raise PayloadError(f"'images' must be a list of {{\"data\": base64, \"dtype\": ..., \"shape\": [...]}}: {e!r}")
+        return array_chunks(images, batch_size)
+    return array_chunks([decode_json(body)], batch_size)
+
+
+async def stream_predictions(chunks, models):
+    """
+    NDJSON lines of the predictions of every image of chunks.
+    models maps an output name to (registry entry of the model, scale the images are divided by or None).
+    """
+    loop = asyncio.get_running_loop()
+    chunks = iter(chunks)
+    # Decode the next chunk while the models run on the current one
+    next_chunk = loop.run_in_executor(None, next, chunks, None)
+    try:
+        while True:
+            chunk = await next_chunk
+            if chunk is None:
+                break
+            next_chunk = loop.run_in_executor(None, next, chunks, None)
+
+            ids, batch = chunk
+            outputs = {}
+            for name, (entry, scale) in models.items():
+                inputs = batch / scale if scale else batch
+                outputs[name] = (await entry.predict_batch(inputs)).reshape(len(batch), -1)[:, 0]
+
+            lines = []
+            for i, image_ids in enumerate(ids):
+                lines.append(json.dumps({**image_ids, **{name: float(values[i]) for name, values in outputs.items()}}))
+            yield '\n'.join(lines) + '\n'
+    except Exception as e:
+        yield json.dumps({'error': repr(e)}) + '\n'
+    finally:
+        # Close the chunks now rather than on garbage collection, so a plate's loader pool and
+        # files are released as soon as the stream ends. A chunk still being read must finish first.
+        if not next_chunk.done():
+            await asyncio.wait([next_chunk])
+        if hasattr(chunks, 'close'):
+            chunks.close()
@@ -0,0 +1,82 @@
+"""
+Convert a trained Keras model (counter / area) to TFLite, with optional quantization.
+
+    python export_tflite.py final_counter_model.keras
+    python export_tflite.py final_area_model.keras --quantization float16
+    python export_tflite.py final_area_model.keras --quantization int8 --samples area_samples.npy
+    python export_tflite.py final_counter_model.keras --quantization int8 --max-value 65535
+
+int8 quantization calibrates the value ranges on representative inputs: --samples is a .npy of
+images preprocessed as the API does before predict (e.g. /65535 for the area model). Without it,
+random inputs in [0, --max-value] are used, which gives a less accurate model. --max-value is then
+required, as it depends on the model: 1 for the area model, 65535 for the counter model (raw uint16).
+"""
+import argparse
+from pathlib import Path
+import numpy as np
+
+QUANTIZATIONS = (None, 'float16', 'int8')
+
+
+def representative_dataset(samples, input_shape, n_samples=100, max_value=None):
+    """
+    Generator of single input batches for the int8 calibration.
+    """
+    def generator():
+        if samples is not None:
+            for sample in samples[:n_samples]:
+                yield [np.asarray(sample, dtype=np.float32).reshape((1,) + tuple(input_shape[1:]))]
+        else:
+            rng = np.random.default_rng(0)
+            for _ in range(n_samples):
+                yield [rng.uniform(0, max_value, (1,) + tuple(input_shape[1:])).astype(np.float32)]
+    return generator
+
+
+def export_tflite(keras_path, tflite_path=None, quantization=None, samples=None, max_value=None):
+    """
+    Write the TFLite version of the Keras model and return its path.
+    """
+    import tensorflow as tf
+
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f'quantization must be one of {QUANTIZATIONS}')
+    if quantization == 'int8' and samples is None and max_value is None:
+        raise ValueError('int8 quantization needs samples or the max_value of the random calibration inputs')
+
+    model = tf.keras.models.load_model(keras_path)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        # Full integer model: weights, activations, inputs and outputs in int8
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset(samples, model.input_shape, max_value=max_value)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+
+    if tflite_path is None:
+        suffix = f'_{quantization}' if quantization else ''
+        tflite_path = Path(keras_path).with_name(f'{Path(keras_path).stem}{suffix}.tflite')
+
+    with open(tflite_path, 'wb') as f:
+        f.write(converter.convert())
+    print(f'✅ {keras_path} exported to {tflite_path}')
+    return tflite_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('keras_path')
+    parser.add_argument('--output')
+    parser.add_argument('--quantization', choices=['float16', 'int8'])
+    parser.add_argument('--samples', help='.npy of representative preprocessed inputs for int8')
+    parser.add_argument('--max-value', type=float, help='range of the random calibration inputs, required for int8 without --samples')
+    args = parser.parse_args()
+    if args.quantization == 'int8' and args.samples is None and args.max_value is None:
+        parser.error('--quantization int8 needs --samples or --max-value (1 for the area model, 65535 for the counter model)')
+
+    samples = np.load(args.samples, mmap_mode='r') if args.samples else None
+    export_tflite(args.keras_path, args.output, args.quantization, samples, args.max_value)
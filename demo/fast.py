@@ -1,14 +1,22 @@
 import numpy as np
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from fastapi.responses import JSONResponse
-from tensorflow.keras import models
+from fastapi.responses import JSONResponse, StreamingResponse
+from payloads import PayloadError, read_image
+from bulk import PlateDataUnavailable, read_bulk, stream_predictions
+from tiling import predict_tiled, read_large_image
+from registry import ModelRegistry, ModelUnavailable
+from prediction_cache import cache_from_env
 
 
 app = FastAPI()
-app.state.model_counter = models.load_model('final_counter_model.keras')
-app.state.model_area = models.load_model('final_area_model.keras')
+# Models are loaded in the background and warmed up, see registry.py.
+# Each one batches its concurrent requests off the event loop, see batching.py,
+# and repeated images are answered from the prediction cache, see prediction_cache.py
+app.state.cache = cache_from_env()
+app.state.registry = ModelRegistry(cache=app.state.cache)
+app.state.registry.register_from_env(defaults={'counter': {'1': 'final_counter_model.keras'},
+                                               'area': {'1': 'final_area_model.keras'}})
 
 # Allowing all middleware is optional, but good practice for dev purposes
 app.add_middleware(
@@ -27,23 +35,101 @@ def root():
     }
 
     return response
-class ImageData(BaseModel):
-    image_np: list
 
-@app.post("/predict_number")
-async def predict_number(image_data: ImageData):
-    image_np = np.array(image_data.image_np)
 
-    img_array_expanded = np.expand_dims(image_np, axis=0)
-    print(img_array_expanded.shape)
-    predictions = float(app.state.model_counter.predict(img_array_expanded))
+@app.on_event("startup")
+async def load_models():
+    app.state.registry.load_all_in_background()
+    if app.state.cache is not None:
+        app.state.cache.start()
+
+
+@app.on_event("shutdown")
+async def stop_batchers():
+    await app.state.registry.close()
+
+
+@app.get("/ready")
+def ready():
+    status_code = 200 if app.state.registry.is_ready() else 503
+    return JSONResponse(status_code=status_code, content=app.state.registry.describe())
+
+
+@app.get("/batching")
+def batching_stats():
+    return app.state.registry.batching_stats()
+
+
+@app.get("/cache")
+def cache_stats():
+    return app.state.cache.stats() if app.state.cache is not None else {'enabled': False}
+
+
+@app.exception_handler(ModelUnavailable)
+async def model_unavailable(request, exc):
+    return JSONResponse(status_code=503, content={'detail': str(exc)})
+
+
+@app.exception_handler(PayloadError)
+async def payload_error(request, exc):
+    return JSONResponse(status_code=400, content={'detail': str(exc)})
+
+
+@app.exception_handler(PlateDataUnavailable)
+async def plate_data_unavailable(request, exc):
+    return JSONResponse(status_code=501, content={'detail': str(exc)})
+
+
+# The image can be sent as .npy, raw bytes, base64, a TIFF/PNG file or the legacy
+# {"image_np": nested lists} JSON, see payloads.py
+@app.post("/predict_number")
+async def predict_number(request: Request, version: str = None):
+    image_np = await read_image(request)
+    predictions = float(np.squeeze(await app.state.registry.predict('counter', image_np, version)))
     return JSONResponse(content={"predictions": predictions})
 
 
 @app.post('/predict_area')
-async def predict_area(image_tensor: ImageData):
-    image_tensor = np.array(image_tensor.image_np)
+async def predict_area(request: Request, version: str = None):
+    image_tensor = await read_image(request)
     image_tensor = image_tensor/65535
-    img_array_expanded = np.expand_dims(image_tensor, axis=0)
-    predictions = float(app.state.model_area.predict(img_array_expanded))
+    predictions = float(np.squeeze(await app.state.registry.predict('area', image_tensor, version)))
     return JSONResponse(content={"predictions_area": predictions})
+
+
+# Outputs of the bulk and tiled endpoints: model, scale of the inputs and reduction over tiles (see tiling.py)
+MODEL_OUTPUTS = {'number': ('counter', None, 'sum'),
+                 'area': ('area', 65535, 'mean')}
+
+
+async def selected_models(models):
+    names = [name.strip() for name in models.split(',')]
+    unknown = set(names) - set(MODEL_OUTPUTS)
+    if unknown:
+        raise PayloadError(f'Unknown models {sorted(unknown)}, use some of {list(MODEL_OUTPUTS)}')
+    selected = {}
+    for name in names:
+        model_name, scale, reduction = MODEL_OUTPUTS[name]
+        selected[name] = (await app.state.registry.get(model_name), scale, reduction)
+    return selected
+
+
+# Many images, or a plate reference, scored in large batches and streamed back as NDJSON, see bulk.py
+@app.post('/predict_bulk')
+async def predict_bulk(request: Request, models: str = 'number,area'):
+    selected = await selected_models(models)
+    chunks = await read_bulk(request)
+    outputs = {name: (entry, scale) for name, (entry, scale, _) in selected.items()}
+    return StreamingResponse(stream_predictions(chunks, outputs), media_type='application/x-ndjson')
+
+
+# Full resolution image or stitched well, scored tile by tile, see tiling.py
+@app.post('/predict_tiled')
+async def predict_tiled_image(request: Request, models: str = 'number,area', overlap: int = 32, batch_size: int = 64):
+    selected = await selected_models(models)
+    image = await read_large_image(request)
+    try:
+        result = await predict_tiled(image, selected, overlap=overlap, batch_size=batch_size)
+    except ValueError as e:
+        raise PayloadError(str(e))
+    return JSONResponse(content=result)
@@ -1,13 +1,20 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 import uvicorn
-from PIL import Image
-from tensorflow.keras.models import load_model as tf_load_model
-from tensorflow.keras.utils import load_img, img_to_array
 import numpy as np
-from pydantic import BaseModel
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from payloads import PayloadError, read_image
+from bulk import PlateDataUnavailable, read_bulk, stream_predictions
+from tiling import predict_tiled, read_large_image
+from registry import ModelRegistry, ModelUnavailable
+from prediction_cache import cache_from_env
 
 app = FastAPI()
+# Models are loaded in the background and warmed up, see registry.py.
+# Each one batches its concurrent requests off the event loop, see batching.py,
+# and repeated images are answered from the prediction cache, see prediction_cache.py
+app.state.cache = cache_from_env()
+app.state.registry = ModelRegistry(cache=app.state.cache)
+app.state.registry.register_from_env(defaults={'model': {'1': 'model_3plate_ERSyto_ERSytobleed_Phgolgi_2024_03_13.keras'}})
 
 # Define a root `/` endpoint
 @app.get('/')
@@ -15,29 +22,77 @@ def index():
     return {'greeting': 'Nice to see you, Boss!'}
 
 @app.on_event("startup")
-def load_model_on_startup():
-    # Use the renamed TensorFlow's load_model function
-    app.state.model = tf_load_model('model_3plate_ERSyto_ERSytobleed_Phgolgi_2024_03_13.keras')
+async def load_model_on_startup():
+    app.state.registry.load_all_in_background()
+    if app.state.cache is not None:
+        app.state.cache.start()
 
+@app.on_event("shutdown")
+async def stop_batcher():
+    await app.state.registry.close()
 
+@app.get('/ready')
+def ready():
+    status_code = 200 if app.state.registry.is_ready() else 503
+    return JSONResponse(status_code=status_code, content=app.state.registry.describe())
 
-class ImageData(BaseModel):
-    image_np: list
+@app.get('/batching')
+def batching_stats():
+    return app.state.registry.batching_stats()
 
-class TensorData(BaseModel):
-    image_tensor: list
+@app.get('/cache')
+def cache_stats():
+    return app.state.cache.stats() if app.state.cache is not None else {'enabled': False}
 
+@app.exception_handler(ModelUnavailable)
+async def model_unavailable(request, exc):
+    return JSONResponse(status_code=503, content={'detail': str(exc)})
+
+
+@app.exception_handler(PayloadError)
+async def payload_error(request, exc):
+    return JSONResponse(status_code=400, content={'detail': str(exc)})
+
+
+@app.exception_handler(PlateDataUnavailable)
+async def plate_data_unavailable(request, exc):
+    return JSONResponse(status_code=501, content={'detail': str(exc)})
+
+
+# The image can be sent as .npy, raw bytes, base64, a TIFF/PNG file or the legacy
+# {"image_np": [...]} / {"image_tensor": [...]} JSON, see payloads.py
 @app.post("/predict_number")
-async def predict_number(image_data: ImageData):
-    image_np = np.array(image_data.image_np)
-    img_array_expanded = np.expand_dims(image_np, axis=0)
-    print(img_array_expanded.shape)
-    predictions = float(app.state.model.predict(img_array_expanded))
+async def predict_number(request: Request, version: str = None):
+    image_np = await read_image(request)
+    predictions = float(np.squeeze(await app.state.registry.predict('model', image_np, version)))
     return JSONResponse(content={"predictions_number": predictions})
 
 @app.post('/predict_area')
-async def predict_area(tensor_data: TensorData):
-        image_tensor = np.array(tensor_data.image_tensor)
-        print(image_tensor.shape)
-        predictions = float(app.state.model.predict(image_tensor))
+async def predict_area(request: Request, version: str = None):
+        image_tensor = await read_image(request)
+        if image_tensor.ndim < 3 or image_tensor.shape[0] != 1:
+            raise PayloadError(f'predict_area takes one image with its batch dimension, e.g. (1, 224, 224, 3), got {image_tensor.shape}')
+        # The tensor already has its batch dimension, each of its images is scheduled
+        entry = await app.state.registry.get('model', version)
+        predictions = float(np.squeeze(await entry.predict_batch(image_tensor)))
         return JSONResponse(content={"predictions_area": predictions})
+
+
+# Many images, or a plate reference, scored in large batches and streamed back as NDJSON, see bulk.py
+@app.post('/predict_bulk')
+async def predict_bulk(request: Request, version: str = None):
+        chunks = await read_bulk(request)
+        models = {'prediction': (await app.state.registry.get('model', version), None)}
+        return StreamingResponse(stream_predictions(chunks, models), media_type='application/x-ndjson')
+
+
+# Full resolution image or stitched well, scored tile by tile, see tiling.py
+@app.post('/predict_tiled')
+async def predict_tiled_image(request: Request, version: str = None, reduction: str = 'mean', overlap: int = 32, batch_size: int = 64):
+        image = await read_large_image(request)
+        models = {'prediction': (await app.state.registry.get('model', version), None, reduction)}
+        try:
+            result = await predict_tiled(image, models, overlap=overlap, batch_size=batch_size)
+        except ValueError as e:
+            raise PayloadError(str(e))
+        return JSONResponse(content=result)
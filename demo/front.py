@@ -3,7 +3,9 @@ import numpy as np
 import requests
 from PIL import Image
 import base64
+import io
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 st.set_page_config(page_title='Morpho Minds',
@@ -88,34 +90,43 @@ h2, h3, h4, h5, h6, p {
 # Function to convert image to numpy array and resize it
 def process_single_image(image):
     image = image.resize((224, 224))  # Resize image to required size
-    image_np = np.array(image)
-    return image_np.tolist()
+    return np.asarray(image)
+
+def load_channel(file):
+    with Image.open(file) as img:
+        return np.asarray(img.resize((224, 224)))  # Resize image as per your requirement
 
 def process_multi_images(files):
-    preprocessed_images = []
-    for file in files:
-        img = Image.open(file)
-        img = img.resize((224, 224))  # Resize image as per your requirement
-        img_array = np.array(img)
-        preprocessed_images.append(img_array)
-    final = np.dstack(preprocessed_images)
-    print(final.shape)
-    return final.tolist()
+    """Decodes the channels in parallel and stacks them into a (224, 224, n_channels) array.
+    Raises ValueError if the channels do not all have the same dtype."""
+    with ThreadPoolExecutor(max_workers=len(files)) as executor:
+        channels = list(executor.map(load_channel, files))
+    dtypes = {file.name: str(channel.dtype) for file, channel in zip(files, channels)}
+    if len(set(dtypes.values())) > 1:
+        raise ValueError(f'All channels must have the same type, got {dtypes}')
+    return np.stack(channels, axis=-1)
+
+
+def npy_payload(image_np):
+    """Serializes an array as .npy bytes, much smaller and faster to parse than a JSON list."""
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(image_np), allow_pickle=False)
+    return buffer.getvalue()
 
 
 # Function to send image to FastAPI for processing
 def predict_image_cell_number(image_np):
 
     url = 'https://morpho-minds-predictor-api-s6ijqaeqvq-ey.a.run.app/predict_number'
-    payload = {"image_np": image_np}
-    response = requests.post(url, json=payload)
+    headers = {'Content-Type': 'application/x-npy'}
+    response = requests.post(url, data=npy_payload(image_np), headers=headers)
     predictions_number = response.json()["predictions"]
     return predictions_number
 
 def predict_image_area(image_tensor):
     url = 'https://morpho-minds-predictor-api-s6ijqaeqvq-ey.a.run.app/predict_area'
-    payload = {"image_np": image_tensor}
-    response = requests.post(url, json=payload)
+    headers = {'Content-Type': 'application/x-npy'}
+    response = requests.post(url, data=npy_payload(image_tensor), headers=headers)
     predictions_area = response.json()["predictions_area"]
     return predictions_area
 
@@ -157,8 +168,12 @@ if files:
 
     else:
         if st.button("Predict Area"):
-            img_array = process_multi_images(files)
-            with st.spinner('Wait for it...'):
-                predictions = predict_image_area(img_array)
-            st.balloons()
-            st.write(f'<p class="big-font">Predicted Mean Area: {round(float(predictions), 2)} square pixels</p>', unsafe_allow_html=True)
+            try:
+                img_array = process_multi_images(files)
+            except ValueError as e:
+                st.error(str(e))
+            else:
+                with st.spinner('Wait for it...'):
+                    predictions = predict_image_area(img_array)
+                st.balloons()
+                st.write(f'<p class="big-font">Predicted Mean Area: {round(float(predictions), 2)} square pixels</p>', unsafe_allow_html=True)
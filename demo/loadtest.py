@@ -0,0 +1,311 @@
+"""
+Load test of the prediction API: latency, throughput and errors of /predict_number and /predict_area
+for every payload format and concurrency, written as a JSON report so serving changes can be compared.
+
+    python loadtest.py --serve fast --concurrency 1,8,32 --duration 10 --output report.json
+    python loadtest.py --serve fastapi_area --shape predict_area=1,224,224,3
+    python loadtest.py --url https://<cloud run service> --app fastapi_area --formats npy --concurrency 1,16,64
+
+--serve starts the app (fast or fastapi_area) with uvicorn on a free port and the stand-in models of
+registry.py (STANDIN_MODELS=1), so the test runs offline and measures the serving code only. The
+prediction cache is disabled unless --cache, as the same images are sent again and again. --url
+targets a running service instead, --app tells which app it serves. The images have the shape
+each endpoint of the app expects (APP_SHAPES), or the one given with --shape.
+
+Every concurrency level is a closed loop: that many clients, each on its own keep-alive connection,
+send the next request as soon as the previous one is answered, for --duration seconds after a
+--warmup that is not measured. The HTTP client is plain asyncio, without dependencies.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import time
+import urllib.parse
+from datetime import datetime, timezone
+from pathlib import Path
+import numpy as np
+from payloads import encode_base64, encode_npy, encode_raw
+
+ENDPOINTS = ('predict_number', 'predict_area')
+FORMATS = ('npy', 'raw', 'base64', 'json')
+DEFAULT_SHAPE = (224, 224)
+# Shapes differing from DEFAULT_SHAPE: /predict_area of fastapi_area.py takes a batch of one image
+APP_SHAPES = {'fast': {}, 'fastapi_area': {'predict_area': (1, 224, 224)}}
+# Upper bounds of the latency histogram buckets, in ms
+HISTOGRAM_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+def encode(image, payload_format):
+    """
+    Body and headers of a request sending image in one of FORMATS.
+    """
+    if payload_format == 'npy':
+        return encode_npy(image)
+    if payload_format == 'raw':
+        return encode_raw(image)
+    if payload_format == 'base64':
+        return json.dumps(encode_base64(image)).encode(), {'Content-Type': 'application/json'}
+    if payload_format == 'json':
+        return json.dumps({'image_np': image.tolist()}).encode(), {'Content-Type': 'application/json'}
+    raise ValueError(f'Unknown format {payload_format!r}, use one of {FORMATS}')
+
+
+def request_bodies(shape, payload_format, distinct, seed=0):
+    rng = np.random.default_rng(seed)
+    return [encode(rng.integers(0, 65535, shape, dtype=np.uint16), payload_format) for _ in range(distinct)]
+
+
+class Connection:
+    """
+    Keep-alive HTTP/1.1 connection, reopened when the server closes it.
+    """
+    def __init__(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.ssl = ssl.create_default_context() if parsed.scheme == 'https' else None
+        self.port = parsed.port or (443 if self.ssl else 80)
+        self.base_path = parsed.path.rstrip('/')
+        self.reader = None
+        self.writer = None
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def request(self, method, path, body=b'', headers=None):
+        """
+        (status, body) of the response.
+        """
+        if self.writer is None:
+            await self.open()
+        lines = [f'{method} {self.base_path}{path} HTTP/1.1', f'Host: {self.host}', f'Content-Length: {len(body)}']
+        lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        try:
+            self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+            await self.writer.drain()
+            return await self.read_response()
+        except Exception:
+            self.close()
+            raise
+
+    async def read_response(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError('Connection closed by the server')
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                body += chunk[:-2]
+        else:
+            body = await self.reader.readexactly(int(headers.get('content-length', 0)))
+
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, body
+
+
+def summarize(latencies, errors, elapsed):
+    """
+    Report of one run: latencies in seconds of the successful requests, errors {kind: count}.
+    """
+    latencies = np.array(latencies) * 1000
+    n_errors = sum(errors.values())
+    total = len(latencies) + n_errors
+    report = {'requests': total, 'ok': len(latencies), 'errors': errors,
+              'error_rate': round(n_errors / total, 4) if total else 0.0,
+              'duration_s': round(elapsed, 3),
+              'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0}
+    if len(latencies):
+        report['latency_ms'] = {'mean': round(float(latencies.mean()), 3),
+                                **{f'p{q}': round(float(np.percentile(latencies, q)), 3) for q in (50, 90, 99)},
+                                'max': round(float(latencies.max()), 3)}
+        counts = np.bincount(np.searchsorted(HISTOGRAM_MS, latencies), minlength=len(HISTOGRAM_MS) + 1)
+        report['histogram_ms'] = {**{f'<={bound}': int(count) for bound, count in zip(HISTOGRAM_MS, counts)},
+                                  f'>{HISTOGRAM_MS[-1]}': int(counts[-1])}
+    return report
+
+
+async def run_level(url, path, bodies, concurrency, duration, warmup):
+    """
+    concurrency clients sending bodies (cycled) to path for warmup + duration seconds.
+    """
+    latencies = []
+    errors = {}
+    start = time.perf_counter()
+    measure_from = start + warmup
+    deadline = measure_from + duration
+
+    async def client(i):
+        connection = Connection(url)
+        n = i
+        try:
+            while time.perf_counter() < deadline:
+                body, headers = bodies[n % len(bodies)]
+                n += concurrency
+                sent = time.perf_counter()
+                try:
+                    status, _ = await connection.request('POST', path, body, headers)
+                    kind = None if status == 200 else str(status)
+                except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                    kind = type(e).__name__
+                done = time.perf_counter()
+                if sent < measure_from:
+                    continue
+                if kind is None:
+                    latencies.append(done - sent)
+                else:
+                    errors[kind] = errors.get(kind, 0) + 1
+        finally:
+            connection.close()
+
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - measure_from)
+
+
+async def get_json(url, path):
+    connection = Connection(url)
+    try:
+        status, body = await connection.request('GET', path)
+        return status, json.loads(body or b'null')
+    finally:
+        connection.close()
+
+
+async def wait_ready(url, timeout):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            status, _ = await get_json(url, '/ready')
+            if status == 200:
+                return
+        except (OSError, ValueError):
+            pass
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f'{url} not ready after {timeout}s')
+        await asyncio.sleep(0.2)
+
+
+async def load_test(url, endpoints=ENDPOINTS, formats=FORMATS, concurrency=(1, 8, 32), duration=10.0, warmup=1.0,
+                    shapes=None, distinct=64, ready_timeout=120.0):
+    await wait_ready(url, ready_timeout)
+    runs = []
+    for endpoint in endpoints:
+        shape = (shapes or {}).get(endpoint, DEFAULT_SHAPE)
+        for payload_format in formats:
+            bodies = request_bodies(shape, payload_format, distinct)
+            for level in concurrency:
+                report = await run_level(url, f'/{endpoint}', bodies, level, duration, warmup)
+                runs.append({'endpoint': endpoint, 'format': payload_format, 'shape': list(shape),
+                             'body_bytes': len(bodies[0][0]), 'concurrency': level, **report})
+                latency = report.get('latency_ms', {})
+                print(f'{endpoint:<16}{payload_format:<8}c={level:<5}{report["throughput_rps"]:>9.1f} req/s  '
+                      f'p50 {latency.get("p50", float("nan")):>8.2f} ms  p99 {latency.get("p99", float("nan")):>8.2f} ms  '
+                      f'errors {report["error_rate"]:.2%}')
+
+    server = {}
+    for path in ('/ready', '/batching', '/cache'):
+        try:
+            server[path.strip('/')] = (await get_json(url, path))[1]
+        except (OSError, ValueError):
+            pass
+    return {'url': url, 'started': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'settings': {'duration_s': duration, 'warmup_s': warmup, 'distinct_images': distinct},
+            'runs': runs, 'server': server}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(app_module, cache=False, env=None):
+    """
+    Start app_module:app with uvicorn and the stand-in models. Returns (process, url).
+    """
+    port = free_port()
+    env = {**os.environ, 'STANDIN_MODELS': '1', **(env or {})}
+    if not cache:
+        env['PREDICTION_CACHE_SIZE'] = '0'
+    process = subprocess.Popen([sys.executable, '-m', 'uvicorn', f'{app_module}:app', '--host', '127.0.0.1',
+                                '--port', str(port), '--log-level', 'warning', '--no-access-log'],
+                               cwd=Path(__file__).resolve().parent, env=env)
+    return process, f'http://127.0.0.1:{port}'
+
+
+def parse_shapes(values):
+    shapes = {}
+    for value in values or []:
+        endpoint, _, shape = value.partition('=')
+        if endpoint not in ENDPOINTS:
+            raise ValueError(f'Unknown endpoint {endpoint!r}, use one of {ENDPOINTS}')
+        shapes[endpoint] = tuple(int(dim) for dim in shape.split(','))
+    return shapes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--serve', choices=['fast', 'fastapi_area'], help='start this app with the stand-in models')
+    target.add_argument('--url', help='base URL of a running service')
+    parser.add_argument('--app', choices=list(APP_SHAPES), default='fast', help='app served at --url (default fast)')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--formats', default=','.join(FORMATS))
+    parser.add_argument('--concurrency', default='1,8,32')
+    parser.add_argument('--duration', type=float, default=10.0, help='measured seconds per run')
+    parser.add_argument('--warmup', type=float, default=1.0, help='seconds per run before measuring')
+    parser.add_argument('--shape', action='append', help='image shape of an endpoint, e.g. predict_area=1,224,224,3 (default from APP_SHAPES)')
+    parser.add_argument('--distinct', type=int, default=64, help='number of different images sent')
+    parser.add_argument('--cache', action='store_true', help='keep the prediction cache of the served app')
+    parser.add_argument('--output', help='also write the report to this JSON file')
+    args = parser.parse_args()
+
+    endpoints, formats = args.endpoints.split(','), args.formats.split(',')
+    for name, values, allowed in (('endpoints', endpoints, ENDPOINTS), ('formats', formats, FORMATS)):
+        if set(values) - set(allowed):
+            parser.error(f'Unknown {name} {sorted(set(values) - set(allowed))}, use some of {list(allowed)}')
+
+    app = args.serve or args.app
+    shapes = {**APP_SHAPES[app], **parse_shapes(args.shape)}
+    process = None
+    url = args.url
+    if args.serve:
+        process, url = serve(args.serve, args.cache)
+    try:
+        report = asyncio.run(load_test(url, endpoints, formats, [int(level) for level in args.concurrency.split(',')],
+                                       args.duration, args.warmup, shapes, args.distinct))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report['app'] = app
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'✅ Report saved to {args.output}')
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,147 @@
+"""
+Decoding of the image payloads accepted by the prediction API.
+
+The Content-Type of the request picks the format:
+
+    application/x-npy         bytes of np.save(array)
+    application/octet-stream  raw array bytes, with the X-Dtype (e.g. uint16) and X-Shape (e.g. 224,224) headers
+    image/tiff, image/png     an image file, resized to the model input size
+    multipart/form-data       an image file uploaded in the `file` field
+    application/json          {"data": base64 of the raw bytes, "dtype": "uint16", "shape": [224, 224]}
+                              or the legacy {"image_np": nested lists}
+
+Binary formats are read with np.frombuffer / np.load, without copying the bytes number by number.
+"""
+import base64
+import io
+import json
+import numpy as np
+from PIL import Image
+
+INPUT_SIZE = (224, 224)
+DTYPES = {'uint8', 'uint16', 'int16', 'int32', 'int64', 'float16', 'float32', 'float64'}
+LEGACY_KEYS = ('image_np', 'image_tensor')
+
+
+class PayloadError(ValueError):
+    pass
+
+
+def check_dtype(dtype):
+    if dtype not in DTYPES:
+        raise PayloadError(f'Unsupported dtype {dtype!r}, use one of {sorted(DTYPES)}')
+    return np.dtype(dtype)
+
+
+def parse_shape(shape):
+    if isinstance(shape, str):
+        shape = shape.split(',')
+    try:
+        return tuple(int(dim) for dim in shape)
+    except (TypeError, ValueError):
+        raise PayloadError(f'Invalid shape {shape!r}')
+
+
+def decode_raw(body, dtype, shape):
+    """
+    Array viewing the raw bytes, no copy.
+    """
+    dtype, shape = check_dtype(dtype), parse_shape(shape)
+    if len(body) != dtype.itemsize * int(np.prod(shape)):
+        raise PayloadError(f'{len(body)} bytes do not match shape {shape} of {dtype}')
+    return np.frombuffer(body, dtype=dtype).reshape(shape)
+
+
+def decode_npy(body):
+    try:
+        array = np.load(io.BytesIO(body), allow_pickle=False)
+    except ValueError as e:
+        raise PayloadError(f'Invalid .npy payload: {e}')
+    check_dtype(array.dtype.name)
+    return array
+
+
+def decode_image_file(body, size=INPUT_SIZE):
+    """
+    Image file (TIFF, PNG...) as an array, resized to size like the Streamlit client does.
+    """
+    try:
+        with Image.open(io.BytesIO(body)) as img:
+            if size is not None and img.size != size:
+                img = img.resize(size)
+            return np.asarray(img)
+    except OSError as e:
+        raise PayloadError(f'Invalid image file: {e}')
+
+
+def decode_json(body):
+    try:
+        payload = json.loads(body)
+    except ValueError as e:
+        raise PayloadError(f'Invalid JSON: {e}')
+    if not isinstance(payload, dict):
+        raise PayloadError(f'JSON payload must be an object, got {type(payload).__name__}')
+
+    if 'data' in payload:
+        try:
+            data = base64.b64decode(payload['data'], validate=True)
+        except ValueError as e:
+            raise PayloadError(f'Invalid base64 data: {e}')
+        return decode_raw(data, payload.get('dtype'), payload.get('shape'))
+
+    for key in LEGACY_KEYS:
+        if key in payload:
+            return np.array(payload[key])
+    raise PayloadError(f"JSON payload needs a 'data' or one of {list(LEGACY_KEYS)} keys")
+
+
+async def read_image(request, size=INPUT_SIZE):
+    """
+    Array sent in the body of a FastAPI / Starlette request, whatever its format.
+    Raises PayloadError if the payload cannot be decoded.
+    """
+    content_type = request.headers.get('content-type', 'application/json').split(';')[0].strip().lower()
+
+    if content_type == 'multipart/form-data':
+        form = await request.form()
+        upload = form.get('file')
+        if upload is None or isinstance(upload, str):
+            raise PayloadError("multipart payload needs a 'file' field")
+        return decode_image_file(await upload.read(), size)
+
+    body = await request.body()
+    if content_type == 'application/x-npy':
+        return decode_npy(body)
+    if content_type == 'application/octet-stream':
+        return decode_raw(body, request.headers.get('x-dtype'), request.headers.get('x-shape'))
+    if content_type.startswith('image/'):
+        return decode_image_file(body, size)
+    return decode_json(body)
+
+
+def encode_npy(array):
+    """
+    Body and headers to send array as .npy (client side).
+    """
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(array), allow_pickle=False)
+    return buffer.getvalue(), {'Content-Type': 'application/x-npy'}
+
+
+def encode_raw(array):
+    """
+    Body and headers to send array as raw bytes (client side).
+    """
+    array = np.ascontiguousarray(array)
+    headers = {'Content-Type': 'application/octet-stream',
+               'X-Dtype': array.dtype.name,
+               'X-Shape': ','.join(str(dim) for dim in array.shape)}
+    return array.tobytes(), headers
+
+
+def encode_base64(array):
+    """
+    JSON payload carrying array as base64 (client side).
+    """
+    array = np.ascontiguousarray(array)
+    return {'data': base64.b64encode(array.tobytes()).decode('ascii'), 'dtype': array.dtype.name, 'shape': list(array.shape)}
@@ -0,0 +1,192 @@
+"""
+Cache of predictions keyed by a hash of the decoded image and the model version.
+
+A resubmitted picture is answered from memory without running the model. The memory tier is an
+LRU of at most max_entries predictions. The optional disk tier (a SQLite file) keeps them across
+restarts and rescoring runs. Every disk read and write runs on one thread of its own, so the event
+loop never waits for SQLite, and writes are committed in batches rather than on every put: after
+PREDICTION_CACHE_COMMIT puts, and by a task started with the app (start()) that commits what is
+pending every PREDICTION_CACHE_COMMIT_S seconds. Configured with the environment variables:
+
+    PREDICTION_CACHE_SIZE       entries kept in memory (default 10000, 0 disables the cache)
+    PREDICTION_CACHE_PATH       SQLite file of the disk tier (default none)
+    PREDICTION_CACHE_COMMIT     puts per disk commit (default 100)
+    PREDICTION_CACHE_COMMIT_S   seconds between the periodic commits (default 5)
+"""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', 10_000))
+CACHE_PATH = os.environ.get('PREDICTION_CACHE_PATH')
+COMMIT_EVERY = int(os.environ.get('PREDICTION_CACHE_COMMIT', 100))
+COMMIT_INTERVAL_S = float(os.environ.get('PREDICTION_CACHE_COMMIT_S', 5))
+
+
+def image_key(image, model_id):
+    """
+    Hash of the values, type and shape of the image, and of the model it is predicted with.
+    """
+    image = np.ascontiguousarray(image)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f'{model_id}|{image.dtype.str}|{image.shape}|'.encode())
+    digest.update(image.data)
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    def __init__(self, max_entries=CACHE_SIZE, disk_path=CACHE_PATH, commit_every=COMMIT_EVERY, commit_interval_s=COMMIT_INTERVAL_S):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.disk = None
+        self.executor = None
+        self.flusher = None
+        self.commit_every = commit_every
+        self.commit_interval_s = commit_interval_s
+        self.pending = 0
+        if disk_path:
+            # Only ever used from the single thread of self.executor
+            self.disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self.disk.execute('CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, value TEXT)')
+            self.disk.commit()
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        """
+        Start the periodic commits on the running event loop (done on app startup, or by the first get).
+        """
+        if self.disk is not None and (self.flusher is None or self.flusher.done()):
+            self.flusher = asyncio.get_running_loop().create_task(self.flush_periodically())
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.commit_interval_s)
+            await self.flush()
+
+    def remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def read_disk(self, keys):
+        """
+        Disk thread: JSON of the stored predictions of keys, None when missing.
+        Uncommitted rows are visible too, they were written by the same connection.
+        """
+        if self.disk is None:
+            return [None] * len(keys)
+        rows = []
+        for key in keys:
+            row = self.disk.execute('SELECT value FROM predictions WHERE key = ?', (key,)).fetchone()
+            rows.append(None if row is None else row[0])
+        return rows
+
+    def write_disk(self, key, value):
+        """
+        Disk thread: store one prediction, committing once commit_every of them are pending.
+        """
+        if self.disk is None:
+            return
+        self.disk.execute('INSERT OR REPLACE INTO predictions VALUES (?, ?)', (key, json.dumps(value.tolist())))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        if self.disk is not None and self.pending:
+            self.disk.commit()
+            self.pending = 0
+
+    def close_disk(self):
+        self.commit()
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+
+    async def get_many(self, keys):
+        """
+        Cached predictions of keys, None for the missing ones. Keys missing from memory are looked up
+        on disk in a single call on the disk thread.
+        """
+        results = []
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                results.append(self.entries.get(key))
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing and self.disk is not None:
+            self.start()
+            rows = await asyncio.get_running_loop().run_in_executor(self.executor, self.read_disk, [keys[i] for i in missing])
+            with self.lock:
+                for i, row in zip(missing, rows):
+                    if row is not None:
+                        results[i] = np.asarray(json.loads(row))
+                        self.remember(keys[i], results[i])
+                        self.disk_hits += 1
+
+        with self.lock:
+            self.misses += sum(result is None for result in results)
+        return results
+
+    async def get(self, key):
+        """
+        Cached prediction or None.
+        """
+        return (await self.get_many([key]))[0]
+
+    def put(self, key, value):
+        """
+        Remember the prediction. It is written to disk in the background.
+        """
+        value = np.asarray(value)
+        with self.lock:
+            self.remember(key, value)
+        if self.disk is not None:
+            self.executor.submit(self.write_disk, key, value)
+
+    async def flush(self):
+        """
+        Commit the predictions not yet on disk.
+        """
+        if self.disk is not None:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.commit)
+
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            try:
+                await self.flusher
+            except asyncio.CancelledError:
+                pass
+            self.flusher = None
+        if self.executor is not None:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.close_disk)
+            self.executor.shutdown()
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {'entries': len(self.entries), 'max_entries': self.max_entries,
+                'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'evictions': self.evictions, 'disk': self.disk is not None, 'disk_pending': self.pending,
+                'hit_rate': round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0}
+
+
+def cache_from_env():
+    return PredictionCache() if CACHE_SIZE > 0 else None
@@ -0,0 +1,218 @@
+"""
+Registry of the models served by the API.
+
+Models are loaded in background threads when the app starts (or on first use), so the server
+accepts connections right away. Each model runs one warmup prediction on a batch of zeros once
+loaded, so the first real request does not pay the graph tracing. /ready reports when every model is ready.
+
+Several versions of a model can be served at once. The models come from the MODELS environment variable:
+
+    MODELS='{"counter": {"1": "final_counter_model.keras", "2": "counter_v2.keras"}}'
+
+and the last version listed is the default one, used when a request does not ask for a version.
+.keras files are served with Keras, .tflite files (see export_tflite.py) with the TFLite backend.
+With STANDIN_MODELS=1 every model is replaced by a tiny stand-in, to run the API offline (see loadtest.py).
+Predictions go through the prediction cache (see prediction_cache.py) when one is given.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+import numpy as np
+from batching import BatchScheduler
+from prediction_cache import image_key
+
+
+STANDIN_MODELS = os.environ.get('STANDIN_MODELS', '0') == '1'
+STANDIN_LATENCY_MS = float(os.environ.get('STANDIN_LATENCY_MS', 2))
+STANDIN_PER_IMAGE_MS = float(os.environ.get('STANDIN_PER_IMAGE_MS', 0.2))
+
+
+class ModelUnavailable(Exception):
+    pass
+
+
+class StandInModel:
+    """
+    Model without TensorFlow: the mean of each image, after sleeping latency_ms per batch and
+    per_image_ms per image in place of the real compute.
+    """
+    input_shape = (None, 224, 224)
+
+    def __init__(self, path=None, latency_ms=STANDIN_LATENCY_MS, per_image_ms=STANDIN_PER_IMAGE_MS):
+        self.path = path
+        self.latency_ms = latency_ms
+        self.per_image_ms = per_image_ms
+
+    def predict_on_batch(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        delay = self.latency_ms + self.per_image_ms * len(batch)
+        if delay:
+            time.sleep(delay / 1000)
+        return batch.reshape(len(batch), -1).mean(axis=1, keepdims=True)
+
+
+def keras_loader(path):
+    # TensorFlow is imported on first load, not when the app module is imported
+    from tensorflow.keras import models
+    return models.load_model(path)
+
+
+def load_model(path):
+    if STANDIN_MODELS:
+        return StandInModel(path)
+    if str(path).endswith('.tflite'):
+        from tflite_backend import TFLiteModel
+        return TFLiteModel(path)
+    return keras_loader(path)
+
+
+def warmup_batch(model, batch_size=1):
+    """
+    Batch of zeros with the input shape of the model.
+    """
+    shape = tuple(batch_size if dim is None else dim for dim in model.input_shape)
+    return np.zeros(shape, dtype=np.float32)
+
+
+class ModelEntry:
+    def __init__(self, name, version, path, loader, cache=None):
+        self.name = name
+        self.version = version
+        self.path = path
+        self.loader = loader
+        self.cache = cache
+        self.model_id = f'{name}:{version}:{path}'
+        self.status = 'registered'
+        self.error = None
+        self.model = None
+        self.batcher = None
+        self.load_s = None
+        self.warmup_s = None
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def load(self):
+        with self.lock:
+            if self.status != 'registered':
+                return
+            self.status = 'loading'
+        try:
+            start = time.perf_counter()
+            self.model = self.loader(self.path)
+            self.load_s = round(time.perf_counter() - start, 3)
+
+            start = time.perf_counter()
+            self.model.predict_on_batch(warmup_batch(self.model))
+            self.warmup_s = round(time.perf_counter() - start, 3)
+
+            self.batcher = BatchScheduler(self.model.predict_on_batch)
+            self.status = 'ready'
+            print(f'✅ Model {self.name} v{self.version} loaded in {self.load_s}s, warmed up in {self.warmup_s}s')
+        except Exception as e:
+            self.error = repr(e)
+            self.status = 'failed'
+            print(f'Model {self.name} v{self.version} failed to load: {self.error}')
+        finally:
+            self.ready.set()
+
+    def load_in_background(self):
+        threading.Thread(target=self.load, daemon=True).start()
+
+    def describe(self):
+        return {'status': self.status, 'path': self.path, 'load_s': self.load_s,
+                'warmup_s': self.warmup_s, 'error': self.error}
+
+    async def predict(self, image):
+        """
+        Prediction for one image, batched with the concurrent requests unless it is cached.
+        """
+        if self.cache is None:
+            return await self.batcher.predict(image)
+        key = image_key(image, self.model_id)
+        result = await self.cache.get(key)
+        if result is None:
+            result = await self.batcher.predict(image)
+            self.cache.put(key, result)
+        return result
+
+    async def predict_batch(self, batch):
+        """
+        Predictions for a whole batch, only the images missing from the cache are run through the model.
+        """
+        if self.cache is None:
+            return await self.batcher.run_batch(batch)
+        keys = [image_key(image, self.model_id) for image in batch]
+        results = await self.cache.get_many(keys)
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            for i, result in zip(missing, await self.batcher.run_batch(batch[missing])):
+                results[i] = result
+                self.cache.put(keys[i], result)
+        return np.stack(results)
+
+
+class ModelRegistry:
+    def __init__(self, loader=load_model, cache=None):
+        self.loader = loader
+        self.cache = cache
+        self.entries = {}
+        self.defaults = {}
+
+    def register(self, name, path, version='1', default=True):
+        self.entries[(name, str(version))] = ModelEntry(name, str(version), path, self.loader, self.cache)
+        if default or name not in self.defaults:
+            self.defaults[name] = str(version)
+
+    def register_from_env(self, variable='MODELS', defaults=None):
+        """
+        Register the models of the JSON environment variable, or the defaults ({name: {version: path}}).
+        """
+        models = json.loads(os.environ[variable]) if variable in os.environ else defaults or {}
+        for name, versions in models.items():
+            for version, path in versions.items():
+                self.register(name, path, version)
+
+    def entry(self, name, version=None):
+        version = self.defaults.get(name) if version is None else str(version)
+        if (name, version) not in self.entries:
+            raise ModelUnavailable(f'Unknown model {name} v{version}')
+        return self.entries[(name, version)]
+
+    def load_all_in_background(self):
+        for entry in self.entries.values():
+            entry.load_in_background()
+
+    async def get(self, name, version=None):
+        """
+        Ready entry of the model, loading it first if needed. Raises ModelUnavailable if it failed to load.
+        """
+        entry = self.entry(name, version)
+        if not entry.ready.is_set():
+            entry.load_in_background()
+            await asyncio.get_running_loop().run_in_executor(None, entry.ready.wait)
+        if entry.status != 'ready':
+            raise ModelUnavailable(f'Model {name} v{entry.version} failed to load: {entry.error}')
+        return entry
+
+    async def predict(self, name, image, version=None):
+        return await (await self.get(name, version)).predict(image)
+
+    def is_ready(self):
+        return all(entry.status == 'ready' for entry in self.entries.values())
+
+    def describe(self):
+        return {f'{name}:{version}': dict(entry.describe(), default=self.defaults[name] == version)
+                for (name, version), entry in self.entries.items()}
+
+    def batching_stats(self):
+        return {f'{name}:{version}': entry.batcher.stats()
+                for (name, version), entry in self.entries.items() if entry.batcher is not None}
+
+    async def close(self):
+        for entry in self.entries.values():
+            if entry.batcher is not None:
+                await entry.batcher.close()
+        if self.cache is not None:
+            await self.cache.close()
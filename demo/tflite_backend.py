@@ -0,0 +1,67 @@
+"""
+TFLite inference backend, a lightweight alternative to Keras for serving on CPU.
+
+TFLiteModel has the part of the Keras model interface the API uses (input_shape and
+predict_on_batch), so the registry serves a .tflite file exported by export_tflite.py like a
+.keras one. The interpreter comes from tflite_runtime if installed (a few MB, no TensorFlow),
+from TensorFlow otherwise. Integer quantized inputs and outputs are converted from and to float.
+"""
+import os
+import numpy as np
+
+TFLITE_THREADS = int(os.environ.get('TFLITE_THREADS', os.cpu_count() or 1))
+
+
+def load_interpreter(path, num_threads=TFLITE_THREADS):
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        # tf.lite is an attribute of the tensorflow module, not an importable package
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter(model_path=path, num_threads=num_threads)
+
+
+class TFLiteModel:
+    def __init__(self, path, num_threads=TFLITE_THREADS):
+        self.interpreter = load_interpreter(path, num_threads)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = int(self.input['shape'][0])
+
+    @property
+    def input_shape(self):
+        return (None,) + tuple(int(dim) for dim in self.input['shape'][1:])
+
+    def resize(self, batch_size):
+        """
+        Reshape the input to batch_size, the tensors are only reallocated when the batch size changes.
+        """
+        if batch_size != self.batch_size:
+            shape = [batch_size] + list(self.input['shape'][1:])
+            self.interpreter.resize_tensor_input(self.input['index'], shape)
+            self.interpreter.allocate_tensors()
+            self.input = self.interpreter.get_input_details()[0]
+            self.output = self.interpreter.get_output_details()[0]
+            self.batch_size = batch_size
+
+    def predict_on_batch(self, batch):
+        batch = np.asarray(batch)
+        self.resize(len(batch))
+
+        scale, zero_point = self.input['quantization']
+        if np.issubdtype(self.input['dtype'], np.integer) and scale:
+            batch = np.round(batch / scale + zero_point)
+            info = np.iinfo(self.input['dtype'])
+            batch = np.clip(batch, info.min, info.max)
+        batch = batch.astype(self.input['dtype']).reshape(self.input['shape'])
+
+        self.interpreter.set_tensor(self.input['index'], batch)
+        self.interpreter.invoke()
+        result = self.interpreter.get_tensor(self.output['index'])
+
+        scale, zero_point = self.output['quantization']
+        if np.issubdtype(self.output['dtype'], np.integer) and scale:
+            result = (result.astype(np.float32) - zero_point) * scale
+        return result
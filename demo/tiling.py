@@ -0,0 +1,139 @@
+"""
+Tiled inference over images larger than the model input (full resolution TIFFs, stitched wells).
+
+The image is cut into overlapping tile x tile windows with a strided view (no copy of the image),
+and the windows are run through the model batch_size at a time, so memory stays bounded whatever
+the size of the image. Because tiles overlap, every pixel is covered by one or more tiles: the
+prediction of a tile is weighted by the share of its pixels it "owns" (1 / coverage, separable
+along rows and columns), so that
+
+    'sum'  (cell counts): total = sum of weighted tile counts, no cell counted twice
+    'mean' (mean area):   weighted mean of the tile predictions
+
+The image is sent in any format of payloads.py (not resized), or as a reference to a stitched well
+of data_handling/stitching.py: {"plate": "24585", "well": "a01", "channels": ["Hoechst"], "level": 0}.
+"""
+import json
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from payloads import PayloadError, read_image
+from bulk import check_plate, import_data_handling
+
+TILE_SIZE = 224
+REDUCTIONS = ('sum', 'mean')
+
+
+def tile_starts(length, tile, stride):
+    """
+    Start of the tiles along one axis, the last tile ends on the edge of the image.
+    """
+    if length <= tile:
+        return np.array([0])
+    starts = np.arange(0, length - tile + 1, stride)
+    if starts[-1] != length - tile:
+        starts = np.append(starts, length - tile)
+    return starts
+
+
+def axis_weights(length, tile, starts):
+    """
+    Share of each tile along one axis: mean over its pixels of 1 / number of tiles covering the pixel.
+    """
+    coverage = np.zeros(length + 1)
+    np.add.at(coverage, starts, 1)
+    np.add.at(coverage, np.minimum(starts + tile, length), -1)
+    inverse = 1 / np.cumsum(coverage)[:length]
+    cumulative = np.concatenate([[0], np.cumsum(inverse)])
+    ends = np.minimum(starts + tile, length)
+    return (cumulative[ends] - cumulative[starts]) / (ends - starts)
+
+
+def pad_to_tile(image, tile):
+    """
+    Pad an image smaller than a tile with zeros, the only case the image is copied.
+    """
+    pad_h, pad_w = max(tile - image.shape[0], 0), max(tile - image.shape[1], 0)
+    if pad_h or pad_w:
+        image = np.pad(image, [(0, pad_h), (0, pad_w)] + [(0, 0)] * (image.ndim - 2))
+    return image
+
+
+def iter_tiles(image, tile=TILE_SIZE, overlap=32, batch_size=64):
+    """
+    Yield (batch of tiles, weight of each tile) for an image of shape (H, W) or (H, W, C).
+    """
+    if not 0 <= overlap < tile:
+        raise ValueError(f'overlap must be in [0, {tile})')
+    height, width = image.shape[:2]
+    image = pad_to_tile(image, tile)
+    stride = tile - overlap
+
+    ys, xs = tile_starts(image.shape[0], tile, stride), tile_starts(image.shape[1], tile, stride)
+    # Tiles are clipped to the real size: the padding owns no pixel
+    wy, wx = axis_weights(height, tile, ys), axis_weights(width, tile, xs)
+    grid_y, grid_x = np.meshgrid(np.arange(len(ys)), np.arange(len(xs)), indexing='ij')
+    grid_y, grid_x = grid_y.ravel(), grid_x.ravel()
+
+    # (H - tile + 1, W - tile + 1, [C,] tile, tile) view of every window
+    windows = sliding_window_view(image, (tile, tile), axis=(0, 1))
+    for start in range(0, len(grid_y), batch_size):
+        iy, ix = grid_y[start:start + batch_size], grid_x[start:start + batch_size]
+        batch = windows[ys[iy], xs[ix]]
+        if image.ndim == 3:
+            batch = np.moveaxis(batch, 1, -1)
+        yield np.ascontiguousarray(batch), wy[iy] * wx[ix]
+
+
+async def predict_tiled(image, models, tile=TILE_SIZE, overlap=32, batch_size=64):
+    """
+    Aggregated predictions of the models over the tiles of image.
+    models maps an output name to (registry entry of the model, scale the tiles are divided by or None, reduction).
+    """
+    for name, (_, _, reduction) in models.items():
+        if reduction not in REDUCTIONS:
+            raise ValueError(f'Unknown reduction {reduction!r} for {name}, use one of {REDUCTIONS}')
+
+    totals = {name: 0.0 for name in models}
+    total_weight = 0.0
+    n_tiles = 0
+    for batch, weights in iter_tiles(image, tile, overlap, batch_size):
+        for name, (entry, scale, _) in models.items():
+            inputs = batch / scale if scale else batch
+            predictions = (await entry.predict_batch(inputs)).reshape(len(batch), -1)[:, 0]
+            totals[name] += float(np.dot(predictions, weights))
+        total_weight += float(weights.sum())
+        n_tiles += len(batch)
+
+    result = {'shape': list(image.shape), 'tiles': n_tiles}
+    for name, (_, _, reduction) in models.items():
+        result[name] = totals[name] if reduction == 'sum' else totals[name] / total_weight
+    return result
+
+
+def well_mosaic(plate_number, well, channels=('Hoechst',), level=0):
+    """
+    Stitched well, (H, W) for one channel or (H, W, C) for several.
+    """
+    check_plate(plate_number, channels)
+    import_data_handling()
+    from stitching import WellMosaics
+
+    try:
+        views = [WellMosaics(plate_number, channel).well(well, level) for channel in channels]
+    except (FileNotFoundError, KeyError) as e:
+        raise PayloadError(f'No mosaic of well {well} of plate {plate_number}: {e}')
+    return views[0] if len(views) == 1 else np.stack(views, axis=-1)
+
+
+async def read_large_image(request):
+    """
+    Image of the request at full resolution, or the stitched well it refers to.
+    """
+    if request.headers.get('content-type', '').startswith('application/json'):
+        try:
+            payload = json.loads(await request.body() or b'{}')
+        except ValueError as e:
+            raise PayloadError(f'Invalid JSON: {e}')
+        if isinstance(payload, dict) and 'plate' in payload and 'well' in payload:
+            return well_mosaic(str(payload['plate']), payload['well'], payload.get('channels', ['Hoechst']), payload.get('level', 0))
+    return await read_image(request, size=None)
@@ -0,0 +1,20 @@
+"""
+The pipeline modules use flat imports and read their settings from the environment when imported,
+so both are set up here, before any test module imports them: everything runs offline in a temp folder.
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+os.environ.setdefault('LOCAL_DATA_PATH', tempfile.mkdtemp(prefix='morpho_minds_tests_'))
+os.environ['DATA_BACKEND'] = 'local'
+os.environ['METRICS_PATH'] = ''
+os.environ.setdefault('PLATE_NUMBER', '90000')
+os.environ.setdefault('BQ_DATASET', 'tests')
+
+for folder in ('data_handling', 'dataset_to_bucket'):
+    if str(ROOT.joinpath(folder)) not in sys.path:
+        sys.path.append(str(ROOT.joinpath(folder)))
@@ -0,0 +1,26 @@
+import pandas as pd
+from backends import get_backend
+from cache import TableWriter, processed_path, read_table
+from main import Plate, PLATE_NUMBER
+from utils import create_folder_structure
+
+
+def test_table_writer_without_chunks(tmp_path):
+    path = tmp_path / 'empty.parquet'
+    with TableWriter(path):
+        pass
+    assert read_table(path).empty
+
+
+def test_empty_warehouse_table_is_cached_with_its_columns():
+    create_folder_structure(PLATE_NUMBER)
+    empty = pd.DataFrame({'ImageID': pd.Series(dtype='int64'), 'Well': pd.Series(dtype='str')})
+    get_backend().write(None, f'project.tests.{PLATE_NUMBER}_pictures', empty)
+
+    path = processed_path(PLATE_NUMBER, 'pictures')
+    plate = Plate(PLATE_NUMBER)
+    plate.get_processed_data('pictures', path)
+
+    assert plate.processed_pictures_df.empty
+    assert list(plate.processed_pictures_df.columns) == ['ImageID', 'Well']
+    assert list(read_table(path).columns) == ['ImageID', 'Well']
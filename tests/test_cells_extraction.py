@@ -0,0 +1,51 @@
+import sqlite3
+import numpy as np
+import pyarrow.parquet as pq
+import pytest
+from backends import get_backend
+from cache import processed_path, read_table
+from main import Plate, PLATE_NUMBER
+from synthetic import write_cells_table
+from utils import create_folder_structure
+
+
+def cells_db(declared_types):
+    """
+    5 cells over 2 images, Cells_Granularity_10_RNA is NULL for every cell of the first image.
+    """
+    conn = sqlite3.connect(':memory:')
+    write_cells_table(conn, np.array([2, 3]), declared_types=declared_types)
+    conn.execute('UPDATE Cells SET Cells_Granularity_10_RNA = NULL WHERE ImageNumber = 0')
+    conn.execute('UPDATE Cells SET Cells_Granularity_10_RNA = 0.5 WHERE ImageNumber = 1')
+    return conn
+
+
+@pytest.mark.parametrize('declared_types', [True, False])
+def test_all_null_first_chunk_keeps_float_type(declared_types):
+    conn = cells_db(declared_types)
+    plate = Plate(PLATE_NUMBER)
+
+    chunks = list(plate.iter_cells_data(conn, chunk_size=2))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert all(chunk['CellsGranularity10RNA'].dtype == 'float32' for chunk in chunks)
+    assert chunks[0]['CellsGranularity10RNA'].tolist() == [0, 0]
+
+    plate.load_cells_data(conn)
+    plate.clean_cells_data()
+    assert plate.cells_df.dtypes.to_dict() == chunks[0].dtypes.to_dict()
+    assert plate.cells_df['CellsAreaShapeArea'].dtype == 'int32'
+
+
+def test_stream_cells_data_replaces_warehouse_table():
+    create_folder_structure(PLATE_NUMBER)
+    conn = cells_db(True)
+    plate = Plate(PLATE_NUMBER)
+
+    # A rerun replaces the table instead of appending the rows again
+    for _ in range(2):
+        assert plate.stream_cells_data(conn, chunk_size=2) == 5
+
+    path = processed_path(PLATE_NUMBER, 'cells')
+    assert str(pq.read_schema(path).field('CellsGranularity10RNA').type) == 'float'
+    assert len(read_table(path)) == 5
+    assert len(get_backend().read(None, f'project.tests.{PLATE_NUMBER}_cells')) == 5
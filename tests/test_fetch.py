@@ -0,0 +1,155 @@
+import http.server
+import os
+import threading
+import pytest
+import fetch
+from fetch import download_files
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves server.files with Range support. With server.hide_size the size is never sent,
+    like servers that answer HEAD without a Content-Length and Range requests with 'bytes a-b/*'.
+    """
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        body = self.server.files.get(self.path)
+        if body is None or self.server.hide_size:
+            self.send_response(404 if body is None else 405)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        if self.server.failures:
+            self.send_response(self.server.failures.pop(0))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        total = '*' if self.server.hide_size else str(len(body))
+        range_header = self.headers.get('Range')
+        if range_header is None:
+            self.send_response(200)
+            if not self.server.hide_size:
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        start, end = range_header.removeprefix('bytes=').split('-')
+        start, end = int(start), min(int(end) if end else len(body) - 1, len(body) - 1)
+        if start >= len(body):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(body)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{total}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(body[start:end + 1])
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    server.files = {'/file.bin': os.urandom(300_000)}
+    server.hide_size = False
+    server.failures = []
+    server.requests = []
+    server.url = f'http://127.0.0.1:{server.server_port}'
+    threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(fetch, 'RETRY_BACKOFF_S', 0)
+
+
+def download(server, path, **kwargs):
+    result, = download_files([{'url': f'{server.url}/file.bin', 'path': path}], **kwargs)
+    return result
+
+
+def test_download_and_skip(server, tmp_path):
+    path = tmp_path / 'file.bin'
+    assert download(server, path)['status'] == 'downloaded'
+    assert path.read_bytes() == server.files['/file.bin']
+    assert download(server, path)['status'] == 'skipped'
+
+
+def test_resume_partial_file(server, tmp_path):
+    path = tmp_path / 'file.bin'
+    body = server.files['/file.bin']
+    (tmp_path / 'file.bin.part').write_bytes(body[:100_000])
+
+    assert download(server, path)['status'] == 'downloaded'
+    assert path.read_bytes() == body
+    assert server.requests[-1] == ('/file.bin', f'bytes=100000-{len(body) - 1}')
+
+
+def test_complete_part_of_unknown_size(server, tmp_path):
+    server.hide_size = True
+    path = tmp_path / 'file.bin'
+    body = server.files['/file.bin']
+    (tmp_path / 'file.bin.part').write_bytes(body)
+
+    # The server answers 416 to the resume request: the .part already holds the whole file
+    assert download(server, path)['status'] == 'downloaded'
+    assert path.read_bytes() == body
+    assert not (tmp_path / 'file.bin.part').exists()
+
+
+def test_overlong_part_of_unknown_size_starts_over(server, tmp_path):
+    server.hide_size = True
+    path = tmp_path / 'file.bin'
+    (tmp_path / 'file.bin.part').write_bytes(server.files['/file.bin'] + b'extra')
+
+    assert download(server, path)['status'] == 'downloaded'
+    assert path.read_bytes() == server.files['/file.bin']
+
+
+def test_segments(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch, 'MIN_SEGMENT_SIZE', 50_000)
+    path = tmp_path / 'file.bin'
+    body = server.files['/file.bin']
+    # One segment was already fetched by an interrupted run
+    (tmp_path / 'file.bin.part0').write_bytes(body[:75_000])
+
+    assert download(server, path, segments=4)['status'] == 'downloaded'
+    assert path.read_bytes() == body
+    ranges = sorted(r for _, r in server.requests if r != 'bytes=0-0')
+    assert ranges == ['bytes=150000-224999', 'bytes=225000-299999', 'bytes=75000-149999']
+    assert not list(tmp_path.glob('file.bin.part*'))
+
+
+def test_server_errors_are_retried(server, tmp_path):
+    server.failures = [503, 500]
+    path = tmp_path / 'file.bin'
+    assert download(server, path)['status'] == 'downloaded'
+    assert path.read_bytes() == server.files['/file.bin']
+
+
+def test_client_errors_are_not_retried(server, tmp_path):
+    server.failures = [403] * 4
+    result = download(server, tmp_path / 'file.bin')
+    assert result['status'] == 'failed'
+    assert len(server.requests) == 1